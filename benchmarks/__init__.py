@@ -0,0 +1,14 @@
+"""Benchmarks for the hasensor package.
+
+Run individual benchmarks from the top of the source tree, as in:
+
+    python3 -m benchmarks.bench_scheduler
+    python3 -m benchmarks.bench_loop --json
+
+Benchmarks that need a broker start the stand-in in benchmarks.broker, so no
+external infrastructure is required.  Every benchmark accepts --json to emit
+machine-readable results for comparison between releases.
+
+python3 -m benchmarks.check_loops runs Loop and AsyncLoop on every scheduler
+backend briefly, and exits non-zero if any of them fails to run its sensors.
+"""
@@ -0,0 +1,159 @@
+"""Measure the I2C bus time of a BME280 reading.
+
+The forced-mode burst read used by BME280Sensor is compared with the access
+pattern of the Adafruit driver it replaced, which read the temperature,
+humidity and pressure properties separately: five register reads per
+reading, three of them of the temperature registers.  Bus time is modeled
+from the bits each transaction puts on the wire at the given clock rate, and
+wall time per reading is measured as well.
+
+By default the chip is simulated, so the wall time covers only the Python
+side of each reading; with --hardware the BME280 on the board's default I2C
+pins is used, and the wall time includes the real bus (and, for the burst
+read, the measurement itself).  The legacy pattern is replayed as register
+reads only, so its wall time leaves out the driver's three compensation
+passes.
+"""
+
+import argparse
+import json
+import struct
+import time
+from typing import Any, Callable, Dict, List
+
+from hasensor.sensors.bme280 import BME280
+
+# Datasheet example calibration and raw readings (25.08 C, 1006.53 hPa)
+_CALIB_TP = struct.pack("<HhhHhhhhhhhh", 27504, 26435, -1000, 36477, -10685,
+                        3024, 2855, 140, -7, 15500, -14600, 6000) + b"\0\x4b"
+_CALIB_H = struct.pack("<hBbBbb", 362, 0, 19, 41, 3, 30)
+_ADC_P, _ADC_T, _ADC_H = 415148, 519888, 30000
+
+
+class _SimulatedI2C:
+    # Enough of busio.I2C and a BME280 behind it for BME280 to run
+    def __init__(self):
+        self._registers = bytearray(256)
+        self._registers[0xD0] = 0x60
+        self._registers[0x88:0x88 + len(_CALIB_TP)] = _CALIB_TP
+        self._registers[0xE1:0xE1 + len(_CALIB_H)] = _CALIB_H
+        self._registers[0xF7:0xFF] = bytes([
+            _ADC_P >> 12, (_ADC_P >> 4) & 0xFF, (_ADC_P & 0xF) << 4,
+            _ADC_T >> 12, (_ADC_T >> 4) & 0xFF, (_ADC_T & 0xF) << 4,
+            _ADC_H >> 8, _ADC_H & 0xFF])
+
+    def try_lock(self) -> bool:
+        return True
+
+    def unlock(self) -> None:
+        pass
+
+    def writeto(self, address: int, buf: bytes) -> None:
+        if buf[0] != 0xE0:
+            self._registers[buf[0]:buf[0] + len(buf) - 1] = buf[1:]
+
+    def writeto_then_readfrom(self, address: int, out: bytes,
+                              buf: bytearray) -> None:
+        buf[:] = self._registers[out[0]:out[0] + len(buf)]
+
+
+class _CountingI2C:
+    # Wraps a bus, counting transactions and the bits they put on the wire
+    def __init__(self, i2c: Any):
+        self._i2c = i2c
+        self.transactions = 0
+        self.bits = 0
+
+    def try_lock(self) -> bool:
+        return self._i2c.try_lock()
+
+    def unlock(self) -> None:
+        self._i2c.unlock()
+
+    def writeto(self, address: int, buf: bytes) -> None:
+        self._i2c.writeto(address, buf)
+        self.transactions += 1
+        # Start, address, data bytes (each with an ACK bit), stop
+        self.bits += 1 + 9 + 9 * len(buf) + 1
+
+    def writeto_then_readfrom(self, address: int, out: bytes,
+                              buf: bytearray) -> None:
+        self._i2c.writeto_then_readfrom(address, out, buf)
+        self.transactions += 1
+        # Start, address, register, repeated start, address, data, stop
+        self.bits += 1 + 9 + 9 * len(out) + 1 + 9 + 9 * len(buf) + 1
+
+
+def _burst_read(bme280: BME280) -> None:
+    bme280.start()
+    bme280.collect()
+
+
+def _legacy_read(bme280: BME280) -> None:
+    # The register reads made by the temperature, humidity and pressure
+    # properties of the Adafruit driver in normal mode
+    read = bme280._read                 # pylint: disable=protected-access
+    read(0xFA, 3)
+    read(0xFA, 3)
+    read(0xFD, 2)
+    read(0xFA, 3)
+    read(0xF7, 3)
+
+
+def _measure(bus: _CountingI2C, read: Callable[[], Any],
+             readings: int) -> Dict[str, float]:
+    bus.transactions = bus.bits = 0
+    begin = time.perf_counter()
+    for _ in range(readings):
+        read()
+    elapsed = time.perf_counter() - begin
+    return {"transactions": bus.transactions / readings,
+            "bits": bus.bits / readings,
+            "seconds_per_reading": elapsed / readings}
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--readings", type=int, default=200,
+                        help="Readings per run")
+    parser.add_argument("--clock", type=int, default=100000,
+                        help="I2C clock rate (Hz) for the modeled bus time")
+    parser.add_argument("--hardware", action="store_true",
+                        help="Use a real BME280 instead of a simulated one")
+    parser.add_argument("--address", type=lambda x: int(x, 0), default=0x77,
+                        help="The BME280's I2C address, with --hardware")
+    parser.add_argument("--json", action="store_true",
+                        help="Emit machine-readable results")
+    args = parser.parse_args()
+
+    if args.hardware:
+        from hasensor.i2cbus import shared_bus
+        bus = _CountingI2C(shared_bus().i2c)
+    else:
+        bus = _CountingI2C(_SimulatedI2C())
+    bme280 = BME280(bus, args.address)
+
+    results: List[Dict[str, Any]] = []
+    # A simulated chip measures instantly
+    burst = bme280.read if args.hardware else lambda: _burst_read(bme280)
+    for name, read in (("burst", burst),
+                       ("legacy", lambda: _legacy_read(bme280))):
+        result: Dict[str, Any] = {"read": name}
+        result.update(_measure(bus, read, args.readings))
+        result["bus_seconds"] = result["bits"] / args.clock
+        results.append(result)
+
+    if args.json:
+        print(json.dumps(results))
+        return
+    print("%-8s %8s %8s %12s %12s" % ("read", "xfers", "bits", "bus us",
+                                      "wall us"))
+    for result in results:
+        print("%-8s %8.1f %8.1f %12.1f %12.1f"
+              % (result["read"], result["transactions"], result["bits"],
+                 result["bus_seconds"] * 1e6,
+                 result["seconds_per_reading"] * 1e6))
+
+
+if __name__ == "__main__":
+    _main()
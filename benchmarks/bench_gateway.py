@@ -0,0 +1,149 @@
+"""Measure the memory cost of each node hosted by a gateway.
+
+A gateway loop, on the in-memory transport, starts the given number of
+logical nodes, each from its own configuration file with a set of synthetic
+sensors and discovery enabled, and runs them for a while.  The Python heap
+(by tracemalloc) and resident memory allocated for the nodes are divided by
+their number to give the cost of each node.  For comparison, the same node
+is run alone as its own process, the way nodes were run before gateways,
+and that process's resident memory is reported: the per-process cost a
+gateway node replaces.
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Dict, List
+
+from hasensor.configuration import Configuration
+from hasensor.event import Event
+from hasensor.gateway import start_nodes
+from hasensor.loop import Loop
+from hasensor.registry import register_sensor_type
+from hasensor.sensorset import SensorSet
+
+from .synthetic import SyntheticSensor
+
+
+def _rss() -> int:
+    # Current resident memory in bytes, or the peak where that is unknown
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _sensors(args: argparse.Namespace) -> List[str]:
+    return ["synthetic:name=sensor%d:period=%f:size=%d"
+            % (i, args.period, args.size) for i in range(args.sensors)]
+
+
+def _write_nodes(directory: str, args: argparse.Namespace) -> List[str]:
+    paths = []
+    for i in range(args.nodes):
+        path = os.path.join(directory, "node%d.conf" % i)
+        with open(path, "w") as f:
+            f.write("prefix = gateway/node%d\ndiscoverable\n" % i)
+            for desc in _sensors(args):
+                f.write("sensor = %s\n" % desc)
+        paths.append(path)
+    return paths
+
+
+def _run(loop: Loop, duration: float) -> None:
+    loop.schedule(Event(time.time() + duration, lambda data: loop.stop()))
+    loop.loop()
+
+
+def _gateway(args: argparse.Namespace) -> Dict[str, Any]:
+    conf = Configuration()
+    conf.transport = "memory"
+    conf.discoverable = True
+    with tempfile.TemporaryDirectory() as directory:
+        conf.nodes = _write_nodes(directory, args)
+        loop = Loop(conf)
+
+        tracemalloc.start()
+        rss = _rss()
+        heap = tracemalloc.get_traced_memory()[0]
+        nodes = start_nodes(loop, conf)
+        _run(loop, args.duration)
+        heap = tracemalloc.get_traced_memory()[0] - heap
+        rss = _rss() - rss
+        tracemalloc.stop()
+
+    return {"nodes": len(nodes),
+            "sensors_per_node": args.sensors,
+            "published": loop.outbound.sent,
+            "heap_per_node": heap / len(nodes),
+            "rss_per_node": rss / len(nodes),
+            "rss_total": _rss()}
+
+
+def _standalone(args: argparse.Namespace) -> Dict[str, Any]:
+    # One node with its own loop, as its own process would run it
+    conf = Configuration()
+    conf.transport = "memory"
+    conf.discoverable = True
+    loop = Loop(conf)
+    sensors = SensorSet(loop)
+    sensors.apply(_sensors(args))
+    _run(loop, args.duration)
+    return {"rss_total": _rss()}
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--nodes", type=int, default=50,
+                        help="Number of nodes hosted by the gateway")
+    parser.add_argument("--sensors", type=int, default=4,
+                        help="Synthetic sensors per node")
+    parser.add_argument("--period", type=float, default=1.0,
+                        help="Period of each sensor (seconds)")
+    parser.add_argument("--size", type=int, default=16,
+                        help="Size of each reading (bytes)")
+    parser.add_argument("--duration", type=float, default=3.0,
+                        help="Time to run the nodes before measuring "
+                        "(seconds)")
+    parser.add_argument("--standalone", action="store_true",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--json", action="store_true",
+                        help="Emit machine-readable results")
+    args = parser.parse_args()
+
+    register_sensor_type("synthetic", SyntheticSensor)
+    if args.standalone:
+        print(json.dumps(_standalone(args)))
+        return
+
+    result = _gateway(args)
+    child = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_gateway", "--standalone",
+         "--sensors", str(args.sensors), "--period", str(args.period),
+         "--size", str(args.size), "--duration", str(args.duration)],
+        check=True, stdout=subprocess.PIPE)
+    result["standalone_rss"] = json.loads(child.stdout)["rss_total"]
+
+    if args.json:
+        print(json.dumps(result))
+        return
+    print("%d nodes of %d sensors, %d messages published"
+          % (result["nodes"], result["sensors_per_node"],
+             result["published"]))
+    print("gateway heap per node:     %8.1f KiB"
+          % (result["heap_per_node"] / 1024))
+    print("gateway resident per node: %8.1f KiB"
+          % (result["rss_per_node"] / 1024))
+    print("standalone node process:   %8.1f KiB"
+          % (result["standalone_rss"] / 1024))
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,156 @@
+"""Measure the loop end to end against a stand-in broker.
+
+A Loop (or AsyncLoop) is connected to an in-process broker stand-in, or to
+another transport, and runs a set of synthetic sensors for a fixed time.  The
+run reports the rate at which events fired, publish throughput as sent by the
+loop and as received by the broker or in-memory consumer, percentiles of how
+late readings were, CPU time per event, and peak resident memory.  The broker
+runs in the same process, so its CPU time is included; compare runs with each
+other rather than against a real node.
+"""
+
+import argparse
+import json
+import resource
+import time
+from typing import Any, Dict, List
+
+from hasensor.asyncloop import AsyncLoop
+from hasensor.configuration import Configuration
+from hasensor.event import Event
+from hasensor.loop import Loop
+from hasensor.outbound import Message
+from hasensor.transport import MemoryTransport
+
+from .broker import Broker
+from .synthetic import SyntheticSensor
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def _cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    """Run the benchmark described by args and return its results."""
+    broker = None
+    conf = Configuration()
+    conf.transport = args.transport
+    conf.transport_path = args.path
+    if args.transport == "mqtt":
+        broker = Broker().start()
+        conf.broker = broker.address
+    conf.scheduler = args.scheduler
+    conf.coalesce_window = args.window
+    loop = AsyncLoop(conf) if args.asyncio else Loop(conf)
+    received = [0, 0]
+    if isinstance(loop.transport, MemoryTransport):
+        def consume(message: Message) -> None:
+            received[0] += 1
+            received[1] += len(message[1])
+        loop.transport.subscribe(consume)
+
+    sensors = []
+    start = time.time() + 0.5
+    for i in range(args.sensors):
+        # Stagger the sensors across their period
+        sensor = SyntheticSensor(name="synthetic%d" % i, cost=args.cost,
+                                 size=args.size, period=args.period,
+                                 start=start + args.period * i / args.sensors,
+                                 threaded=args.threaded, qos=args.qos)
+        sensor.set_loop(loop)
+        loop.schedule(sensor.event())
+        sensors.append(sensor)
+    loop.schedule(Event(start + args.duration, lambda data: loop.stop()))
+
+    cpu = _cpu_time()
+    loop.loop()
+    cpu = _cpu_time() - cpu
+    if broker is not None:
+        # Give the broker a moment to read what is still in the socket
+        time.sleep(0.2)
+        broker.stop()
+        received = [broker.count, broker.bytes]
+
+    fires = sum(sensor.fires for sensor in sensors)
+    lateness = sorted(late for sensor in sensors for late in sensor.lateness)
+    return {
+        "loop": "asyncio" if args.asyncio else "select",
+        "transport": args.transport,
+        "scheduler": args.scheduler,
+        "sensors": args.sensors,
+        "period": args.period,
+        "cost": args.cost,
+        "size": args.size,
+        "threaded": args.threaded,
+        "duration": args.duration,
+        "events": fires,
+        "events_per_sec": fires / args.duration,
+        "published": loop.outbound.sent,
+        "publish_per_sec": loop.outbound.sent / args.duration,
+        "coalesced": loop.outbound.coalesced,
+        "received": received[0],
+        "received_bytes": received[1],
+        "jitter_p50": _percentile(lateness, 0.5),
+        "jitter_p90": _percentile(lateness, 0.9),
+        "jitter_p99": _percentile(lateness, 0.99),
+        "jitter_max": lateness[-1] if lateness else 0.0,
+        "cpu_per_event": cpu / fires if fires else 0.0,
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sensors", type=int, default=100,
+                        help="Number of synthetic sensors")
+    parser.add_argument("--period", type=float, default=0.1,
+                        help="Period of each sensor (seconds)")
+    parser.add_argument("--cost", type=float, default=0.0,
+                        help="CPU time spent by each reading (seconds)")
+    parser.add_argument("--size", type=int, default=16,
+                        help="Size of each reading (bytes)")
+    parser.add_argument("--duration", type=float, default=10.0,
+                        help="Length of the run (seconds)")
+    parser.add_argument("--qos", type=int, default=0,
+                        help="QoS level of each reading")
+    parser.add_argument("--window", type=float, default=0.0,
+                        help="Outbound coalescing window (seconds)")
+    parser.add_argument("--transport", default="mqtt",
+                        choices=["mqtt", "memory", "unix", "file"],
+                        help="Transport (mqtt uses the broker stand-in)")
+    parser.add_argument("--path",
+                        help="Socket or file path for the unix or file transport")
+    parser.add_argument("--scheduler", default="heap",
+                        help="Scheduler backend")
+    parser.add_argument("--threaded", action="store_true",
+                        help="Read the sensors on worker threads")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="Use AsyncLoop rather than Loop")
+    parser.add_argument("--json", action="store_true",
+                        help="Emit machine-readable results")
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.json:
+        print(json.dumps(result))
+        return
+    for key, value in result.items():
+        if key.startswith("jitter_"):
+            print("%-16s %10.3f ms" % (key, value * 1000))
+        elif key == "cpu_per_event":
+            print("%-16s %10.1f us" % (key, value * 1e6))
+        elif isinstance(value, float):
+            print("%-16s %10.1f" % (key, value))
+        else:
+            print("%-16s %10s" % (key, value))
+
+
+if __name__ == "__main__":
+    _main()
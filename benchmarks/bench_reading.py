@@ -0,0 +1,77 @@
+"""Measure the cost and size of encoding sensor readings.
+
+Each sensor's payload is built the way it was before Readings (a
+%-formatted string, or json.dumps of a dict for the system sensor) and with
+the precompiled JSON and binary encoders, and the time per payload and the
+payload size are reported.  Nothing is published; only encoding is timed.
+"""
+
+import argparse
+import json
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from hasensor.reading import Fields, Reading, create_encoder
+from hasensor.sensors.bme280 import BME280Sensor
+from hasensor.sensors.rtlamr import RTLAMRSensor
+from hasensor.sensors.system import SystemSensor
+
+def _cases() -> List[Tuple[str, Fields, Reading, Callable[[], Any]]]:
+    # Each sensor's fields and a sample reading, with the legacy encoding
+    bme280 = Reading(21.537, 40.214, 1006.5327)
+    rtlamr = Reading(12345678, 4321)
+    system = Reading(48.312, 12.345, 41.27, ["/", "/var"])
+    return [
+        ("bme280", BME280Sensor._fields, bme280,
+         lambda: '{"temp":%.01f,"humidity":%.01f,"pressure":%.02f}'
+         % bme280.values),
+        ("rtlamr", RTLAMRSensor._fields, rtlamr,
+         lambda: '{"id":%d,"kWh":%d}' % rtlamr.values),
+        ("system", SystemSensor._fields, system,
+         lambda: json.dumps({"cpu_temp": round(system.values[0], 1),
+                             "cpu_pct": round(system.values[1], 1),
+                             "mem_used_pct": round(system.values[2], 1),
+                             "disk_full": system.values[3]})),
+    ]
+
+
+def _time(func: Callable[[], Any], count: int) -> float:
+    begin = time.perf_counter()
+    for _ in range(count):
+        func()
+    return (time.perf_counter() - begin) / count
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--count", type=int, default=100000,
+                        help="Payloads encoded per run")
+    parser.add_argument("--json", action="store_true",
+                        help="Emit machine-readable results")
+    args = parser.parse_args()
+
+    results: List[Dict[str, Any]] = []
+    for sensor, fields, reading, legacy in _cases():
+        runs: List[Tuple[str, Callable[[], Any]]] = [("legacy", legacy)]
+        for encoding in ("json", "binary"):
+            encoder = create_encoder(fields, encoding)
+            runs.append((encoding,
+                         lambda e=encoder: e.encode(reading.values)))
+        for encoding, func in runs:
+            results.append({"sensor": sensor, "encoding": encoding,
+                            "seconds_per_payload": _time(func, args.count),
+                            "bytes": len(func())})
+
+    if args.json:
+        print(json.dumps(results))
+        return
+    print("%-8s %-8s %10s %8s" % ("sensor", "encoding", "ns/payload",
+                                  "bytes"))
+    for result in results:
+        print("%-8s %-8s %10.0f %8d"
+              % (result["sensor"], result["encoding"],
+                 result["seconds_per_payload"] * 1e9, result["bytes"]))
+
+
+if __name__ == "__main__":
+    _main()
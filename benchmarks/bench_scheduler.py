@@ -0,0 +1,99 @@
+"""Compare the loop scheduler backends.
+
+Each run schedules N repeating events with random periods and then drives
+the scheduler on a simulated clock, rescheduling every event that fires, until
+a fixed number of events have fired.  The "legacy" backend is the bare
+heapq-of-Events scheduler the loop used originally, which orders events with
+Event.__lt__.
+"""
+
+import argparse
+import json
+import random
+import time
+from heapq import heappush, heappop
+from typing import Any, Callable, Dict, List
+
+from hasensor.event import RepeatingEvent, NOW
+from hasensor.scheduler import HeapScheduler, Scheduler, TimingWheelScheduler
+
+_SIZES = [10, 100, 1000, 10000, 100000]
+
+
+def _events(n: int, seed: int) -> List[RepeatingEvent]:
+    rand = random.Random(seed)
+    events = []
+    for _ in range(n):
+        period = rand.choice([1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 600.0])
+        event = RepeatingEvent(NOW, period)
+        # Run on a simulated clock starting from zero
+        event.next_fire = rand.uniform(1.0, period)
+        events.append(event)
+    return events
+
+
+def _run_legacy(events: List[RepeatingEvent], fires: int) -> float:
+    heap: List[RepeatingEvent] = []
+    begin = time.perf_counter()
+    for event in events:
+        heappush(heap, event)
+    for _ in range(fires):
+        event = heappop(heap)
+        event.next_fire += event.period
+        heappush(heap, event)
+    return time.perf_counter() - begin
+
+
+def _run_scheduler(sched: Scheduler, events: List[RepeatingEvent],
+                   fires: int) -> float:
+    fired = 0
+    begin = time.perf_counter()
+    for event in events:
+        sched.push(event)
+    while fired < fires:
+        now = sched.next_time()
+        for event in sched.pop_due(now):
+            event.next_fire += event.period
+            sched.push(event)
+            fired += 1
+    return time.perf_counter() - begin
+
+
+_BACKENDS: Dict[str, Callable[[List[RepeatingEvent], int], float]] = {
+    "legacy": _run_legacy,
+    "heap": lambda events, fires: _run_scheduler(HeapScheduler(), events,
+                                                 fires),
+    "wheel": lambda events, fires: _run_scheduler(
+        TimingWheelScheduler(clock=lambda: 0.0), events, fires),
+}
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--fires", type=int, default=200000,
+                        help="Events to fire per run")
+    parser.add_argument("--sizes", type=int, nargs="+", default=_SIZES,
+                        help="Numbers of scheduled events to test")
+    parser.add_argument("--json", action="store_true",
+                        help="Emit machine-readable results")
+    args = parser.parse_args()
+
+    results: List[Dict[str, Any]] = []
+    for size in args.sizes:
+        for name, run in _BACKENDS.items():
+            elapsed = run(_events(size, size), args.fires)
+            results.append({"backend": name, "events": size,
+                            "seconds": elapsed,
+                            "fires_per_sec": args.fires / elapsed})
+
+    if args.json:
+        print(json.dumps(results))
+        return
+    print("%-8s %8s %12s" % ("backend", "events", "fires/s"))
+    for result in results:
+        print("%-8s %8d %12.0f" % (result["backend"], result["events"],
+                                   result["fires_per_sec"]))
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,120 @@
+"""Measure the append throughput and read latency of the local store.
+
+Readings of a BME280-shaped sensor are recorded into a fresh store in a
+temporary directory (or --path), one second apart in simulated time, with the
+buffers written out and fsynced every --batch readings as the loop's sync
+event would.  Append throughput counts both the recording and the writes.
+Then ranges of raw readings, and of minute rollups, are read back from random
+points, and the latency of each read is reported as percentiles.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, List
+
+from hasensor.reading import Reading
+from hasensor.sensors.bme280 import BME280Sensor
+from hasensor.store import Store
+
+_TOPIC = "bench/climate"
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def _append(store: Store, args: argparse.Namespace,
+            start: float) -> Dict[str, Any]:
+    fields = BME280Sensor._fields     # pylint: disable=protected-access
+    now = time.monotonic()
+    wall = time.time()
+    flushes: List[float] = []
+    begin = time.perf_counter()
+    for i in range(args.readings):
+        reading = Reading(21.5 + (i % 100) / 100, 40.0 + (i % 7),
+                          1006.53 + (i % 13) / 10)
+        # The monotonic time of a reading start + i seconds since the Epoch
+        store.record(_TOPIC, fields, reading.values,
+                     now - (wall - (start + i)))
+        if (i + 1) % args.batch == 0:
+            flush = time.perf_counter()
+            store.flush()
+            flushes.append(time.perf_counter() - flush)
+    store.flush()
+    elapsed = time.perf_counter() - begin
+    return {"readings": args.readings,
+            "appends_per_sec": args.readings / elapsed,
+            "flush_p50": _percentile(flushes, 0.5) if flushes else 0.0,
+            "flush_max": max(flushes) if flushes else 0.0,
+            "bytes": store.bytes}
+
+
+def _read(store: Store, args: argparse.Namespace, start: float,
+          resolution: str, span: float) -> Dict[str, Any]:
+    latencies = []
+    rows = 0
+    for _ in range(args.queries):
+        since = start + random.uniform(0, max(args.readings - span, 0))
+        begin = time.perf_counter()
+        _, records = store.read(_TOPIC, since, since + span, resolution)
+        latencies.append(time.perf_counter() - begin)
+        rows += len(records)
+    return {"read": "%s %ds" % (resolution, span),
+            "rows": rows / args.queries,
+            "p50": _percentile(latencies, 0.5),
+            "p90": _percentile(latencies, 0.9),
+            "max": max(latencies)}
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--readings", type=int, default=200000,
+                        help="Readings appended, one simulated second apart")
+    parser.add_argument("--batch", type=int, default=1000,
+                        help="Readings between writes and fsyncs")
+    parser.add_argument("--queries", type=int, default=200,
+                        help="Reads of each kind")
+    parser.add_argument("--path",
+                        help="Store directory (default: a temporary one)")
+    parser.add_argument("--json", action="store_true",
+                        help="Emit machine-readable results")
+    args = parser.parse_args()
+
+    path = args.path or tempfile.mkdtemp(prefix="bench_store")
+    try:
+        store = Store(path, 1 << 40)
+        start = 1700000000.0
+        appended = _append(store, args, start)
+        reads = [_read(store, args, start, "raw", 60),
+                 _read(store, args, start, "raw", 3600),
+                 _read(store, args, start, "1m", 86400)]
+        store.close()
+    finally:
+        if args.path is None:
+            shutil.rmtree(path)
+        elif not os.listdir(path):
+            os.rmdir(path)
+
+    if args.json:
+        print(json.dumps({"append": appended, "reads": reads}))
+        return
+    print("%d readings appended: %.0f/s, %d bytes; flush p50 %.2f ms, "
+          "max %.2f ms" % (appended["readings"], appended["appends_per_sec"],
+                           appended["bytes"], appended["flush_p50"] * 1e3,
+                           appended["flush_max"] * 1e3))
+    print("%-14s %8s %10s %10s %10s" % ("read", "rows", "p50 us", "p90 us",
+                                        "max us"))
+    for result in reads:
+        print("%-14s %8.0f %10.1f %10.1f %10.1f"
+              % (result["read"], result["rows"], result["p50"] * 1e6,
+                 result["p90"] * 1e6, result["max"] * 1e6))
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,106 @@
+"""Measure the per-fire cost of the system sensor.
+
+The current SystemSensor is compared with the original implementation, which
+reopened the thermal zone and asked psutil for CPU, memory, and every
+partition on each fire.  The legacy run needs psutil; it is skipped if psutil
+is not installed.  Messages go to the in-memory transport.
+"""
+
+import argparse
+import json
+import os
+import time
+from typing import Any, Callable, Dict, List
+
+from hasensor.configuration import Configuration
+from hasensor.loop import Loop
+from hasensor.sensor import Sensor
+from hasensor.sensors.system import SystemSensor
+
+try:
+    import psutil                       # type: ignore
+except ImportError:
+    psutil = None
+
+_THERMAL = "/sys/class/thermal/thermal_zone0/temp"
+
+
+class _LegacySystemSensor(Sensor):
+    # SystemSensor.fire() as it was, less the partitions argument
+    def __init__(self, diskthresh: float = 0.0, **kwargs):
+        super().__init__(**kwargs)
+        self._diskthresh = diskthresh
+        self._have_thermal = os.path.exists(_THERMAL)
+
+    def fire(self):
+        stats: Dict[str, Any] = {}
+
+        if self._have_thermal:
+            with open(_THERMAL, "r") as f:
+                temp = int(f.read())
+            stats["cpu_temp"] = round(float(temp) / 1000.0, 1)
+
+        stats["cpu_pct"] = round(psutil.cpu_percent(), 1)
+        stats["mem_used_pct"] = round(psutil.virtual_memory().percent, 1)
+
+        if self._diskthresh != 0.0:
+            warnings: List[str] = []
+            for part in psutil.disk_partitions():
+                usage = psutil.disk_usage(part.mountpoint)
+                if usage.percent > self._diskthresh:
+                    warnings.append(part.mountpoint)
+            if warnings:
+                stats["disk_full"] = warnings
+
+        self.publish(json.dumps(stats))
+
+
+def _measure(sensor: Sensor, fires: int) -> float:
+    conf = Configuration()
+    conf.transport = "memory"
+    loop = Loop(conf)
+    sensor.set_loop(loop)
+    sensor.read()
+    begin = time.perf_counter()
+    for _ in range(fires):
+        sensor.read()
+    elapsed = time.perf_counter() - begin
+    sensor.close()
+    return elapsed / fires
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--fires", type=int, default=2000,
+                        help="Fires per run")
+    parser.add_argument("--diskthresh", type=float, default=90.0,
+                        help="Disk threshold (0 skips the partition scan)")
+    parser.add_argument("--json", action="store_true",
+                        help="Emit machine-readable results")
+    args = parser.parse_args()
+
+    runs: Dict[str, Callable[[], Sensor]] = {
+        "current": lambda: SystemSensor(name="system",
+                                        diskthresh=args.diskthresh),
+    }
+    if psutil is not None:
+        runs["legacy"] = lambda: _LegacySystemSensor(
+            name="system", diskthresh=args.diskthresh)
+
+    results = []
+    for name, create in runs.items():
+        per_fire = _measure(create(), args.fires)
+        results.append({"sensor": name, "diskthresh": args.diskthresh,
+                        "seconds_per_fire": per_fire})
+
+    if args.json:
+        print(json.dumps(results))
+        return
+    print("%-8s %12s" % ("sensor", "us/fire"))
+    for result in results:
+        print("%-8s %12.1f" % (result["sensor"],
+                               result["seconds_per_fire"] * 1e6))
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,192 @@
+"""A minimal in-process MQTT broker stand-in.
+
+The broker speaks just enough of MQTT 3.1.1 for the loop to connect,
+publish at any QoS, subscribe, and keep the connection alive.  It accepts
+every client, runs on its own thread, and counts what it receives, so that
+benchmarks can drive a real Loop without any external infrastructure.  It is
+not a conforming broker: there are no sessions, no retained messages, and
+subscribers receive everything at QoS 0.
+"""
+
+import selectors
+import socket
+import struct
+import threading
+from typing import Dict, List, Tuple
+
+# MQTT control packet types
+_CONNECT = 1
+_PUBLISH = 3
+_SUBSCRIBE = 8
+_PINGREQ = 12
+_DISCONNECT = 14
+
+
+def _decode_length(buf: bytes, pos: int) -> Tuple[int, int]:
+    # Decode a remaining-length field; returns (-1, pos) if incomplete
+    mult, value = 1, 0
+    while True:
+        if pos >= len(buf):
+            return -1, pos
+        byte = buf[pos]
+        pos += 1
+        value += (byte & 0x7f) * mult
+        if not byte & 0x80:
+            return value, pos
+        mult *= 128
+
+
+def _encode_length(length: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        out.append(byte)
+        if not length:
+            return bytes(out)
+
+
+def _match(sub: str, topic: str) -> bool:
+    sparts = sub.split("/")
+    tparts = topic.split("/")
+    for i, part in enumerate(sparts):
+        if part == "#":
+            return True
+        if i >= len(tparts) or (part != "+" and part != tparts[i]):
+            return False
+    return len(sparts) == len(tparts)
+
+
+class Broker:
+    """A broker stand-in listening on a local TCP port.
+
+    Use start() to begin serving and stop() to shut down; address is the
+    (host, port) tuple to give to Configuration.broker.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 keep: bool = False):
+        """Create a broker listening on host and port (0 for any free port).
+
+        If keep is True, every message received is kept in messages.
+        """
+        self._listen = socket.socket()
+        self._listen.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listen.bind((host, port))
+        self._listen.listen()
+        self._listen.setblocking(False)
+        self.address: Tuple[str, int] = self._listen.getsockname()
+        self.keep = keep
+        self.messages: List[Tuple[str, bytes]] = []
+        """The (topic, payload) pairs received, if keep is set."""
+        self.count = 0
+        """The number of messages received."""
+        self.bytes = 0
+        """The number of payload bytes received."""
+
+        self._sel = selectors.DefaultSelector()
+        self._sel.register(self._listen, selectors.EVENT_READ)
+        self._bufs: Dict[socket.socket, bytes] = {}
+        self._subs: Dict[socket.socket, List[str]] = {}
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> 'Broker':
+        """Start serving on a background thread."""
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop serving and close every connection."""
+        self._stop = True
+        self._thread.join()
+        for sock in list(self._bufs):
+            sock.close()
+        self._listen.close()
+
+    def drop_clients(self) -> None:
+        """Close every client connection, as a broker restart would."""
+        for sock in list(self._bufs):
+            self._close(sock)
+
+    def _close(self, sock: socket.socket) -> None:
+        self._sel.unregister(sock)
+        self._bufs.pop(sock, None)
+        self._subs.pop(sock, None)
+        sock.close()
+
+    def _run(self) -> None:
+        while not self._stop:
+            for key, _ in self._sel.select(0.1):
+                sock = key.fileobj
+                if sock is self._listen:
+                    conn, _ = self._listen.accept()
+                    conn.setblocking(True)
+                    self._sel.register(conn, selectors.EVENT_READ)
+                    self._bufs[conn] = b""
+                    continue
+                try:
+                    data = sock.recv(65536)
+                except OSError:
+                    data = b""
+                if not data:
+                    self._close(sock)
+                    continue
+                self._bufs[sock] += data
+                self._parse(sock)
+
+    def _parse(self, sock: socket.socket) -> None:
+        buf = self._bufs[sock]
+        while len(buf) >= 2:
+            length, pos = _decode_length(buf, 1)
+            if length < 0 or len(buf) < pos + length:
+                break
+            ptype = buf[0] >> 4
+            flags = buf[0] & 0x0f
+            body = buf[pos:pos + length]
+            buf = buf[pos + length:]
+            if ptype == _CONNECT:
+                sock.sendall(b"\x20\x02\x00\x00")
+            elif ptype == _PUBLISH:
+                self._publish(sock, flags, body)
+            elif ptype == _SUBSCRIBE:
+                self._subscribe(sock, body)
+            elif ptype == _PINGREQ:
+                sock.sendall(b"\xd0\x00")
+            elif ptype == _DISCONNECT:
+                self._close(sock)
+                return
+        self._bufs[sock] = buf
+
+    def _publish(self, sock: socket.socket, flags: int, body: bytes) -> None:
+        tlen = struct.unpack(">H", body[:2])[0]
+        topic = body[2:2 + tlen].decode()
+        payload = body[2 + tlen:]
+        qos = (flags >> 1) & 3
+        if qos:
+            mid = payload[:2]
+            payload = payload[2:]
+            # PUBACK; QoS 2 is acknowledged as if it were QoS 1
+            sock.sendall(b"\x40\x02" + mid)
+        self.count += 1
+        self.bytes += len(payload)
+        if self.keep:
+            self.messages.append((topic, payload))
+        for other, subs in self._subs.items():
+            if any(_match(sub, topic) for sub in subs):
+                packet = struct.pack(">H", tlen) + body[2:2 + tlen] + payload
+                other.sendall(b"\x30" + _encode_length(len(packet)) + packet)
+
+    def _subscribe(self, sock: socket.socket, body: bytes) -> None:
+        mid = body[:2]
+        pos = 2
+        granted = b""
+        while pos < len(body):
+            tlen = struct.unpack(">H", body[pos:pos + 2])[0]
+            self._subs.setdefault(sock, []).append(
+                body[pos + 2:pos + 2 + tlen].decode())
+            pos += 2 + tlen + 1
+            granted += b"\x00"
+        sock.sendall(b"\x90" + _encode_length(2 + len(granted)) + mid + granted)
@@ -0,0 +1,91 @@
+"""Check that every loop runs on every scheduler backend.
+
+Each combination of Loop or AsyncLoop with each scheduler runs a few
+repeating synthetic sensors on the in-memory transport for a short while,
+and must fire and publish every sensor and then stop.  Exits non-zero if any
+combination fails.
+"""
+
+import argparse
+import json
+import sys
+import time
+import traceback
+from typing import Any, Dict, List
+
+from hasensor.asyncloop import AsyncLoop
+from hasensor.configuration import Configuration
+from hasensor.event import Event
+from hasensor.loop import Loop
+from hasensor.scheduler import create_scheduler
+from hasensor.transport import MemoryTransport
+
+from .synthetic import SyntheticSensor
+
+_SCHEDULERS = ("heap", "wheel")
+
+
+def _check(loop_type: type, scheduler: str,
+           duration: float) -> Dict[str, Any]:
+    conf = Configuration()
+    conf.transport = "memory"
+    conf.scheduler = scheduler
+    loop = loop_type(conf)
+    topics = set()
+    assert isinstance(loop.transport, MemoryTransport)
+    loop.transport.subscribe(lambda message: topics.add(message[0]))
+
+    sensors = []
+    start = time.time()
+    for i in range(4):
+        sensor = SyntheticSensor(name="check%d" % i, period=0.1,
+                                 start=start + 0.02 * i)
+        sensor.set_loop(loop)
+        loop.schedule(sensor.event())
+        sensors.append(sensor)
+    loop.schedule(Event(start + duration, lambda data: loop.stop()))
+
+    error = None
+    try:
+        loop.loop()
+    except Exception:            # pylint: disable=broad-except
+        error = traceback.format_exc(limit=3)
+    missing = [sensor.name for sensor in sensors
+               if not sensor.fires or sensor.topic not in topics]
+    if error is None and missing:
+        error = "sensors never fired or published: %s" % ", ".join(missing)
+    return {"loop": loop_type.__name__, "scheduler": scheduler,
+            "fires": sum(sensor.fires for sensor in sensors),
+            "ok": error is None, "error": error}
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--duration", type=float, default=0.5,
+                        help="Length of each run (seconds)")
+    parser.add_argument("--json", action="store_true",
+                        help="Emit machine-readable results")
+    args = parser.parse_args()
+
+    for scheduler in _SCHEDULERS:
+        # Fail early if a backend cannot even be created
+        create_scheduler(scheduler)
+    results: List[Dict[str, Any]] = [
+        _check(loop_type, scheduler, args.duration)
+        for loop_type in (Loop, AsyncLoop) for scheduler in _SCHEDULERS]
+
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for result in results:
+            print("%-10s %-6s %5d fires  %s"
+                  % (result["loop"], result["scheduler"], result["fires"],
+                     "ok" if result["ok"] else "FAILED"))
+            if result["error"]:
+                print(result["error"])
+    if not all(result["ok"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,40 @@
+"""Synthetic sensors for benchmarking.
+
+A SyntheticSensor spends a configurable amount of CPU time per reading and
+publishes a payload of a configurable size, so that the loop can be exercised
+without hardware.  It also records how late each of its readings was.
+"""
+
+import time
+from typing import List
+
+from hasensor.sensor import ArgDict, Sensor
+
+
+def _spin(seconds: float) -> None:
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+class SyntheticSensor(Sensor):
+    _argtypes: ArgDict = {
+        'cost': float,
+        'size': int,
+    }
+
+    def __init__(self, cost: float = 0.0, size: int = 16, **kwargs):
+        """Create a sensor costing cost CPU seconds and size bytes per read."""
+        super().__init__(**kwargs)
+        self.cost = cost
+        self.payload = "x" * size
+        self.fires = 0
+        self.lateness: List[float] = []
+        """The lateness of each reading (seconds)."""
+
+    def fire(self) -> None:
+        self.fires += 1
+        self.lateness.append(self.event().lateness.last)
+        if self.cost:
+            _spin(self.cost)
+        self.publish(self.payload)
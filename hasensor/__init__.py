@@ -6,4 +6,5 @@ __copyright__ = "Copyright 2020 Ethan Blanton"
 __version__ = "0.0.1"
 __license__ = "BSD-2-Clause"
 
-__all__ = ["configuration", "event", "loop", "registry", "sensor"]
+__all__ = ["asyncloop", "configuration", "event", "loop", "registry", "sensor",
+           "transport"]
@@ -0,0 +1,179 @@
+"""Windowed aggregation of sensor readings.
+
+A sensor that samples faster than it should publish can pass its readings
+through an Aggregator, which accumulates them over a window and produces one
+summary per window.  Readings are JSON: either a bare number, or an object
+whose numeric fields are each summarized separately.  Samples are held in
+array-backed buffers of doubles, which are reused from window to window.
+
+A summary of a bare number is an object of the requested aggregates, such as
+{"min": 1.0, "max": 3.0, "mean": 2.0, "samples": 3}.  A summary of an object
+replaces each numeric field with such an object (without the sample count,
+which appears once at the top level), and keeps the latest value of every
+other field.
+
+A window ends window seconds after the reading that opened it, and is closed
+with close() when it ends, so that its summary is not held back until the
+next reading.  A window without readings has no summary; the next window then
+opens with the next reading.
+"""
+
+import json
+import math
+import threading
+from array import array
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from .outbound import Payload
+
+AggregateFunc = Callable[[Sequence[float]], float]
+
+
+def _percentile(pct: float) -> AggregateFunc:
+    def aggregate(values: Sequence[float]) -> float:
+        # Nearest rank
+        ordered = sorted(values)
+        rank = math.ceil(pct / 100.0 * len(ordered)) - 1
+        return ordered[min(max(rank, 0), len(ordered) - 1)]
+    return aggregate
+
+
+_AGGREGATES: Dict[str, AggregateFunc] = {
+    "min": min,
+    "max": max,
+    "mean": lambda values: sum(values) / len(values),
+    "last": lambda values: values[-1],
+}
+
+
+def aggregate_function(name: str) -> AggregateFunc:
+    """Return the aggregate function with the given name.
+
+    The names are min, max, mean, last, and pNN for the NNth percentile.
+    """
+    if name in _AGGREGATES:
+        return _AGGREGATES[name]
+    if name.startswith("p"):
+        try:
+            pct = float(name[1:])
+        except ValueError:
+            pct = -1.0
+        if 0.0 <= pct <= 100.0:
+            return _percentile(pct)
+    raise Exception("unknown aggregate %s" % name)
+
+
+def agg_parser(arg: str) -> List[str]:
+    """Parse a comma-separated list of aggregate names."""
+    names = arg.split(",")
+    for name in names:
+        aggregate_function(name)
+    return names
+
+
+class Aggregator:
+    """Accumulate readings over a window and summarize them.
+
+    Readings may be added from any thread.
+    """
+
+    def __init__(self, window: float, aggregates: Sequence[str]):
+        """Create an aggregator of window seconds computing aggregates."""
+        self.window = window
+        self._aggregates = [(name, aggregate_function(name))
+                            for name in aggregates]
+        self._lock = threading.Lock()
+        self._end: Optional[float] = None
+        self._samples = 0
+        self._values: Dict[Optional[str], array] = {}
+        self._latest: Dict[str, Any] = {}
+        self._shape: Optional[bool] = None
+
+    def _summarize(self, values: array) -> Dict[str, float]:
+        return {name: round(func(values), 6)
+                for name, func in self._aggregates}
+
+    def _flush(self) -> Payload:
+        if self._shape:
+            summary: Dict[str, Any] = dict(self._latest)
+            for field, values in self._values.items():
+                if values:
+                    summary[field] = self._summarize(values)
+        else:
+            values = self._values.get(None)
+            summary = self._summarize(values) if values else {}
+        summary["samples"] = self._samples
+
+        self._samples = 0
+        for values in self._values.values():
+            del values[:]
+        self._latest.clear()
+        return json.dumps(summary)
+
+    def _buffer(self, field: Optional[str]) -> array:
+        values = self._values.get(field)
+        if values is None:
+            values = self._values[field] = array("d")
+        return values
+
+    def _advance(self, now: float) -> None:
+        # Start the window after the current one
+        self._end += self.window
+        # Keep windows aligned unless samples stopped for a while
+        if self._end <= now:
+            self._end = now + self.window
+
+    def window_end(self) -> Optional[float]:
+        """Return the monotonic time the open window ends, or None if none."""
+        with self._lock:
+            return self._end
+
+    def close(self, now: float) -> Optional[Payload]:
+        """Close the open window if it has ended by monotonic time now.
+
+        Returns the window's summary, or None if it has not ended or had no
+        readings.
+        """
+        with self._lock:
+            if self._end is None or now < self._end:
+                return None
+            if not self._samples:
+                self._end = None
+                return None
+            summary = self._flush()
+            self._advance(now)
+            return summary
+
+    def add(self, data: Payload, now: float) -> Optional[Payload]:
+        """Add a reading taken at monotonic time now.
+
+        Returns the summary of the window if this reading completed it, or
+        None.  A reading completes a window if it arrives after the window's
+        end; it then starts the next window.
+        """
+        try:
+            reading = json.loads(data)
+        except ValueError:
+            reading = data
+        with self._lock:
+            summary = None
+            if self._end is None:
+                self._end = now + self.window
+            elif now >= self._end:
+                summary = self._flush()
+                self._advance(now)
+
+            self._samples += 1
+            if isinstance(reading, dict):
+                self._shape = True
+                for field, value in reading.items():
+                    if isinstance(value, (int, float)) \
+                            and not isinstance(value, bool):
+                        self._buffer(field).append(value)
+                    else:
+                        self._latest[field] = value
+            elif isinstance(reading, (int, float)) \
+                    and not isinstance(reading, bool):
+                self._shape = False
+                self._buffer(None).append(reading)
+            return summary
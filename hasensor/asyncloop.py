@@ -0,0 +1,250 @@
+"""An asyncio-based main loop for a sensor node.
+
+AsyncLoop is a drop-in alternative to Loop that runs on an asyncio event
+loop.  The transport's socket, if it has one, is watched with add_reader()/add_writer()
+rather than polled, and every scheduled event is an asyncio timer, so the loop
+only wakes when there is something to do.  Sensors may define fire() as a
+coroutine, letting them await subprocesses and delays instead of blocking the
+loop or owning a thread.
+"""
+
+import asyncio
+import inspect
+import threading
+import time
+from typing import Any, Callable, Optional, Set, TYPE_CHECKING
+
+from .configuration import Configuration
+from .loop import Loop
+
+if TYPE_CHECKING:
+    from .event import Event
+
+# The interval at which the transport's keepalive and retry logic must be
+# serviced
+_MISC_INTERVAL = 1.0
+
+
+class AsyncLoop(Loop):
+    """The main event loop, running on asyncio.
+
+    The Event and Sensor interfaces are the same as for Loop; events may be
+    scheduled before or after the loop is started.
+    """
+
+    def __init__(self, conf: Configuration):
+        self._aloop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread_id = 0
+        self._timers = 0
+        self._tasks: Set[asyncio.Task] = set()
+        self._done: Optional[asyncio.Future] = None
+        self._flush_handle: Optional[asyncio.Handle] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        super().__init__(conf)
+
+        transport = self.transport
+        transport.on_socket_open = lambda sock: self._call(self._watch, sock)
+        transport.on_socket_close = lambda sock: self._call(self._unwatch,
+                                                            sock)
+        transport.on_socket_register_write = \
+            lambda sock: self._call(self._watch_write, sock)
+        transport.on_socket_unregister_write = \
+            lambda sock: self._call(self._unwatch_write, sock)
+
+    def _call(self, func: Callable[..., Any], *args: Any) -> None:
+        # Run func on the asyncio loop, which paho callbacks and publishers
+        # may not be on
+        if self._aloop is None:
+            return
+        if threading.get_ident() == self._thread_id:
+            func(*args)
+        else:
+            self._aloop.call_soon_threadsafe(func, *args)
+
+    def _watch(self, sock: Any) -> None:
+        self._aloop.add_reader(sock, self.transport.loop_read)
+
+    def _watch_write(self, sock: Any) -> None:
+        self._aloop.add_writer(sock, self.transport.loop_write)
+
+    def _unwatch_write(self, sock: Any) -> None:
+        self._aloop.remove_writer(sock)
+
+    def _unwatch(self, sock: Any) -> None:
+        self._aloop.remove_reader(sock)
+        self._aloop.remove_writer(sock)
+
+    def add_reader(self, fd: int, callback: Callable[[], None]) -> None:
+        super().add_reader(fd, callback)
+        if self._aloop is not None:
+            self._aloop.add_reader(fd, callback)
+
+    def remove_reader(self, fd: int) -> None:
+        super().remove_reader(fd)
+        if self._aloop is not None:
+            self._aloop.remove_reader(fd)
+
+    def _on_connect_cb(self, result: int) -> None:
+        super()._on_connect_cb(result)
+        self._call(self._kick)
+
+    def _on_disconnect_cb(self, result: int) -> None:
+        super()._on_disconnect_cb(result)
+        self._call(self._kick)
+
+    def _kick(self) -> None:
+        # Run housekeeping now, as the connection state has changed
+        self._wakeup.set()
+
+    def post(self, callback: Callable[..., None], *args: Any) -> None:
+        self._posted.append((callback, args))
+        aloop = self._aloop
+        if aloop is None:
+            return
+        # As for Loop, every post from another thread schedules a drain
+        if threading.get_ident() != self._thread_id:
+            aloop.call_soon_threadsafe(self._run_posted)
+        elif len(self._posted) == 1:
+            aloop.call_soon(self._run_posted)
+
+    def submit(self, name: str, fire: Callable[[], None], deadline: float,
+               limit: int = 1) -> bool:
+        started = super().submit(name, fire, deadline, limit)
+        if started:
+            # Have housekeeping wake at the read's deadline
+            self._call(self._kick)
+        return started
+
+    def _queued(self) -> None:
+        self._call(self._flush_at, 0.0)
+
+    def _flush_at(self, when: float) -> None:
+        # Arrange for the outbound queue to be flushed no later than when
+        if self._flush_handle is not None:
+            if self._flush_handle.when() <= when:
+                return
+            self._flush_handle.cancel()
+        self._flush_handle = self._aloop.call_at(when, self._flush)
+
+    def _flush(self) -> None:
+        self._flush_handle = None
+        now = time.monotonic()
+        self.outbound.flush(now, self._deliver)
+        due = self.outbound.next_due()
+        if due is not None:
+            self._flush_at(self._aloop.time() + due - now)
+
+    def schedule(self, event: 'Event') -> None:
+        """Add an event to the loop's schedule."""
+        if self._aloop is None:
+            super().schedule(event)
+            return
+        self._track(event)
+        delay = event.next_fire - time.monotonic()
+        self._timers += 1
+        self._aloop.call_at(self._aloop.time() + delay, self._run, event)
+
+    def _run(self, event: 'Event') -> None:
+        self._timers -= 1
+        if self.metrics is not None:
+            self.metrics.wakeups += 1
+        try:
+            self._process(event)
+        except Exception as error:      # pylint: disable=broad-except
+            # Stop the loop, as an exception from Loop.loop() would
+            if not self._done.done():
+                self._done.set_exception(error)
+            return
+        self._check_done()
+
+    def _process(self, event: 'Event') -> None:
+        if event.cancelled:
+            return
+        result = self._fire(event)
+        if inspect.isawaitable(result):
+            task = asyncio.ensure_future(result)
+            self._tasks.add(task)
+            task.add_done_callback(self._task_done)
+        if event.repeats:
+            self.schedule(event)
+
+    def _task_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            if not self._done.done():
+                self._done.set_exception(task.exception())
+            return
+        self._check_done()
+
+    def stop(self) -> None:
+        """Stop the loop once the current callback returns.
+
+        This method may be called from any thread, or from an event.
+        """
+        self._call(self._stop)
+
+    def _stop(self) -> None:
+        if not self._done.done():
+            self._done.set_result(None)
+
+    def _check_done(self) -> None:
+        if not self._timers and not self._tasks and not self._done.done():
+            self._done.set_result(None)
+
+    async def _housekeeping(self) -> None:
+        while True:
+            now = time.monotonic()
+            if self.metrics is not None:
+                self.metrics.wakeups += 1
+            self._service(now)
+            self._flush_at(0.0)
+            if self.connected:
+                self.transport.loop_misc()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),
+                                       self._service_time(now, _MISC_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def run(self) -> None:
+        """Run the scheduled events until none remain."""
+        self._aloop = asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+        self._done = self._aloop.create_future()
+        self._wakeup = asyncio.Event()
+
+        sock = self.transport.socket()
+        if sock is not None:
+            self._watch(sock)
+            if self.transport.want_write():
+                self._watch_write(sock)
+
+        for fd, callback in self._readers.items():
+            self._aloop.add_reader(fd, callback)
+        if self._posted:
+            self._aloop.call_soon(self._run_posted)
+        for event in self._scheduler.drain():
+            self.schedule(event)
+        housekeeping = asyncio.ensure_future(self._housekeeping())
+        try:
+            if self._timers:
+                await self._done
+        finally:
+            housekeeping.cancel()
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+                self._flush_handle = None
+            sock = self.transport.socket()
+            if sock is not None:
+                self._unwatch(sock)
+            for fd in self._readers:
+                self._aloop.remove_reader(fd)
+            self._aloop = None
+            if self.store is not None:
+                self.store.flush()
+
+    def loop(self) -> None:
+        """Loop forever, running the scheduled events."""
+        asyncio.run(self.run())
+
@@ -0,0 +1,34 @@
+"""Exponential backoff with jitter.
+
+Used wherever the sensor node must retry an operation against something that
+may be down for a while, such as the MQTT broker.
+"""
+
+import random
+
+
+class Backoff:
+    """An exponential backoff schedule with jitter.
+
+    Each call to delay() returns the next delay and doubles the base delay,
+    up to a cap; reset() returns to the initial delay after a success.  Half
+    of each delay is randomized so that many nodes restarted together do not
+    retry in lockstep.
+    """
+
+    def __init__(self, initial: float = 1.0, maximum: float = 300.0,
+                 factor: float = 2.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self._base = initial
+
+    def delay(self) -> float:
+        """Return the next delay, in seconds, and advance the schedule."""
+        base = self._base
+        self._base = min(base * self.factor, self.maximum)
+        return base / 2 + random.uniform(0, base / 2)
+
+    def reset(self) -> None:
+        """Return to the initial delay."""
+        self._base = self.initial
@@ -3,13 +3,27 @@
 This file encapsulates the configuration state needed for an entire sensor
 node, from the information required to connect to the MQTT broker to the topic
 prefix used by the node to the description of its sensors.
+
+A configuration may also be read from a file, with --config.  Each line of a
+configuration file holds one command line option without its leading dashes,
+optionally followed by = and its value; blank lines and lines starting with #
+are ignored.  Options given on the command line override those in the file,
+except that sensors from both are used.  For example:
+
+    # Garage sensor node
+    broker = mqtt.local:1883
+    prefix = house/garage
+    discoverable
+    sensor = system:name=system:period=60
+    sensor = bme280:name=climate:period=30
 """
 
 import argparse
 import socket
+import sys
 
 from dataclasses import dataclass
-from typing import Tuple, List
+from typing import List, Optional, Tuple
 
 
 def _parse_broker(broker: str) -> Tuple[str, int]:
@@ -49,7 +63,23 @@ class Configuration:
     DEF_MQTT_PREFIX = DEF_MQTT_CLIENT_ID        # type: str
     DEF_DISC_PREFIX = "homeassistant"           # type: str
     DEF_DISC_NODE = _hostname                   # type: str
-    DEF_DISC_INTERVAL = 60*60                   # type: int
+    DEF_DISC_INTERVAL = 0                       # type: int
+    DEF_SCHEDULER = "heap"                      # type: str
+    DEF_RECONNECT_MIN = 1.0                     # type: float
+    DEF_RECONNECT_MAX = 300.0                   # type: float
+    DEF_SPOOL_SIZE = 1 << 20                    # type: int
+    DEF_SPOOL_POLICY = "oldest"                 # type: str
+    DEF_SPOOL_RATE = 50.0                       # type: float
+    DEF_WORKERS = 2                             # type: int
+    DEF_COALESCE_WINDOW = 0.0                   # type: float
+    DEF_MAX_INFLIGHT = 20                       # type: int
+    DEF_STATS_INTERVAL = 0.0                    # type: float
+    DEF_STATS_FILE_INTERVAL = 60.0              # type: float
+    DEF_TRANSPORT = "mqtt"                      # type: str
+    DEF_CONFIG_POLL = 2.0                       # type: float
+    DEF_HISTORY_SIZE = 0                        # type: int
+    DEF_STORE_SIZE = 64 << 20                   # type: int
+    DEF_STORE_SYNC = 10.0                       # type: float
 
     broker: Tuple[str, int]
     """The MQTT broker (hostname, port) tuple"""
@@ -64,12 +94,59 @@ class Configuration:
     discovery_node: str
     """The discovery node ID"""
     discovery_interval: int
-    """The interval at which repeated discovery messages should be sent.
+    """The interval at which discovery messages are re-sent, if at all.
 
-    A value of 0 will send only one discovery message at sensor startup,
-    providing that discovery is enabled.
+    Discovery messages are retained, and re-sent whenever Home Assistant
+    announces that it has started and when the sensors change, so the
+    default of 0 sends no others.
     """
     sensors: List[str]
+    nodes: List[str]
+    """Configuration files of the logical nodes hosted by this gateway"""
+    scheduler: str
+    """The scheduler backend used by the loop ("heap" or "wheel")"""
+    reconnect_min: float
+    """The initial delay between broker connection attempts (seconds)"""
+    reconnect_max: float
+    """The maximum delay between broker connection attempts (seconds)"""
+    spool: Optional[str]
+    """The file used to hold messages published while disconnected, if any"""
+    spool_size: int
+    """The capacity of the spool (bytes)"""
+    spool_policy: str
+    """What to drop when the spool is full ("oldest", "newest", "coalesce")"""
+    spool_rate: float
+    """The rate at which spooled messages are sent on reconnection (messages/s)"""
+    workers: int
+    """The number of worker threads for sensors read off the loop"""
+    use_asyncio: bool
+    """Whether to run the node on the asyncio-based loop"""
+    coalesce_window: float
+    """How long outgoing messages wait to be superseded on their topic (seconds)"""
+    max_inflight: int
+    """The maximum number of QoS 1 and 2 messages awaiting acknowledgement"""
+    stats_interval: float
+    """The interval at which runtime metrics are published (seconds; 0 is off)"""
+    stats_file: Optional[str]
+    """A Prometheus textfile to which runtime metrics are written, if any"""
+    transport: str
+    """How messages leave the node ("mqtt", "memory", "unix", or "file")"""
+    transport_path: Optional[str]
+    """The socket or file path for the unix and file transports"""
+    startup_report: bool
+    """Whether to report the time taken to import and create each sensor"""
+    config: Optional[str]
+    """The configuration file, if any"""
+    config_poll: float
+    """The interval at which the configuration file is checked for changes"""
+    history_size: int
+    """The memory kept for recent readings of this node's sensors (bytes)"""
+    store: Optional[str]
+    """The directory in which every reading is stored, if any"""
+    store_size: int
+    """The space the store may take, beyond which old readings are dropped"""
+    store_sync: float
+    """The interval at which stored readings are written and fsynced"""
 
     def __init__(self):
         self.broker = ("localhost", 1883)
@@ -80,10 +157,40 @@ class Configuration:
         self.discovery_node = Configuration.DEF_DISC_NODE
         self.discovery_interval = Configuration.DEF_DISC_INTERVAL
         self.sensors = []
+        self.nodes = []
+        self.scheduler = Configuration.DEF_SCHEDULER
+        self.reconnect_min = Configuration.DEF_RECONNECT_MIN
+        self.reconnect_max = Configuration.DEF_RECONNECT_MAX
+        self.spool = None
+        self.spool_size = Configuration.DEF_SPOOL_SIZE
+        self.spool_policy = Configuration.DEF_SPOOL_POLICY
+        self.spool_rate = Configuration.DEF_SPOOL_RATE
+        self.workers = Configuration.DEF_WORKERS
+        self.use_asyncio = False
+        self.coalesce_window = Configuration.DEF_COALESCE_WINDOW
+        self.max_inflight = Configuration.DEF_MAX_INFLIGHT
+        self.stats_interval = Configuration.DEF_STATS_INTERVAL
+        self.stats_file = None
+        self.transport = Configuration.DEF_TRANSPORT
+        self.transport_path = None
+        self.startup_report = False
+        self.config = None
+        self.config_poll = Configuration.DEF_CONFIG_POLL
+        self.history_size = Configuration.DEF_HISTORY_SIZE
+        self.store = None
+        self.store_size = Configuration.DEF_STORE_SIZE
+        self.store_sync = Configuration.DEF_STORE_SYNC
+        self._argv: List[str] = []
+        self._filename: Optional[str] = None
 
     @classmethod
     def _parser(cls) -> argparse.ArgumentParser:
         parser = argparse.ArgumentParser(description="Multi-sensor sensor node.")
+        parser.add_argument("--config", "-f", type=str,
+                            help="Read options from this file, reloading it when it changes or on SIGHUP")
+        parser.add_argument("--config-poll", type=float,
+                            default=Configuration.DEF_CONFIG_POLL,
+                            help="Interval for checking the configuration file for changes (seconds; suppress if 0)")
         parser.add_argument("--broker", "-b", default="localhost",
                             type=_parse_broker,
                             help="MQTT broker (host[:port])")
@@ -100,26 +207,94 @@ class Configuration:
                             help="MQTT prefix to use for discovery")
         parser.add_argument("--discovery-interval", type=int,
                             default=Configuration.DEF_DISC_INTERVAL,
-                            help="Interval for discovery re-broadcast (seconds; suppress if 0)")
+                            help="Interval for periodic discovery re-broadcast (seconds; suppress if 0)")
         parser.add_argument("--discovery-node", type=str,
                             default=Configuration.DEF_DISC_NODE,
                             help="Node ID for discovery (omitted if none)")
         parser.add_argument("--sensor", "-s", type=str, action="append",
                             help="Add a sensor description string to the current configuration")
+        parser.add_argument("--node", "-n", type=str, action="append",
+                            help="Host the logical node configured by this file over this node's connection")
+        parser.add_argument("--scheduler", type=str,
+                            choices=["heap", "wheel"],
+                            default=Configuration.DEF_SCHEDULER,
+                            help="Event scheduler (heap, the default and faster, or a timing wheel)")
+        parser.add_argument("--transport", type=str,
+                            choices=["mqtt", "memory", "unix", "file"],
+                            default=Configuration.DEF_TRANSPORT,
+                            help="Message transport (mqtt for a broker, or a local sink)")
+        parser.add_argument("--transport-path", type=str,
+                            help="Datagram socket path for the unix transport, or file for the file transport")
+        parser.add_argument("--startup-report", action="store_true",
+                            help="Report sensor import and creation times on startup")
+        parser.add_argument("--reconnect-min", type=float,
+                            default=Configuration.DEF_RECONNECT_MIN,
+                            help="Initial broker reconnection delay (seconds)")
+        parser.add_argument("--reconnect-max", type=float,
+                            default=Configuration.DEF_RECONNECT_MAX,
+                            help="Maximum broker reconnection delay (seconds)")
+        parser.add_argument("--spool", type=str,
+                            help="Spool file for messages published while disconnected")
+        parser.add_argument("--spool-size", type=int,
+                            default=Configuration.DEF_SPOOL_SIZE,
+                            help="Spool capacity (bytes)")
+        parser.add_argument("--spool-policy", type=str,
+                            choices=["oldest", "newest", "coalesce"],
+                            default=Configuration.DEF_SPOOL_POLICY,
+                            help="Messages to drop when the spool is full")
+        parser.add_argument("--spool-rate", type=float,
+                            default=Configuration.DEF_SPOOL_RATE,
+                            help="Spool drain rate on reconnection (messages/s)")
+        parser.add_argument("--workers", type=int,
+                            default=Configuration.DEF_WORKERS,
+                            help="Worker threads for threaded sensor reads")
+        parser.add_argument("--asyncio", action="store_true",
+                            help="Run on asyncio (required for coroutine sensors)")
+        parser.add_argument("--coalesce-window", type=float,
+                            default=Configuration.DEF_COALESCE_WINDOW,
+                            help="Time for outgoing messages to be replaced by newer ones on their topic (seconds)")
+        parser.add_argument("--max-inflight", type=int,
+                            default=Configuration.DEF_MAX_INFLIGHT,
+                            help="Maximum unacknowledged QoS 1/2 messages")
+        parser.add_argument("--stats-interval", type=float,
+                            default=Configuration.DEF_STATS_INTERVAL,
+                            help="Interval for publishing runtime metrics to <prefix>/stats (seconds; suppress if 0)")
+        parser.add_argument("--stats-file", type=str,
+                            help="Also write runtime metrics to this Prometheus textfile")
+        parser.add_argument("--history-size", type=int,
+                            default=Configuration.DEF_HISTORY_SIZE,
+                            help="Memory for recent readings, queried on <prefix>/history/request (bytes; suppress if 0)")
+        parser.add_argument("--store", type=str,
+                            help="Directory in which to keep every reading, with minute and hour rollups")
+        parser.add_argument("--store-size", type=int,
+                            default=Configuration.DEF_STORE_SIZE,
+                            help="Store capacity, beyond which the oldest readings are deleted (bytes)")
+        parser.add_argument("--store-sync", type=float,
+                            default=Configuration.DEF_STORE_SYNC,
+                            help="Interval for writing and fsyncing stored readings (seconds)")
         return parser
 
-    def parse_args(self, filename: str = None) -> None:
+    def parse_args(self, filename: str = None,
+                   argv: Optional[List[str]] = None) -> None:
         """Parse the command line arguments.
 
         The contents of the command line arguments will be used to configure
-        the event loop, MQTT broker, and sensors.
+        the event loop, MQTT broker, and sensors.  If filename is given, the
+        options are read from that file rather than the command line; argv
+        replaces the command line itself.
         """
         parser = Configuration._parser()
-        args = None
+        self._filename = filename
         if filename is not None:
-            raise Exception("File parser not yet implemented")
-        else:
-            args = parser.parse_args()
+            argv = _read_config(filename)
+        elif argv is None:
+            argv = sys.argv[1:]
+        self._argv = argv
+        args = parser.parse_args(argv)
+        if args.config:
+            args = parser.parse_args(_read_config(args.config) + argv)
+            self.config = args.config
+        self.config_poll = args.config_poll
 
         if args.discoverable:
             self.discoverable = args.discoverable
@@ -131,7 +306,92 @@ class Configuration:
             self.prefix = args.prefix
         if args.discovery_prefix:
             self.discovery_prefix = args.discovery_prefix
+        if args.discovery_node:
+            self.discovery_node = args.discovery_node
         if args.discovery_interval:
             self.discovery_interval = args.discovery_interval
         if args.sensor:
             self.sensors = args.sensor
+        if args.node:
+            self.nodes = args.node
+        if args.scheduler:
+            self.scheduler = args.scheduler
+        if args.transport:
+            self.transport = args.transport
+        if args.transport_path:
+            self.transport_path = args.transport_path
+        if args.startup_report:
+            self.startup_report = True
+        if args.reconnect_min:
+            self.reconnect_min = args.reconnect_min
+        if args.reconnect_max:
+            self.reconnect_max = args.reconnect_max
+        if args.spool:
+            self.spool = args.spool
+        if args.spool_size:
+            self.spool_size = args.spool_size
+        if args.spool_policy:
+            self.spool_policy = args.spool_policy
+        if args.spool_rate:
+            self.spool_rate = args.spool_rate
+        if args.workers:
+            self.workers = args.workers
+        if args.asyncio:
+            self.use_asyncio = args.asyncio
+        if args.coalesce_window:
+            self.coalesce_window = args.coalesce_window
+        if args.max_inflight:
+            self.max_inflight = args.max_inflight
+        if args.stats_interval:
+            self.stats_interval = args.stats_interval
+        if args.stats_file:
+            self.stats_file = args.stats_file
+            if not self.stats_interval:
+                self.stats_interval = Configuration.DEF_STATS_FILE_INTERVAL
+        if args.history_size:
+            self.history_size = args.history_size
+        if args.store:
+            self.store = args.store
+        if args.store_size:
+            self.store_size = args.store_size
+        if args.store_sync:
+            self.store_sync = args.store_sync
+
+    def availability_topic(self) -> Optional[str]:
+        """Return the topic announcing whether the node is online, if any.
+
+        The node publishes "online" there, retained, on connecting, and the
+        broker publishes "offline" as its last will.  Only discoverable nodes
+        and gateways, whose nodes share their connection, have one.
+        """
+        if not self.discoverable and not self.nodes:
+            return None
+        return self.prefix + "/availability"
+
+    def reloaded(self) -> 'Configuration':
+        """Return a new configuration, re-reading the configuration file.
+
+        The command line used for this configuration applies to the new one,
+        or the file it was read from is read again.
+        """
+        conf = Configuration()
+        if self._filename is not None:
+            conf.parse_args(filename=self._filename)
+        else:
+            conf.parse_args(argv=self._argv)
+        return conf
+
+
+def _read_config(filename: str) -> List[str]:
+    """Read a configuration file into a list of command line arguments."""
+    argv: List[str] = []
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            key, *value = line.split("=", 1)
+            argv.append("--" + key.strip())
+            if value:
+                argv.append(value[0].strip())
+    return argv
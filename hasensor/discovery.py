@@ -0,0 +1,171 @@
+"""Home Assistant MQTT discovery for a node's sensors.
+
+Each sensor is announced as one Home Assistant entity per numeric field of
+its readings (or, for a sensor without fields, one entity for its whole
+payload), along with the node's own Online entity.  The configuration
+payloads are built once per sensor and published retained, so Home Assistant
+finds them whenever it subscribes.  They are published again only when Home
+Assistant announces that it has (re)started, with "online" on
+<discovery_prefix>/status, and when the node's sensors change; entities of
+sensors that were removed are deleted.
+
+Every entity refers to the node's availability topic, on which the node
+publishes "online" when it connects and the broker publishes "offline", the
+node's last will, if the node disappears.
+"""
+
+import json
+import re
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from .configuration import Configuration
+from .event import RepeatingEvent
+from .loop import Loop
+from .sensor import Sensor
+from .sensorset import SensorSet
+
+# A discovery message: its topic and payload
+_Config = Tuple[str, str]
+
+_UNSAFE = re.compile(r"[^a-zA-Z0-9_-]")
+
+
+def _object_id(*parts: str) -> str:
+    return _UNSAFE.sub("_", "_".join(parts))
+
+
+def sensor_configs(sensor: Sensor, conf: Configuration,
+                   availability: Optional[str]) -> List[_Config]:
+    """Return the discovery messages announcing a sensor.
+
+    availability is the topic on which the sensor's node is reported
+    online, if any.
+    """
+    node = conf.discovery_node
+    common: Dict[str, Any] = {
+        "state_topic": sensor.topic,
+        "availability_topic": availability,
+        "device": {"identifiers": [node], "name": node},
+    }
+
+    configs: List[_Config] = []
+    # pylint: disable=protected-access
+    fields = sensor.discovery_fields()
+    if not fields:
+        if sensor._fields or sensor._component is None:
+            return []
+        object_id = _object_id(node, sensor.name)
+        config = dict(common, name=sensor.name, unique_id=object_id)
+        topic = "%s/%s/%s/config" % (conf.discovery_prefix,
+                                     sensor._component, object_id)
+        return [(topic, json.dumps(config, sort_keys=True))]
+
+    for field in fields:
+        object_id = _object_id(node, sensor.name, field.name)
+        if sensor.aggregates:
+            template = "{{ value_json.%s.%s }}" % (field.name,
+                                                   sensor.aggregates[0])
+        else:
+            template = "{{ value_json.%s }}" % field.name
+        config = dict(common, name="%s %s" % (sensor.name, field.name),
+                      unique_id=object_id, value_template=template)
+        if field.unit is not None:
+            config["unit_of_measurement"] = field.unit
+        if field.device_class is not None:
+            config["device_class"] = field.device_class
+        if field.state_class is not None:
+            config["state_class"] = field.state_class
+        topic = "%s/sensor/%s/config" % (conf.discovery_prefix, object_id)
+        configs.append((topic, json.dumps(config, sort_keys=True)))
+    return configs
+
+
+def _node_config(conf: Configuration,
+                 availability: Optional[str]) -> _Config:
+    topic = "%s/binary_sensor/%sOnline/config" % (conf.discovery_prefix,
+                                                  conf.discovery_node)
+    config = {"state_topic": "%s/state" % conf.prefix,
+              "name": "%s Online" % conf.discovery_node,
+              "availability_topic": availability}
+    return topic, json.dumps(config, sort_keys=True)
+
+
+class Discovery:
+    """Announce a node's sensors to Home Assistant.
+
+    The node's entities are available while the loop's availability topic
+    is online; a gateway's nodes share the gateway's connection, and so its
+    availability.
+    """
+
+    def __init__(self, loop: Loop, conf: Configuration, sensors: SensorSet):
+        self._loop = loop
+        self._conf = conf
+        self._sensors = sensors
+        self._availability = loop.availability
+        # The sensor each cached set of messages was built for, by name
+        self._cache: Dict[str, Tuple[Sensor, List[_Config]]] = {}
+        self._published: Dict[str, str] = {}
+        self.announcements = 0
+        """The number of times discovery messages were (re)published"""
+
+    def install(self) -> None:
+        """Publish discovery now, and again whenever it is needed."""
+        self._loop.subscribe("%s/status" % self._conf.discovery_prefix,
+                             self._status)
+        self._sensors.on_change = self.update
+        if self._conf.discovery_interval:
+            self._loop.schedule(RepeatingEvent(
+                time.time() + self._conf.discovery_interval,
+                self._conf.discovery_interval, _republish, self))
+        self.update()
+
+    def _status(self, payload: bytes) -> None:
+        # Home Assistant's birth message
+        if payload.strip() == b"online":
+            self.republish()
+
+    def _configs(self) -> Dict[str, str]:
+        configs = dict([_node_config(self._conf, self._availability)])
+        cache: Dict[str, Tuple[Sensor, List[_Config]]] = {}
+        for sensor in self._sensors.sensors():
+            cached = self._cache.get(sensor.name)
+            if cached is None or cached[0] is not sensor:
+                cached = (sensor, sensor_configs(sensor, self._conf,
+                                                  self._availability))
+            cache[sensor.name] = cached
+            configs.update(cached[1])
+        self._cache = cache
+        return configs
+
+    def _send(self, topic: str, payload: str) -> None:
+        self._loop.publish_raw(topic, payload, 1, True)
+
+    def update(self) -> None:
+        """Publish the messages for sensors that were added or changed.
+
+        Entities of sensors that were removed are deleted.
+        """
+        configs = self._configs()
+        for topic in self._published:
+            if topic not in configs:
+                # An empty retained message deletes the entity
+                self._send(topic, "")
+        for topic, payload in configs.items():
+            if self._published.get(topic) != payload:
+                self._send(topic, payload)
+        self._published = configs
+        self.announcements += 1
+
+    def republish(self) -> None:
+        """Publish every discovery message again."""
+        self._published = self._configs()
+        for topic, payload in self._published.items():
+            self._send(topic, payload)
+        self.announcements += 1
+
+
+def _republish(discovery: Optional[Discovery]) -> None:
+    if discovery is not None:
+        discovery.republish()
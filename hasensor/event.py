@@ -1,17 +1,59 @@
-"""Sensor node events."""
+"""Sensor node events.
+
+Events are scheduled on the time.monotonic() clock, so that steps in the wall
+clock (from NTP, or a suspended container) neither stall nor flood the loop.
+Times given to the Event constructors are wall-clock times (seconds since the
+Epoch), and are converted to the monotonic clock once, at construction.
+"""
 
 import time
 from functools import total_ordering
-from typing import Any, Callable, Optional
+from typing import Any, Callable, Optional, TYPE_CHECKING
 
-from .loop import Loop
+if TYPE_CHECKING:
+    from .loop import Loop
 
-EventCallback = Callable[[Optional[Any]], None]
+EventCallback = Callable[[Optional[Any]], Any]
 """The type for callbacks passed to the Event constructor."""
 
 NOW = 0                 # type: int
 """ The time Now can be used to schedule an event as soon as possible."""
 
+MISSED_POLICIES = ("skip", "once", "catchup")
+"""The policies for a repeating event that has missed whole periods.
+
+  - skip:    drop the late firing and wait for the next period
+  - once:    fire once for all the missed periods, then resume on period
+  - catchup: fire once for every missed period, back to back
+"""
+
+
+class Lateness:
+    """Lateness statistics for an event."""
+
+    __slots__ = ("fires", "missed", "last", "max", "total")
+
+    def __init__(self):
+        self.fires = 0
+        """The number of times the event was due"""
+        self.missed = 0
+        """The number of periods skipped or merged by the missed-tick policy"""
+        self.last = 0.0
+        self.max = 0.0
+        self.total = 0.0
+
+    def mean(self) -> float:
+        """Return the mean lateness, in seconds."""
+        return self.total / self.fires if self.fires else 0.0
+
+    def record(self, late: float) -> None:
+        """Record that the event was due late seconds ago."""
+        self.fires += 1
+        self.last = late
+        self.total += late
+        if late > self.max:
+            self.max = late
+
 
 @total_ordering
 class Event:
@@ -24,25 +66,35 @@ class Event:
     repeats: bool
     """True if this event is a repeating event and should be rescheduled."""
     next_fire: float
-    """The next time at which this event should fire."""
+    """The next time at which this event should fire, on the monotonic clock."""
+    name: Optional[str]
+    """A name under which the loop reports this event's lateness, if any."""
+    lateness: Lateness
+    """How late this event has fired."""
+    cancelled: bool
+    """True if this event has been cancelled and should not fire."""
 
     _callback: Optional[EventCallback]
     _data: Any
 
     def __init__(self, t: float, callback: Optional[EventCallback] = None,
                  data: Any = None):
-        """Creates an event that fires at time t.
+        """Creates an event that fires at wall-clock time t.
 
         The callback will be called with data as an argument
         at time t.
         """
         self.repeats = False
-        self.next_fire = t
+        self.name = None
+        self.lateness = Lateness()
+        self.cancelled = False
         self._callback = callback
         self._data = data
 
         if t == NOW:
-            self.next_fire = time.time()
+            self.next_fire = time.monotonic()
+        else:
+            self.next_fire = time.monotonic() + (t - time.time())
 
     def __eq__(self, other: Any) -> bool:
         return other.instanceof(self.__class__) \
@@ -54,12 +106,21 @@ class Event:
     def __lt__(self, other: 'Event') -> bool:
         return self.next_fire < other.next_fire
 
-    def fire(self) -> None:
-        """Execute this event's callback with its given data."""
+    def fire(self) -> Any:
+        """Execute this event's callback with its given data.
+
+        Returns the callback's result, which may be an awaitable to be run
+        by an AsyncLoop.
+        """
+        self.lateness.record(time.monotonic() - self.next_fire)
+        return self._call()
+
+    def _call(self) -> Any:
         if self._callback is not None:
-            self._callback(self._data)
+            return self._callback(self._data)
+        return None
 
-    def reschedule(self, loop: Loop) -> None:
+    def reschedule(self, loop: 'Loop') -> None:
         """Reschedule this event on the given loop (no-op)."""
 
 
@@ -71,23 +132,40 @@ class RepeatingEvent(Event):
     """
 
     def __init__(self, t: float, period: float,
-                 callback: Optional[EventCallback] = None, data: Any = None):
+                 callback: Optional[EventCallback] = None, data: Any = None,
+                 missed: str = "once"):
         """Creates a repeating event.
 
         The event will first fire at time t, then every period
-        seconds thereafter.
+        seconds thereafter.  If it falls a whole period or more behind, the
+        missed policy (one of MISSED_POLICIES) decides how to recover.
         """
         super().__init__(t, callback, data)
 
+        if missed not in MISSED_POLICIES:
+            raise Exception("unknown missed-tick policy %s" % missed)
         self.repeats = True
         self.period = period
+        self.missed = missed
 
-    def fire(self) -> None:
+    def fire(self) -> Any:
         """Execute this event's callback with its given data, and update its
         next firing time.
         """
-        super().fire()
+        late = time.monotonic() - self.next_fire
+        self.lateness.record(late)
+        skipped = int(late // self.period) if late >= self.period else 0
+        if skipped and self.missed != "catchup":
+            self.lateness.missed += skipped
+            # Resume on the first period boundary after now
+            self.next_fire += skipped * self.period
+            if self.missed == "skip":
+                self.lateness.missed += 1
+                self.next_fire += self.period
+                return None
+        result = self._call()
         self.next_fire += self.period
+        return result
 
     def reschedule(self, loop):
         """Reschedule this event on the given loop."""
@@ -0,0 +1,160 @@
+"""Off-loop execution of slow sensor reads.
+
+Sensors that opt in have their fire() method run on a small pool of worker
+threads instead of on the loop itself, so that a slow bus transaction does not
+stall the MQTT connection or the other sensors.  Anything such a sensor
+publishes is collected on the worker and handed back to the loop when the read
+completes: the worker calls the executor's on_done callback, which asks the
+loop to collect it.
+"""
+
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Empty, SimpleQueue
+from typing import Callable, Dict, List, Optional
+
+from .outbound import Message
+
+
+class ReadStats:
+    """Read statistics for one sensor."""
+
+    __slots__ = ("reads", "timeouts", "errors", "skipped", "total_time",
+                 "max_time", "last_time")
+
+    def __init__(self):
+        self.reads = 0
+        """Reads that completed, including late and failed reads"""
+        self.timeouts = 0
+        """Reads that did not complete by their deadline"""
+        self.errors = 0
+        """Reads that raised an exception"""
+        self.skipped = 0
+        """Reads not started because too many were already in flight"""
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.last_time = 0.0
+
+    def mean_time(self) -> float:
+        """Return the mean read latency, in seconds."""
+        return self.total_time / self.reads if self.reads else 0.0
+
+
+class _Job:
+    __slots__ = ("name", "start", "end", "deadline", "outbox", "late")
+
+    def __init__(self, name: str, start: float, deadline: float):
+        self.name = name
+        self.start = start
+        self.end = start
+        self.deadline = deadline
+        self.outbox: List[Message] = []
+        self.late = False
+
+
+class SensorExecutor:
+    """A bounded pool of worker threads for sensor reads.
+
+    Each read is given a deadline, after which it is counted as timed out and
+    anything it publishes is discarded.  Python threads cannot be cancelled,
+    so a timed-out read still holds its sensor's in-flight slot until it
+    eventually returns; this is what keeps a hung bus from accumulating
+    readers.
+    """
+
+    def __init__(self, workers: int = 2,
+                 on_done: Optional[Callable[[], None]] = None):
+        """Create a pool of worker threads.
+
+        on_done is called on a worker thread whenever a read finishes, and
+        should arrange for collect() to be called on the loop.
+        """
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix="sensor")
+        self._done: SimpleQueue = SimpleQueue()
+        self._pending: List[_Job] = []
+        self._inflight: Dict[str, int] = {}
+        self._on_done = on_done
+        self.stats: Dict[str, ReadStats] = {}
+        """Read statistics, by sensor name."""
+
+    def submit(self, name: str, read: Callable[[List[Message]], None],
+               deadline: float, limit: int = 1) -> bool:
+        """Start a read for the named sensor, unless limit reads are running.
+
+        The read is called on a worker thread with a list to which it should
+        append any messages to publish.  Returns True if the read started.
+        """
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = ReadStats()
+        if self._inflight.get(name, 0) >= limit:
+            stats.skipped += 1
+            return False
+
+        self._inflight[name] = self._inflight.get(name, 0) + 1
+        now = time.monotonic()
+        job = _Job(name, now, now + deadline)
+        self._pending.append(job)
+        future = self._pool.submit(self._run, job, read)
+        future.add_done_callback(lambda f: self._finished(job, f))
+        return True
+
+    def _finished(self, job: _Job, future: Future) -> None:
+        # Called on the worker thread once a read has returned
+        self._done.put((job, future))
+        if self._on_done is not None:
+            self._on_done()
+
+    @staticmethod
+    def _run(job: _Job, read: Callable[[List[Message]], None]) -> None:
+        try:
+            read(job.outbox)
+        finally:
+            job.end = time.monotonic()
+
+    def collect(self) -> List[Message]:
+        """Account for finished and overdue reads.
+
+        Returns the messages published by reads that finished on time, for the
+        loop to send.
+        """
+        messages: List[Message] = []
+        now = time.monotonic()
+        while True:
+            try:
+                job, future = self._done.get_nowait()
+            except Empty:
+                break
+            self._finish(job, future, messages)
+
+        for job in self._pending:
+            if not job.late and now > job.deadline:
+                job.late = True
+                self.stats[job.name].timeouts += 1
+        return messages
+
+    def _finish(self, job: _Job, future: Future,
+                messages: List[Message]) -> None:
+        self._inflight[job.name] -= 1
+        self._pending.remove(job)
+        stats = self.stats[job.name]
+        elapsed = job.end - job.start
+        stats.reads += 1
+        stats.total_time += elapsed
+        stats.last_time = elapsed
+        stats.max_time = max(stats.max_time, elapsed)
+        error = future.exception()
+        if error is not None:
+            stats.errors += 1
+            print("Read failed for sensor %s: %s" % (job.name, error))
+        elif not job.late and job.end <= job.deadline:
+            messages.extend(job.outbox)
+        elif not job.late:
+            job.late = True
+            stats.timeouts += 1
+
+    def next_deadline(self) -> Optional[float]:
+        """Return the first deadline of the reads not yet overdue, if any."""
+        deadlines = [job.deadline for job in self._pending if not job.late]
+        return min(deadlines) if deadlines else None
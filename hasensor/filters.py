@@ -0,0 +1,217 @@
+"""Composable filters for sensor readings.
+
+A sensor's readings can be passed through a pipeline of filters before they
+are published.  Smoothing filters replace each numeric value with a filtered
+value:
+
+  - ewma(alpha):  an exponentially weighted moving average, giving weight
+                  alpha to the newest value
+  - median(n):    the median of the last n values
+
+Suppression filters drop readings that have not changed enough since the last
+reading published:
+
+  - deadband(d):  suppress unless some value moved by at least d
+  - change:       suppress unless some value changed
+
+A sensor that declares its fields has the values of its Readings filtered
+before they are encoded, each numeric field separately, and the encoder
+rounds the filtered values to the fields' precisions.  Other readings are
+JSON, either a bare value or an object, each of whose numeric fields is
+filtered separately.  Fields that are not numeric only count as changed if
+they are not equal.  When suppression is in use, a heartbeat interval ensures that a
+reading is published at least that often, so that consumers can tell a steady
+value from a dead sensor.
+"""
+
+import collections
+import json
+import re
+from typing import Any, Deque, Dict, List, Optional, Sequence, Tuple
+
+from .outbound import Payload
+from .reading import Fields
+
+# A filter name and its numeric arguments
+FilterSpec = Tuple[str, List[float]]
+
+_SPEC = re.compile(r"\s*(\w+)\s*(?:\(([^)]*)\))?\s*(?:,|$)")
+
+# The number of arguments taken by each filter
+_ARITY = {
+    "ewma": 1,
+    "median": 1,
+    "deadband": 1,
+    "change": 0,
+}
+
+
+def filter_parser(arg: str) -> List[FilterSpec]:
+    """Parse a filter pipeline, such as "ewma(0.3),deadband(0.2)"."""
+    specs: List[FilterSpec] = []
+    pos = 0
+    while pos < len(arg):
+        match = _SPEC.match(arg, pos)
+        if match is None or match.end() == pos:
+            raise Exception("bad filter specification %s" % arg)
+        name, args = match.group(1), match.group(2)
+        values = [float(value) for value in args.split(",")] if args else []
+        if name not in _ARITY:
+            raise Exception("unknown filter %s" % name)
+        if len(values) != _ARITY[name]:
+            raise Exception("filter %s takes %d arguments"
+                            % (name, _ARITY[name]))
+        specs.append((name, values))
+        pos = match.end()
+    return specs
+
+
+class _EWMA:
+    __slots__ = ("alpha", "value")
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.value: Optional[float] = None
+
+    def __call__(self, value: float) -> float:
+        if self.value is None:
+            self.value = value
+        else:
+            self.value = value * self.alpha + self.value * (1 - self.alpha)
+        return self.value
+
+
+class _Median:
+    __slots__ = ("values",)
+
+    def __init__(self, n: float):
+        self.values: Deque[float] = collections.deque(maxlen=max(int(n), 1))
+
+    def __call__(self, value: float) -> float:
+        self.values.append(value)
+        ordered = sorted(self.values)
+        mid = len(ordered) // 2
+        if len(ordered) % 2:
+            return ordered[mid]
+        return (ordered[mid - 1] + ordered[mid]) / 2
+
+
+_SMOOTHERS = {
+    "ewma": _EWMA,
+    "median": _Median,
+}
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class FilterPipeline:
+    """A pipeline of filters for one sensor's readings."""
+
+    def __init__(self, specs: List[FilterSpec], heartbeat: float = 0.0):
+        """Create a pipeline from parsed filter specifications.
+
+        If heartbeat is nonzero, a reading is published at least every
+        heartbeat seconds even if it would otherwise be suppressed.
+        """
+        self._smoothing = [(_SMOOTHERS[name], args) for name, args in specs
+                           if name in _SMOOTHERS]
+        self._deadband: Optional[float] = None
+        for name, args in specs:
+            if name == "deadband":
+                self._deadband = max(self._deadband or 0.0, args[0])
+            elif name == "change" and self._deadband is None:
+                self._deadband = 0.0
+        self.heartbeat = heartbeat
+        self.suppressed = 0
+        """The number of readings suppressed."""
+
+        # Smoothing filters and last values published, by field name for
+        # JSON readings and by position for Readings
+        self._filters: Dict[Any, List[Any]] = {}
+        self._published: Optional[Dict[Any, Any]] = None
+        self._published_time = 0.0
+
+    def _smooth(self, field: Any, value: float) -> float:
+        filters = self._filters.get(field)
+        if filters is None:
+            filters = self._filters[field] = [cls(*args) for cls, args
+                                              in self._smoothing]
+        for func in filters:
+            value = func(value)
+        return value
+
+    def _changed(self, values: Dict[Any, Any]) -> bool:
+        if self._published is None or self._deadband is None:
+            return True
+        for field, value in values.items():
+            prev = self._published.get(field)
+            if self._deadband and _is_number(value) and _is_number(prev):
+                if abs(value - prev) >= self._deadband:
+                    return True
+            elif value != prev:
+                return True
+        return len(values) != len(self._published)
+
+    def _admit(self, values: Dict[Any, Any], now: float) -> bool:
+        # Whether to publish a reading of these values, taken at now
+        if not self._changed(values) and \
+                not (self.heartbeat and
+                     now - self._published_time >= self.heartbeat):
+            self.suppressed += 1
+            return False
+        self._published = values
+        self._published_time = now
+        return True
+
+    def filter(self, fields: Fields, values: Sequence[Any],
+               now: float) -> Optional[Sequence[Any]]:
+        """Filter the values of a Reading taken at monotonic time now.
+
+        Returns the values to encode and publish, or None if the reading is
+        suppressed.
+        """
+        if self._smoothing:
+            smoothed = []
+            for i, (field, value) in enumerate(zip(fields, values)):
+                if field.kind != "json" and _is_number(value):
+                    value = self._smooth(i, value)
+                    if field.kind == "int":
+                        value = round(value)
+                smoothed.append(value)
+            values = smoothed
+        if not self._admit(dict(enumerate(values)), now):
+            return None
+        return values
+
+    def process(self, data: Payload, now: float) -> Optional[Payload]:
+        """Filter a reading taken at monotonic time now.
+
+        Returns the reading to publish, or None if it is suppressed.
+        """
+        try:
+            reading = json.loads(data)
+            parsed = True
+        except ValueError:
+            reading = data
+            parsed = False
+
+        values: Dict[Any, Any]
+        if isinstance(reading, dict):
+            values = dict(reading)
+        else:
+            values = {None: reading}
+        if self._smoothing and parsed:
+            for field, value in values.items():
+                if _is_number(value):
+                    values[field] = round(self._smooth(field, value), 6)
+
+        if not self._admit(values, now):
+            return None
+
+        if not self._smoothing or not parsed:
+            return data
+        if isinstance(reading, dict):
+            return json.dumps(values)
+        return json.dumps(values[None])
@@ -0,0 +1,97 @@
+"""Logical nodes hosted by a gateway.
+
+A gateway is one process, with one loop and one broker connection, standing
+in for many sensor nodes, such as one per room or meter on an aggregation
+box.  Each Node has its own configuration file, giving its topic prefix, its
+identity for Home Assistant discovery, and its sensors; the nodes share the
+gateway's scheduler, worker threads, outbound queue, spool and connection,
+so each costs only its sensors and a little bookkeeping rather than an
+interpreter and a connection of its own.
+
+Only the prefix, discovery options, history size and sensors of a node's
+configuration are used; everything about the connection comes from the
+gateway's.  A node that does not name itself with discovery-node is named
+after its prefix.  Every node's entities share the gateway's availability
+topic, since they go offline together.  A node's file is reloaded like the
+gateway's own, when it changes or on SIGHUP.
+"""
+
+from typing import List, Optional
+
+from .configuration import Configuration
+from .discovery import Discovery
+from .loop import Loop
+from .sensorset import ConfigWatcher, SensorSet
+
+
+def read_node(path: str) -> Configuration:
+    """Read the configuration file of a node."""
+    argv = ["--config", path]
+    conf = Configuration()
+    conf.parse_args(argv=argv)
+    if conf.discovery_node == Configuration.DEF_DISC_NODE:
+        # On the command line, so that reloads keep the name
+        name = conf.prefix.replace("/", "_")
+        conf = Configuration()
+        conf.parse_args(argv=argv + ["--discovery-node", name])
+    return conf
+
+
+class Node:
+    """A logical node: a prefix and a set of sensors on a shared loop."""
+
+    def __init__(self, loop: Loop, conf: Configuration):
+        self.conf = conf
+        if conf.history_size:
+            loop.add_history(conf.prefix, conf.history_size)
+        self.sensors = SensorSet(loop, conf.prefix)
+        """The node's sensors"""
+        self.discovery: Optional[Discovery] = None
+        if conf.discoverable:
+            self.discovery = Discovery(loop, conf, self.sensors)
+        self._loop = loop
+        self._watcher: Optional[ConfigWatcher] = None
+
+    @property
+    def prefix(self) -> str:
+        """The node's topic prefix."""
+        return self.conf.prefix
+
+    def start(self) -> None:
+        """Start the node's sensors, and announce them if discoverable.
+
+        Sensors that cannot be created are reported by the exception raised,
+        once the others have started.
+        """
+        try:
+            self.sensors.apply(self.conf.sensors)
+        finally:
+            if self.discovery is not None:
+                self.discovery.install()
+            if self.conf.config is not None:
+                self._watcher = ConfigWatcher(self.conf, self.sensors)
+                self._watcher.install()
+                self._loop.schedule(self._watcher)
+
+    def close(self) -> None:
+        """Stop the node's sensors."""
+        if self._watcher is not None:
+            self._watcher.uninstall()
+            self._loop.cancel(self._watcher)
+            self._watcher = None
+        self.sensors.close()
+
+
+def start_nodes(loop: Loop, conf: Configuration) -> List[Node]:
+    """Create and start the nodes of a gateway's configuration."""
+    nodes = []
+    prefixes = {conf.prefix}
+    for path in conf.nodes:
+        node = Node(loop, read_node(path))
+        if node.prefix in prefixes:
+            raise Exception("node %s has the prefix %s of another node"
+                            % (path, node.prefix))
+        prefixes.add(node.prefix)
+        node.start()
+        nodes.append(node)
+    return nodes
@@ -0,0 +1,299 @@
+"""Recent readings kept in memory, and queried over MQTT.
+
+A History keeps the most recent readings of each of a node's sensor topics
+in a ring buffer of fixed size.  Each ring is stored by column, an array of
+doubles for the reading times (seconds since the Epoch) and one for each
+numeric field, so a reading costs eight bytes per column and no Python
+objects.  The node's memory budget is divided equally between its topics:
+when a topic is added or forgotten, every ring is resized to its new share,
+keeping its newest readings.
+
+Readings are recorded as the sensor took them, before any filtering or
+aggregation.  Only sensors that declare the fields of their readings are
+recorded; absent values are stored as NaN.
+
+Consumers query the history by publishing a JSON request on
+<prefix>/history/request:
+
+    {"sensor": "climate", "last": 100, "id": 7}
+    {"sensor": "climate", "since": 1700000000, "until": 1700003600}
+
+The sensor is named relative to the node's prefix.  last asks for the given
+number of newest readings; since and until (seconds since the Epoch, either
+of which may be omitted) ask for the readings in a time range.  The readings
+are returned in one message, by column:
+
+    {"id": 7, "sensor": "climate", "fields": ["temp", "humidity"],
+     "time": [...], "temp": [...], "humidity": [...]}
+
+on the request's reply topic if it gives one, or else on
+<prefix>/history/response, followed by /<id> if the request has an id.
+Responses on a topic replace each other in the outbound queue like any other
+message, so concurrent requesters should use their own reply topic or id.
+A request that cannot be answered gets a response with an error, as does one
+whose reply topic or id is empty or contains a wildcard or NUL, on
+<prefix>/history/response.
+"""
+
+import json
+import math
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Any, Dict, List, Optional, Sequence, TYPE_CHECKING
+
+from .reading import Fields
+
+if TYPE_CHECKING:
+    from .loop import Loop
+
+_ITEM = array("d").itemsize
+
+
+class _Times:
+    # The time column of a ring in logical order, oldest first, for bisect
+    def __init__(self, ring: 'Ring'):
+        self._ring = ring
+
+    def __len__(self) -> int:
+        return self._ring.count
+
+    def __getitem__(self, i: int) -> float:
+        return self._ring.times[self._ring.slot(i)]
+
+
+class Ring:
+    """A fixed-size columnar ring buffer of readings."""
+
+    __slots__ = ("fields", "capacity", "count", "times", "columns",
+                 "_index", "_precisions", "_next")
+
+    def __init__(self, fields: Fields, capacity: int):
+        """Create a ring for the numeric fields of readings."""
+        # The positions of the numeric fields in a reading's values
+        self._index = [i for i, field in enumerate(fields)
+                       if field.kind != "json"]
+        self.fields = [fields[i].name for i in self._index]
+        """The names of the fields held"""
+        self._precisions = [fields[i].precision
+                            if fields[i].kind == "float" else None
+                            for i in self._index]
+        self.capacity = 0
+        self.count = 0
+        """The number of readings held"""
+        self.times = array("d")
+        self.columns: List[array] = [array("d") for _ in self._index]
+        self._next = 0
+        self.resize(capacity)
+
+    def record_size(self) -> int:
+        """Return the bytes taken by each reading."""
+        return _ITEM * (1 + len(self.columns))
+
+    def slot(self, i: int) -> int:
+        """Return the slot of the i-th oldest reading."""
+        return (self._next - self.count + i) % self.capacity
+
+    def append(self, when: float, values: Sequence[Any]) -> None:
+        """Add a reading, replacing the oldest if the ring is full."""
+        if not self.capacity:
+            return
+        slot = self._next
+        self.times[slot] = when
+        for column, i in zip(self.columns, self._index):
+            value = values[i]
+            column[slot] = math.nan if value is None else value
+        self._next = (slot + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def resize(self, capacity: int) -> None:
+        """Change the capacity of the ring, keeping its newest readings."""
+        keep = min(self.count, capacity)
+        start = self.count - keep
+        pad = array("d", bytes(_ITEM * (capacity - keep)))
+        self.times = self._ordered(self.times, start) + pad
+        self.columns = [self._ordered(column, start) + pad
+                        for column in self.columns]
+        self.capacity = capacity
+        self.count = keep
+        self._next = keep % capacity if capacity else 0
+
+    def _ordered(self, column: array, start: int) -> array:
+        # The readings of a column from the start-th oldest on, in order
+        if start >= self.count:
+            return array("d")
+        first = self.slot(start)
+        end = self.slot(self.count - 1) + 1
+        if first < end:
+            return column[first:end]
+        return column[first:] + column[:end]
+
+    def select(self, first: int, end: int) -> Dict[str, List[Any]]:
+        """Return the i-th oldest readings, for first <= i < end, by column."""
+        slots = [self.slot(i) for i in range(first, end)]
+        result: Dict[str, List[Any]] = {
+            "time": [round(self.times[slot], 3) for slot in slots]}
+        for name, precision, column in zip(self.fields, self._precisions,
+                                           self.columns):
+            result[name] = [None if not math.isfinite(column[slot])
+                            else int(column[slot]) if precision is None
+                            else round(column[slot], precision)
+                            for slot in slots]
+        return result
+
+    def last(self, n: int) -> Dict[str, List[Any]]:
+        """Return the n newest readings, by column."""
+        return self.select(max(self.count - n, 0), self.count)
+
+    def between(self, since: Optional[float],
+                until: Optional[float]) -> Dict[str, List[Any]]:
+        """Return the readings taken from since through until, by column."""
+        times = _Times(self)
+        first = 0 if since is None else bisect_left(times, since)
+        end = self.count if until is None else bisect_right(times, until)
+        return self.select(first, max(first, end))
+
+
+def _count(value: Any) -> int:
+    # A number of readings asked for by a request
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or value < 0:
+        raise ValueError("last must be a non-negative integer")
+    return value
+
+
+def _publishable(topic: str) -> bool:
+    # Whether a topic can be published to: not empty, no wildcards or NULs,
+    # and encodable in at most 65535 bytes of UTF-8
+    if not topic or "+" in topic or "#" in topic or "\0" in topic:
+        return False
+    try:
+        return len(topic.encode("utf-8")) <= 65535
+    except UnicodeEncodeError:
+        return False
+
+
+class History:
+    """The recent readings of a node's sensors, within a memory budget."""
+
+    def __init__(self, loop: 'Loop', prefix: str, budget: int):
+        """Keep readings under prefix in budget bytes, answering queries."""
+        self._loop = loop
+        self._prefix = prefix
+        self.budget = budget
+        self._rings: Dict[str, Ring] = {}
+        # Readings may be recorded by worker threads
+        self._lock = threading.Lock()
+        self.queries = 0
+        """The number of requests answered"""
+        loop.subscribe(prefix + "/history/request", self._request)
+
+    def __len__(self) -> int:
+        return len(self._rings)
+
+    def ring(self, topic: str) -> Optional[Ring]:
+        """Return the ring of a topic, if it has one."""
+        return self._rings.get(topic)
+
+    def _rebalance(self) -> None:
+        if not self._rings:
+            return
+        share = self.budget // len(self._rings)
+        for ring in self._rings.values():
+            ring.resize(share // ring.record_size())
+
+    def record(self, topic: str, fields: Fields, values: Sequence[Any],
+               when: Optional[float] = None) -> None:
+        """Record a reading published on topic.
+
+        when is the monotonic time the reading was taken, if not now.
+        """
+        now = time.time()
+        if when is not None:
+            now -= time.monotonic() - when
+        with self._lock:
+            ring = self._rings.get(topic)
+            if ring is None:
+                ring = self._rings[topic] = Ring(fields, 0)
+                self._rebalance()
+            ring.append(now, values)
+
+    def forget(self, topic: str) -> None:
+        """Drop the readings of topic and of the topics beneath it."""
+        with self._lock:
+            for key in list(self._rings):
+                if key == topic or key.startswith(topic + "/"):
+                    del self._rings[key]
+            self._rebalance()
+
+    def query(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        """Answer a request, as described for the request topic."""
+        sensor = request.get("sensor")
+        result: Dict[str, Any] = {"sensor": sensor}
+        if "id" in request:
+            result["id"] = request["id"]
+        with self._lock:
+            ring = self._rings.get("%s/%s" % (self._prefix, sensor))
+            if ring is None:
+                result["error"] = "no history for sensor %s" % sensor
+                return result
+            result["fields"] = list(ring.fields)
+            if "last" in request:
+                result.update(ring.last(_count(request["last"])))
+            else:
+                since = request.get("since")
+                until = request.get("until")
+                result.update(ring.between(
+                    None if since is None else float(since),
+                    None if until is None else float(until)))
+        return result
+
+    def _request(self, payload: bytes) -> None:
+        try:
+            request = json.loads(payload)
+            if not isinstance(request, dict):
+                raise ValueError("request is not an object")
+        except ValueError as err:
+            self._respond(self._prefix + "/history/response",
+                          {"error": "bad request: %s" % err})
+            return
+        reply = request.get("reply")
+        if not isinstance(reply, str):
+            reply = None
+            if "id" in request:
+                ident = "%s" % (request["id"],)
+                reply = ("%s/history/response/%s" % (self._prefix, ident)
+                         if ident else "")
+        if reply is not None and not _publishable(reply):
+            # Requesters must not be able to make the loop publish to a topic
+            # the broker client refuses
+            self._respond(self._prefix + "/history/response",
+                          {"id": request.get("id"),
+                           "error": "bad request: invalid reply topic"})
+            return
+        if reply is None:
+            reply = self._prefix + "/history/response"
+        try:
+            response = self.query(request)
+        except (TypeError, ValueError, OverflowError) as err:
+            response = {"id": request.get("id"),
+                        "error": "bad request: %s" % err}
+        self._respond(reply, response)
+
+    def _respond(self, topic: str, response: Dict[str, Any]) -> None:
+        self.queries += 1
+        self._loop.publish_raw(topic, json.dumps(response,
+                                                 separators=(",", ":")))
+
+    def report(self) -> Dict[str, Any]:
+        """Return the history's size and use, for the runtime metrics."""
+        with self._lock:
+            return {"topics": len(self._rings),
+                    "readings": sum(ring.count
+                                    for ring in self._rings.values()),
+                    "bytes": sum(ring.capacity * ring.record_size()
+                                 for ring in self._rings.values()),
+                    "queries": self.queries}
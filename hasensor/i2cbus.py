@@ -0,0 +1,115 @@
+"""Shared I2C buses.
+
+Sensors on the same I2C bus share one bus object, obtained from shared_bus(),
+rather than each opening the bus themselves.  Each bus has a lock, which a
+sensor holds for the duration of a read with transaction(), so that reads on
+worker threads cannot interleave on the wire.
+
+Reads made from the loop's thread are batched: the first sensor to read a bus
+at a given tick of the loop takes the lock, and it is released only once the
+loop has run every event due at that tick, so sensors due together are read
+back to back in one locked batch without a worker read slipping in between.
+
+Each bus counts its transactions and batches, and keeps a histogram of how
+long transactions held it; report() returns these for the loop's runtime
+metrics.  The CircuitPython board and busio modules are imported only when a
+bus is first opened.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple, TYPE_CHECKING
+
+from .metrics import Histogram
+
+if TYPE_CHECKING:
+    from .loop import Loop
+
+TRANSACTION_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.05, 0.1, 1.0)
+"""Histogram bucket bounds for I2C transaction durations (seconds)."""
+
+
+class BusStats:
+    """Statistics for a shared I2C bus."""
+
+    __slots__ = ("transactions", "batches", "wait", "duration")
+
+    def __init__(self):
+        self.transactions = 0
+        """The number of transactions on the bus"""
+        self.batches = 0
+        """The number of locked batches of loop-thread transactions"""
+        self.wait = 0.0
+        """The total time spent waiting for the bus lock, in seconds"""
+        self.duration = Histogram(TRANSACTION_BUCKETS)
+        """The time each transaction held the bus"""
+
+
+class I2CBus:
+    """An I2C bus shared by every sensor using the same pins."""
+
+    def __init__(self, name: str, i2c: Any):
+        self.name = name
+        self.i2c = i2c
+        """The underlying busio.I2C object, to pass to device drivers."""
+        self.stats = BusStats()
+        # Reentrant, so that a batch held by the loop's thread admits that
+        # thread's transactions
+        self._lock = threading.RLock()
+        self._batch = False
+
+    @contextmanager
+    def transaction(self, loop: Optional['Loop'] = None) -> Iterator[Any]:
+        """Hold the bus for the duration of a with block.
+
+        The busio.I2C object is the value of the with statement.  If loop is
+        given and this is its thread, the bus is held until the loop has run
+        every event due now, batching them.
+        """
+        start = time.perf_counter()
+        if loop is not None and not self._batch and loop.on_loop_thread():
+            self._lock.acquire()
+            self._batch = True
+            self.stats.batches += 1
+            loop.post(self._end_batch)
+        with self._lock:
+            begin = time.perf_counter()
+            self.stats.wait += begin - start
+            try:
+                yield self.i2c
+            finally:
+                self.stats.transactions += 1
+                self.stats.duration.observe(time.perf_counter() - begin)
+
+    def _end_batch(self) -> None:
+        self._batch = False
+        self._lock.release()
+
+    def report(self) -> Dict[str, Any]:
+        """Return the bus statistics as a JSON-compatible dict."""
+        return {"transactions": self.stats.transactions,
+                "batches": self.stats.batches,
+                "wait": round(self.stats.wait, 6),
+                "duration": self.stats.duration.report()}
+
+
+_buses: Dict[Tuple[str, str], I2CBus] = {}
+_buses_lock = threading.Lock()
+
+
+def shared_bus(scl: str = "SCL", sda: str = "SDA") -> I2CBus:
+    """Return the shared bus on the named board pins, opening it if needed."""
+    with _buses_lock:
+        bus = _buses.get((scl, sda))
+        if bus is None:
+            import board                # type: ignore
+            import busio                # type: ignore
+            i2c = busio.I2C(getattr(board, scl), getattr(board, sda))
+            bus = _buses[(scl, sda)] = I2CBus("%s,%s" % (scl, sda), i2c)
+        return bus
+
+
+def report() -> Dict[str, Dict[str, Any]]:
+    """Return the statistics of every open bus, by name."""
+    return {bus.name: bus.report() for bus in list(_buses.values())}
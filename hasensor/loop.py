@@ -1,31 +1,65 @@
 """Main loop for a sensor node.
 
 This file provides a mainloop for integrating the sensor node logic
-with the paho MQTT loop.  It allows time-scheduled events to be added
-to the system and loops only until the next scheduled event occurs.
+with its transport, normally the paho MQTT loop.  It allows time-scheduled
+events to be added to the system and loops only until the next scheduled
+event occurs.
 
-It does not currently handle reconnection logic, but it should.
+Published messages are queued and sent, coalesced by topic, each time the
+loop wakes up.  When the broker is unreachable, the loop retries the
+connection with exponential backoff while continuing to run scheduled events.
+If a spool is configured, messages published in the meantime are held there
+and sent once the connection returns.
+
+Code running on other threads, such as GPIO interrupt callbacks, hands work to
+the loop with post(), which queues a callback and wakes the loop immediately.
 """
 
+import collections
+import inspect
+import json
+import select
+import socket
+import threading
 import time
-from typing import Dict, List, Optional, TYPE_CHECKING
-from heapq import heappush, heappop
-
-import paho.mqtt.client as MQTTClient
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple, \
+    Union, TYPE_CHECKING
 
+from . import i2cbus
+from .backoff import Backoff
 from .configuration import Configuration
+from .event import RepeatingEvent
+from .executor import ReadStats, SensorExecutor
+from .history import History
+from .metrics import Metrics, write_textfile
+from .outbound import Message, OutboundQueue, Payload
+from .scheduler import create_scheduler
+from .spool import Spool
+from .store import Store
+from .transport import Transport, create_transport
 
 if TYPE_CHECKING:
-    from .event import Event
+    from .event import Event, Lateness
+
+Recorder = Union[History, Store]
+"""The type of the objects that record sensors' readings."""
 
 _MAX_LOOP = 15.0
+_CONNECT_TIMEOUT = 30.0
+_SPOOL_INTERVAL = 0.1
+
+# Connection states
+_DISCONNECTED = 0
+_CONNECTING = 1
+_CONNECTED = 2
 
 
 class Loop:
     """The main event loop.
 
-    Events can be added to the loop, and their execution will begin as soon as
-    a connection with the MQTT broker is established.   Scheduling is on a
+    Events can be added to the loop, and their execution will begin when the
+    loop is started, whether or not the MQTT broker is reachable; the loop
+    (re)connects to the broker in the background.  Scheduling is on a
     fractional-second basis, but only minimal effort is made to maintain
     timings.  Critical timings (such as I/O interactions) should not rely on
     the loop's scheduler.
@@ -39,15 +73,67 @@ class Loop:
 
         self._conf: Configuration = conf
 
-        # Create the MQTT client
-        self._mqttclient = MQTTClient.Client(conf.client_id, userdata=self)
-        self._mqttclient.on_connect = lambda client, data, flags, result: \
-            self._on_connect_cb(client, flags, result)
-        self._mqttclient.on_disconnect = lambda client, data, result: \
-            self._on_disconnect_cb(client, result)
+        self.transport: Transport = create_transport(conf)
+        """The transport that carries published messages."""
+        self.transport.on_connect = self._on_connect_cb
+        self.transport.on_disconnect = self._on_disconnect_cb
+        self.transport.on_publish = lambda mid: self.outbound.acknowledged(mid)
+        self.transport.on_message = self._on_message_cb
+        # Callbacks for received messages, by topic
+        self._subscriptions: Dict[str, List[Callable[[bytes], None]]] = {}
+        self.availability = conf.availability_topic()
+        """The topic on which the loop is reported online, if any."""
+        # The recent readings of each node's sensors, by node prefix
+        self._histories: Dict[str, History] = {}
+        if conf.history_size:
+            self.add_history(conf.prefix, conf.history_size)
+        self.store: Optional[Store] = None
+        """The local store of every sensor's readings, if any."""
+        if conf.store is not None:
+            self.store = Store(conf.store, conf.store_size)
+
+        self._scheduler = create_scheduler(conf.scheduler)
+        self._named: Dict[str, 'Event'] = {}
+        self._backoff = Backoff(conf.reconnect_min, conf.reconnect_max)
+        self._conn_state = _DISCONNECTED
+        # When the next connection attempt (or the current one) times out
+        self._conn_deadline = 0.0
 
-        self._events: List['Event'] = []
-        self._conn_pending = True
+        self._spool: Optional[Spool] = None
+        if conf.spool is not None:
+            self._spool = Spool(conf.spool, conf.spool_size, conf.spool_policy)
+        self._spool_tokens = 0.0
+        self._spool_time = 0.0
+
+        self._executor: Optional[SensorExecutor] = None
+        # Worker threads collect their publishes in _local.outbox
+        self._local = threading.local()
+
+        self.outbound = OutboundQueue(conf.coalesce_window, conf.max_inflight)
+        """The outbound message queue, which may be queried for statistics."""
+        # Other threads wake the loop by writing to _wake_w
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        # Callbacks posted for the loop to run; deque appends and pops are
+        # atomic, so posting takes no lock
+        self._posted: Deque[Tuple[Callable[..., None], Tuple[Any, ...]]] = \
+            collections.deque()
+        # Callbacks for file descriptors watched by sensors, by descriptor
+        self._readers: Dict[int, Callable[[], None]] = {}
+        self._thread_id = threading.get_ident()
+        self._stopping = False
+
+        self.metrics: Optional[Metrics] = None
+        """Runtime metrics, if enabled by the configuration."""
+        if conf.stats_interval > 0:
+            self.metrics = Metrics()
+            self.schedule(RepeatingEvent(time.time() + conf.stats_interval,
+                                         conf.stats_interval,
+                                         self._report_stats))
+        if self.store is not None:
+            self.schedule(RepeatingEvent(time.time() + conf.store_sync,
+                                         conf.store_sync, self._sync_store))
 
         self.prefix = self._conf.prefix
         self.connected: bool = False
@@ -55,79 +141,403 @@ class Loop:
 
         This value should only be queried, not set, by external users.
         """
+        self.connects: int = 0
+        """The number of successful connections to the broker."""
+        self.disconnects: int = 0
+        """The number of times an established connection was lost."""
+        self.connect_failures: int = 0
+        """The number of connection attempts that failed."""
 
-        self._mqttclient.connect(self._conf.broker[0], self._conf.broker[1])
+        self._try_reconnect()
 
-    def _on_connect_cb(self, client: MQTTClient.Client, flags: Dict[str, int],
-                       result: int) -> None:
+    def _on_connect_cb(self, result: int) -> None:
         if result == 0:
             self.connected = True
+            self._conn_state = _CONNECTED
+            self.connects += 1
+            self._backoff.reset()
+            self._spool_tokens = 0.0
+            self._spool_time = time.monotonic()
+            self.outbound.reset_inflight()
+            if self.availability is not None:
+                self.publish_raw(self.availability, "online", 1, True)
         else:
-            raise Exception("connection error")
+            self._connect_failed()
 
-    def _on_disconnect_cb(self, client: MQTTClient.Client, result: int) -> None:
-        self.connected = False
-        self._try_reconnect()
+    def _on_disconnect_cb(self, result: int) -> None:
+        if self._conn_state == _CONNECTED:
+            self.disconnects += 1
+            self.connected = False
+            self._retry_later()
+        elif self._conn_state == _CONNECTING:
+            self._connect_failed()
+
+    def _on_message_cb(self, topic: str, payload: bytes) -> None:
+        for callback in self._subscriptions.get(topic, ()):
+            callback(payload)
+
+    def subscribe(self, topic: str, callback: Callable[[bytes], None]) -> None:
+        """Call callback with the payload of each message received on topic.
+
+        The topic is a full topic, not under the node's prefix.  Messages are
+        only received over transports that support it, such as MQTT.
+        """
+        self._subscriptions.setdefault(topic, []).append(callback)
+        self.transport.listen(topic)
+
+    def add_history(self, prefix: str, budget: int) -> History:
+        """Keep the recent readings of sensors under prefix in budget bytes.
+
+        Sensors must join the loop after their history is added.
+        """
+        history = self._histories[prefix] = History(self, prefix, budget)
+        return history
+
+    def history(self, prefix: Optional[str] = None) -> Optional[History]:
+        """Return the history kept for the node with prefix, if any.
+
+        The loop's own prefix is the default.
+        """
+        return self._histories.get(prefix or self.prefix)
+
+    def recorders(self, prefix: Optional[str] = None) -> List[Recorder]:
+        """Return what records the readings of sensors under prefix.
+
+        The loop's own prefix is the default.
+        """
+        recorders: List[Recorder] = []
+        history = self.history(prefix)
+        if history is not None:
+            recorders.append(history)
+        if self.store is not None:
+            recorders.append(self.store)
+        return recorders
+
+    def _sync_store(self, data: None) -> None:
+        # Write the store out on a worker thread, so that slow storage does
+        # not stall the loop; while a write is still running, readings are
+        # left for the next
+        store = self.store
+        self.submit("store",
+                    lambda: self.post(store.synced, store.write(store.take())),
+                    self._conf.store_sync)
+
+    def _connect_failed(self) -> None:
+        self.connect_failures += 1
+        self._retry_later()
+
+    def _retry_later(self) -> None:
+        self._conn_state = _DISCONNECTED
+        self._conn_deadline = time.monotonic() + self._backoff.delay()
 
     def _try_reconnect(self) -> None:
-        self._conn_pending = True
+        self._conn_state = _CONNECTING
+        self._conn_deadline = time.monotonic() + _CONNECT_TIMEOUT
         try:
-            self._mqttclient.reconnect()
+            self.transport.connect()
         except OSError:
-            self._conn_pending = False
+            self._connect_failed()
+
+    def _maintain_connection(self, now: float) -> None:
+        if self._conn_state == _CONNECTED or now < self._conn_deadline:
+            return
+        if self._conn_state == _CONNECTING:
+            # The broker accepted the socket but never answered
+            self.transport.disconnect()
+            self._connect_failed()
+        else:
+            self._try_reconnect()
 
     def schedule(self, event: 'Event') -> None:
         """Add an event to the loop's schedule."""
-        heappush(self._events, event)
+        self._track(event)
+        self._scheduler.push(event)
+
+    def cancel(self, event: 'Event') -> None:
+        """Cancel a scheduled event, so that it neither fires nor repeats."""
+        event.cancelled = True
+        if event.name is not None and self._named.get(event.name) is event:
+            del self._named[event.name]
+
+    def _track(self, event: 'Event') -> None:
+        if event.name is not None:
+            self._named[event.name] = event
+
+    def lateness(self) -> Dict[str, 'Lateness']:
+        """Return the lateness statistics of named events, by name."""
+        return {name: event.lateness for name, event in self._named.items()}
 
-    def publish(self, subtopic: str, data: str) -> None:
+    def publish(self, subtopic: str, data: Payload, qos: int = 0,
+                retain: bool = False) -> None:
         """Publish a message to the loop's MQTT broker under this sensor's topic."""
-        topic = self._conf.prefix + "/" + subtopic
-        self._mqttclient.publish(topic, data)
+        self.publish_raw(self._conf.prefix + "/" + subtopic, data, qos, retain)
+
+    def publish_raw(self, topic: str, data: Payload, qos: int = 0,
+                    retain: bool = False) -> None:
+        """Publish a message to the loop's MQTT broker on any topic.
+
+        The message is queued, and sent when the loop next wakes up and its
+        coalescing window has passed, unless it has been replaced by a newer
+        message on the same topic.  This method may be called from any
+        thread.
+        """
+        outbox = getattr(self._local, "outbox", None)
+        if outbox is not None:
+            outbox.append((topic, data, qos, retain))
+            return
+        self.outbound.add(topic, data, qos, retain, time.monotonic())
+        self._queued()
 
-    def publish_raw(self, topic: str, data: str) -> None:
-        """Publish a message to the loop's MQTT broker on any topic."""
-        self._mqttclient.publish(topic, data)
+    def _queued(self) -> None:
+        # Make sure the loop flushes a newly queued message in time
+        if threading.get_ident() != self._thread_id:
+            self._wake()
+
+    def _wake(self) -> None:
+        try:
+            self._wake_w.send(b"\0")
+        except BlockingIOError:
+            # The loop has plenty of wakeups pending already
+            pass
+
+    def post(self, callback: Callable[..., None], *args: Any) -> None:
+        """Run callback(*args) on the loop's thread as soon as possible.
+
+        This method may be called from any thread, and wakes the loop if it
+        is waiting.  Callbacks run in the order they were posted.
+        """
+        self._posted.append((callback, args))
+        # Every post from another thread wakes the loop: two threads posting
+        # at once could each find the other's callback already queued, and
+        # the wakeup bytes are drained together.  The loop's own thread
+        # checks the queue before it next waits.
+        if not self.on_loop_thread():
+            self._wake()
+
+    def on_loop_thread(self) -> bool:
+        """Return whether the caller is running on the loop's thread."""
+        return threading.get_ident() == self._thread_id
+
+    def _run_posted(self) -> None:
+        posted = self._posted
+        while True:
+            try:
+                callback, args = posted.popleft()
+            except IndexError:
+                return
+            callback(*args)
+
+    def _deliver(self, messages: List[Message]) -> List[Optional[int]]:
+        # Send a batch from the outbound queue, or spool it if the transport
+        # is unavailable.  Returns the IDs of messages awaiting acknowledgement.
+        if self._spool is not None and (not self.connected or self._spool):
+            for message in messages:
+                self._spool.append(*message)
+            return []
+        if self.metrics is not None:
+            for topic, data, _, _ in messages:
+                self.metrics.published(topic, len(data))
+        mids = self.transport.publish_many(messages)
+        if self._spool is not None:
+            for message, mid in zip(messages, mids):
+                if mid is None:
+                    self._spool.append(*message)
+        return [mid or None for mid in mids]
+
+    def _send(self, topic: str, data: Payload, qos: int,
+              retain: bool) -> bool:
+        return self.transport.publish(topic, data, qos, retain) is not None
+
+    def _drain_spool(self, now: float) -> None:
+        # Drain at most spool_rate messages per second, in batches
+        rate = self._conf.spool_rate
+        self._spool_tokens = min(self._spool_tokens
+                                 + (now - self._spool_time) * rate, rate)
+        self._spool_time = now
+        if self._spool_tokens >= 1:
+            self._spool_tokens -= self._spool.drain(int(self._spool_tokens),
+                                                    self._send)
+
+    def submit(self, name: str, fire: Callable[[], None], deadline: float,
+               limit: int = 1) -> bool:
+        """Run fire() for the named sensor on a worker thread.
+
+        Messages published by fire() are sent from the loop once it returns,
+        unless it took longer than deadline seconds.  At most limit reads for
+        the sensor may be in flight at once; returns False if the read was
+        skipped for that reason.
+        """
+        if self._executor is None:
+            self._executor = SensorExecutor(
+                self._conf.workers, lambda: self.post(self._collect_reads))
+
+        def read(outbox):
+            self._local.outbox = outbox
+            try:
+                fire()
+            finally:
+                self._local.outbox = None
+        return self._executor.submit(name, read, deadline, limit)
+
+    def read_stats(self) -> Dict[str, ReadStats]:
+        """Return the statistics for sensors read on worker threads, by name."""
+        if self._executor is None:
+            return {}
+        return self._executor.stats
+
+    def _report_stats(self, data: None) -> None:
+        gauges = {
+            "connects": self.connects,
+            "disconnects": self.disconnects,
+            "connect_failures": self.connect_failures,
+            "queued": self.outbound.queued,
+            "coalesced": self.outbound.coalesced,
+            "sent": self.outbound.sent,
+            "queue_depth": len(self.outbound),
+            "inflight": self.outbound.inflight(),
+        }
+        if self._spool is not None:
+            gauges["spool_depth"] = len(self._spool)
+            gauges["spool_dropped"] = self._spool.dropped
+        report = self.metrics.report(gauges)
+        buses = i2cbus.report()
+        if buses:
+            report["i2c"] = buses
+        if self._histories:
+            report["history"] = {prefix: history.report() for prefix, history
+                                 in self._histories.items()}
+        if self.store is not None:
+            report["store"] = self.store.report()
+        self.publish("stats", json.dumps(report, separators=(",", ":")))
+        if self._conf.stats_file:
+            write_textfile(self._conf.stats_file, report)
+
+    def _fire(self, event: 'Event') -> Any:
+        # Fire an event, timing it if metrics are enabled
+        if self.metrics is None or event.name is None:
+            return event.fire()
+        start = time.perf_counter()
+        result = event.fire()
+        self.metrics.fired(event.name, time.perf_counter() - start,
+                           event.lateness.last)
+        return result
 
     def _process(self, event: 'Event') -> None:
-        event.fire()
+        if event.cancelled:
+            return
+        if inspect.isawaitable(self._fire(event)):
+            raise TypeError("coroutine events require an AsyncLoop")
         if event.repeats:
             self.schedule(event)
 
+    def add_reader(self, fd: int, callback: Callable[[], None]) -> None:
+        """Call callback from the loop whenever fd is readable.
+
+        This method must be called from the loop's thread, or before the loop
+        is started.
+        """
+        self._readers[fd] = callback
+
+    def remove_reader(self, fd: int) -> None:
+        """Stop watching fd."""
+        self._readers.pop(fd, None)
+
+    def _wait(self, timeout: float) -> None:
+        # Wait for transport traffic, a watched descriptor, a wakeup from
+        # another thread, or the timeout
+        client = self.transport
+        sock = client.socket() if self._conn_state != _DISCONNECTED else None
+        rlist: List[Any] = [self._wake_r]
+        rlist.extend(self._readers)
+        wlist = []
+        if sock is not None:
+            rlist.append(sock)
+            if client.want_write():
+                wlist.append(sock)
+
+        readable, writable, _ = select.select(rlist, wlist, [], timeout)
+        if self._wake_r in readable:
+            try:
+                while self._wake_r.recv(256):
+                    pass
+            except BlockingIOError:
+                pass
+        for fd in readable:
+            callback = self._readers.get(fd)
+            if callback is not None:
+                callback()
+        if sock in readable:
+            client.loop_read()
+        if sock in writable and client.socket() is not None:
+            client.loop_write()
+        if client.socket() is not None:
+            client.loop_misc()
+
+    def _service(self, now: float) -> None:
+        # Connection, spool and worker housekeeping, run at every wakeup
+        self._maintain_connection(now)
+        if self._spool and self.connected:
+            self._drain_spool(now)
+        if self._executor is not None:
+            self._collect_reads()
+
+    def _collect_reads(self) -> None:
+        # Publish what finished reads published, and count overdue reads
+        for message in self._executor.collect():
+            self.publish_raw(*message)
+
+    def _service_time(self, now: float, stime: float) -> float:
+        # Shorten a wait of stime seconds to the next housekeeping deadline
+        if self._posted:
+            return 0.0
+        due = self.outbound.next_due()
+        if due is not None:
+            stime = min(stime, due - now)
+        if not self.connected:
+            stime = min(stime, self._conn_deadline - now)
+        elif self._spool:
+            stime = min(stime, _SPOOL_INTERVAL)
+        if self._executor is not None:
+            # Finished reads post to the loop; wake only to time out the rest
+            deadline = self._executor.next_deadline()
+            if deadline is not None:
+                stime = min(stime, deadline - now)
+        return max(min(stime, _MAX_LOOP), 0.0)
+
+    def stop(self) -> None:
+        """Stop the loop once it has finished its current iteration.
+
+        This method may be called from any thread, or from an event.
+        """
+        self._stopping = True
+        if threading.get_ident() != self._thread_id:
+            self._wake()
+
     def loop(self) -> None:
         """Loop forever, running the scheduled events."""
-        if not self._events:
+        if not self._scheduler:
             return
 
-        # Using a heap for the handful of events with multi-second
-        # delays between is almost certainly overkill.
-        nevent: Optional[Event] = heappop(self._events)
-        while True:
-            if not self.connected:
-                if self._conn_pending:
-                    self._mqttclient.loop(timeout=0.5, max_packets=1)
-                else:
-                    self._try_reconnect()
-                continue
-
-            now = time.time()
+        self._thread_id = threading.get_ident()
+        while not self._stopping:
+            now = time.monotonic()
+            if self.metrics is not None:
+                self.metrics.wakeups += 1
+            self._service(now)
+            self._run_posted()
 
-            # nevent is not None here, but mypy doesn't know that
-            if nevent is None:
-                break
             # Process all events that happened up to and including now
-            while nevent.next_fire <= now:
-                self._process(nevent)
-                if self._events:
-                    nevent = heappop(self._events)
-                else:
-                    nevent = None
-                    break
-            if nevent is None:
+            for event in self._scheduler.pop_due(now):
+                self._process(event)
+            self.outbound.flush(time.monotonic(), self._deliver)
+
+            nfire = self._scheduler.next_time()
+            if nfire is None or self._stopping:
                 break
 
-            # Calculate the difference between now and the next event
-            stime = nevent.next_fire - now
-            if stime > _MAX_LOOP:
-                stime = _MAX_LOOP
-            self._mqttclient.loop(timeout=stime)
+            # Wait until the next event or housekeeping deadline
+            self._wait(self._service_time(now, nfire - now))
+        self._run_posted()
+        if self.store is not None:
+            self.store.flush()
+        self._stopping = False
@@ -0,0 +1,195 @@
+"""Runtime metrics for the loop and its sensors.
+
+The loop keeps counters and fixed-bucket histograms describing its own
+behavior: how long each sensor takes to fire, how late events run, how much is
+published on each topic, how often the loop wakes up, and so on.  Recording a
+value is a dictionary lookup and a bisection, so metrics are cheap enough to
+leave enabled on small hardware.
+
+Metrics are reported as a JSON document, and optionally written as a
+Prometheus node-exporter textfile.
+"""
+
+import os
+import time
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional, Sequence
+
+FIRE_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+"""Histogram bucket bounds for sensor fire durations (seconds)."""
+
+LATENESS_BUCKETS = (0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+"""Histogram bucket bounds for event lateness (seconds)."""
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 1.0)
+"""Histogram bucket bounds for input-to-publish latency (seconds)."""
+
+
+class Histogram:
+    """A histogram with fixed bucket bounds.
+
+    Bucket i counts observations no greater than bounds[i] (and greater than
+    bounds[i - 1]); a final bucket counts observations above every bound.
+    """
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Sequence[float]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """Add an observation."""
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def report(self) -> Dict[str, Any]:
+        """Return the histogram as a JSON-compatible dict."""
+        return {"count": self.count, "sum": round(self.sum, 6),
+                "le": list(self.bounds), "buckets": self.counts}
+
+
+class _SensorMetrics:
+    __slots__ = ("fire_time", "lateness", "latency")
+
+    def __init__(self):
+        self.fire_time = Histogram(FIRE_BUCKETS)
+        self.lateness = Histogram(LATENESS_BUCKETS)
+        self.latency: Optional[Histogram] = None
+
+
+class Metrics:
+    """Counters and histograms for a loop.
+
+    The loop records into this object as it runs; gauges that the loop
+    already tracks (connection counters, queue depths) are passed in when a
+    report is made.
+    """
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.wakeups = 0
+        """The number of times the loop has woken up"""
+        self._sensors: Dict[str, _SensorMetrics] = {}
+        self._topics: Dict[str, List[int]] = {}
+        self._last_time = self.start
+        self._last_wakeups = 0
+
+    def _sensor(self, name: str) -> _SensorMetrics:
+        sensor = self._sensors.get(name)
+        if sensor is None:
+            sensor = self._sensors[name] = _SensorMetrics()
+        return sensor
+
+    def fired(self, name: str, duration: float, lateness: float) -> None:
+        """Record that the named event fired lateness seconds late."""
+        sensor = self._sensor(name)
+        sensor.fire_time.observe(duration)
+        sensor.lateness.observe(lateness)
+
+    def latency(self, name: str, seconds: float) -> None:
+        """Record the time from an input to the named sensor publishing it.
+
+        This applies to sensors driven by interrupts rather than by events.
+        """
+        sensor = self._sensor(name)
+        if sensor.latency is None:
+            sensor.latency = Histogram(LATENCY_BUCKETS)
+        sensor.latency.observe(seconds)
+
+    def published(self, topic: str, size: int) -> None:
+        """Record a message of size bytes published on topic."""
+        counts = self._topics.get(topic)
+        if counts is None:
+            self._topics[topic] = [1, size]
+        else:
+            counts[0] += 1
+            counts[1] += size
+
+    def report(self, gauges: Dict[str, int]) -> Dict[str, Any]:
+        """Return a JSON-compatible report including the given gauges.
+
+        The wakeup rate is averaged over the time since the previous report.
+        """
+        now = time.monotonic()
+        elapsed = now - self._last_time
+        rate = (self.wakeups - self._last_wakeups) * 60.0 / elapsed \
+            if elapsed > 0 else 0.0
+        self._last_time = now
+        self._last_wakeups = self.wakeups
+
+        report: Dict[str, Any] = {
+            "uptime": round(now - self.start, 1),
+            "wakeups": self.wakeups,
+            "wakeups_per_min": round(rate, 1),
+        }
+        report.update(gauges)
+        report["sensors"] = {}
+        for name, sensor in self._sensors.items():
+            entry = {"fire_time": sensor.fire_time.report(),
+                     "lateness": sensor.lateness.report()}
+            if sensor.latency is not None:
+                entry["latency"] = sensor.latency.report()
+            report["sensors"][name] = entry
+        report["topics"] = {
+            topic: {"messages": counts[0], "bytes": counts[1]}
+            for topic, counts in self._topics.items()
+        }
+        return report
+
+
+def _prom_histogram(lines: List[str], metric: str, label: str,
+                    histograms: Dict[str, Dict[str, Any]]) -> None:
+    lines.append("# TYPE %s histogram" % metric)
+    for name, hist in histograms.items():
+        total = 0
+        for bound, count in zip(hist["le"] + ["+Inf"], hist["buckets"]):
+            total += count
+            lines.append('%s_bucket{%s="%s",le="%s"} %d'
+                         % (metric, label, name, bound, total))
+        lines.append('%s_sum{%s="%s"} %s' % (metric, label, name, hist["sum"]))
+        lines.append('%s_count{%s="%s"} %d'
+                     % (metric, label, name, hist["count"]))
+
+
+def prometheus(report: Dict[str, Any]) -> str:
+    """Format a report from Metrics.report() in Prometheus text format."""
+    lines: List[str] = []
+    for key, value in report.items():
+        if isinstance(value, (int, float)):
+            lines.append("# TYPE hasensor_%s gauge" % key)
+            lines.append("hasensor_%s %s" % (key, value))
+    sensors = report["sensors"]
+    _prom_histogram(lines, "hasensor_fire_seconds", "sensor",
+                    {name: s["fire_time"] for name, s in sensors.items()})
+    _prom_histogram(lines, "hasensor_lateness_seconds", "sensor",
+                    {name: s["lateness"] for name, s in sensors.items()})
+    _prom_histogram(lines, "hasensor_latency_seconds", "sensor",
+                    {name: s["latency"] for name, s in sensors.items()
+                     if "latency" in s})
+    buses = report.get("i2c", {})
+    if buses:
+        _prom_histogram(lines, "hasensor_i2c_transaction_seconds", "bus",
+                        {name: bus["duration"] for name, bus in buses.items()})
+        for key in ("transactions", "batches"):
+            lines.append("# TYPE hasensor_i2c_%s_total counter" % key)
+            for name, bus in buses.items():
+                lines.append('hasensor_i2c_%s_total{bus="%s"} %d'
+                             % (key, name, bus[key]))
+    for key in ("messages", "bytes"):
+        lines.append("# TYPE hasensor_topic_%s_total counter" % key)
+        for topic, counts in report["topics"].items():
+            lines.append('hasensor_topic_%s_total{topic="%s"} %d'
+                         % (key, topic, counts[key]))
+    return "\n".join(lines) + "\n"
+
+
+def write_textfile(path: str, report: Dict[str, Any]) -> None:
+    """Atomically write a report as a Prometheus textfile at path."""
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        f.write(prometheus(report))
+    os.replace(tmp, path)
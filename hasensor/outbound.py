@@ -0,0 +1,130 @@
+"""The outbound message queue.
+
+Every message published through the loop passes through this queue on its way
+to the broker.  A message waits in the queue for a short coalescing window,
+during which a newer message on the same topic replaces it, so that a burst of
+superseded state updates is sent as a single message.  The queue also limits
+the number of QoS 1 and 2 messages awaiting acknowledgement from the broker.
+"""
+
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple, Union
+
+Payload = Union[str, bytes]
+
+# (topic, payload, qos, retain)
+Message = Tuple[str, Payload, int, bool]
+
+
+class _Message:
+    __slots__ = ("payload", "qos", "retain", "due")
+
+    def __init__(self, payload: Payload, qos: int, retain: bool, due: float):
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.due = due
+
+
+# A send function takes a list of messages and returns, for each, the message
+# ID of a QoS 1 or 2 message that is awaiting acknowledgement, or None if the
+# message needs no acknowledgement.
+SendFunc = Callable[[List[Message]], List[Optional[int]]]
+
+
+class OutboundQueue:
+    """A queue of outgoing messages, coalesced by topic.
+
+    Messages may be added from any thread, but are flushed by the loop.
+    """
+
+    def __init__(self, window: float = 0.0, max_inflight: int = 20):
+        """Create a queue.
+
+        Messages are held for window seconds before being sent, and at most
+        max_inflight QoS 1 or 2 messages may await acknowledgement at once.
+        """
+        self.window = window
+        self.max_inflight = max_inflight
+        self.queued: int = 0
+        """The number of messages added to the queue."""
+        self.coalesced: int = 0
+        """The number of messages replaced by a newer message on their topic."""
+        self.sent: int = 0
+        """The number of messages handed to the transport."""
+
+        # Reentrant, as the MQTT client may acknowledge a message from within
+        # the send function
+        self._lock = threading.RLock()
+        self._pending: Dict[str, _Message] = {}
+        self._inflight: Set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def inflight(self) -> int:
+        """Return the number of messages awaiting acknowledgement."""
+        return len(self._inflight)
+
+    def add(self, topic: str, payload: Payload, qos: int, retain: bool,
+            now: float) -> None:
+        """Queue a message, replacing any message waiting on its topic."""
+        with self._lock:
+            self.queued += 1
+            message = self._pending.get(topic)
+            if message is None:
+                self._pending[topic] = _Message(payload, qos, retain,
+                                                now + self.window)
+                return
+            self.coalesced += 1
+            message.payload = payload
+            message.qos = qos
+            message.retain = retain
+
+    def flush(self, now: float, send: SendFunc) -> None:
+        """Send every message whose window has closed, oldest first.
+
+        The messages are passed to send in a single batch.  Messages that need
+        acknowledgement wait in the queue while the in-flight limit is
+        reached.
+        """
+        with self._lock:
+            batch: List[Message] = []
+            room = self.max_inflight - len(self._inflight)
+            for topic, message in self._pending.items():
+                if message.due > now:
+                    # Messages are held in order of their due times
+                    break
+                if message.qos:
+                    if room <= 0:
+                        continue
+                    room -= 1
+                batch.append((topic, message.payload, message.qos,
+                              message.retain))
+            if not batch:
+                return
+            for topic, _, _, _ in batch:
+                del self._pending[topic]
+            for mid in send(batch):
+                if mid is not None:
+                    self._inflight.add(mid)
+            self.sent += len(batch)
+
+    def acknowledged(self, mid: int) -> None:
+        """Note that the broker has acknowledged the message with ID mid."""
+        with self._lock:
+            self._inflight.discard(mid)
+
+    def reset_inflight(self) -> None:
+        """Forget the messages awaiting acknowledgement, as on reconnection."""
+        with self._lock:
+            self._inflight.clear()
+
+    def next_due(self) -> Optional[float]:
+        """Return the time at which the next message may be sent, if any."""
+        with self._lock:
+            for message in self._pending.values():
+                if message.qos and len(self._inflight) >= self.max_inflight:
+                    continue
+                return message.due
+        return None
@@ -0,0 +1,170 @@
+"""Supervised subprocesses whose output is read by the loop.
+
+A ProcessReader runs a command and watches its standard output from the
+loop's own I/O multiplexing, so no thread is needed to read it.  Output is
+split into lines and passed to a callback.  When the command exits, or closes
+its output, it is restarted after an exponential backoff delay; the backoff
+resets once the command produces output again.  Lines are accumulated in a
+bounded buffer, and an over-long line is discarded rather than growing the
+buffer without limit.
+"""
+
+import os
+import time
+from subprocess import DEVNULL, PIPE, Popen
+from typing import Callable, List, Optional
+
+from .backoff import Backoff
+from .event import Event
+from .loop import Loop
+
+DEF_MAX_LINE = 4096
+"""The default longest line accepted, in bytes."""
+
+_READ_SIZE = 65536
+
+
+class ReaderStats:
+    """Statistics for a ProcessReader."""
+
+    __slots__ = ("starts", "exits", "start_failures", "lines", "overflows",
+                 "bytes")
+
+    def __init__(self):
+        self.starts = 0
+        """The number of times the command was started"""
+        self.exits = 0
+        """The number of times the command exited or closed its output"""
+        self.start_failures = 0
+        """The number of times the command could not be started"""
+        self.lines = 0
+        """The number of lines read"""
+        self.overflows = 0
+        """The number of lines discarded for exceeding the maximum length"""
+        self.bytes = 0
+        """The number of bytes read"""
+
+
+class ProcessReader:
+    """A supervised subprocess whose output lines are handled on the loop."""
+
+    def __init__(self, loop: Loop, args: List[str],
+                 on_line: Callable[[bytes], None],
+                 max_line: int = DEF_MAX_LINE,
+                 backoff: Optional[Backoff] = None):
+        """Create a reader running args on loop, passing lines to on_line.
+
+        The command is not started until start() is called.  Lines are
+        passed without their line terminator.
+        """
+        self.args = args
+        self.stats = ReaderStats()
+        self._loop = loop
+        self._on_line = on_line
+        self._max_line = max_line
+        self._backoff = backoff if backoff is not None \
+            else Backoff(1.0, 300.0)
+        self._proc: Optional[Popen] = None
+        self._fd: Optional[int] = None
+        self._buf = bytearray()
+        self._discarding = False
+        self._restart: Optional[Event] = None
+        self._closed = False
+
+    def running(self) -> bool:
+        """Return whether the command is running."""
+        return self._proc is not None
+
+    def start(self) -> None:
+        """Start the command, if it is not already running or pending."""
+        if self._closed or self._proc is not None or self._restart is not None:
+            return
+        try:
+            self._proc = Popen(self.args, stdin=DEVNULL, stdout=PIPE,
+                               stderr=DEVNULL, close_fds=True)
+        except OSError:
+            self.stats.start_failures += 1
+            self._retry_later()
+            return
+        self.stats.starts += 1
+        self._fd = self._proc.stdout.fileno()
+        os.set_blocking(self._fd, False)
+        self._loop.add_reader(self._fd, self._readable)
+
+    def close(self) -> None:
+        """Stop the command, and do not restart it."""
+        self._closed = True
+        if self._restart is not None:
+            self._loop.cancel(self._restart)
+            self._restart = None
+        self._stop()
+
+    def _stop(self) -> None:
+        if self._proc is None:
+            return
+        self._loop.remove_reader(self._fd)
+        if self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.wait()
+        self._proc.stdout.close()
+        self._proc = None
+        self._fd = None
+        self._buf.clear()
+        self._discarding = False
+
+    def _retry_later(self) -> None:
+        self._restart = Event(time.time() + self._backoff.delay(),
+                              _restart, self)
+        self._loop.schedule(self._restart)
+
+    def _restarted(self) -> None:
+        self._restart = None
+        self.start()
+
+    def _readable(self) -> None:
+        try:
+            data = os.read(self._fd, _READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            # The command exited or closed its output
+            self.stats.exits += 1
+            self._stop()
+            self._retry_later()
+            return
+        self.stats.bytes += len(data)
+        self._backoff.reset()
+        self._split(data)
+
+    def _split(self, data: bytes) -> None:
+        buf = self._buf
+        start = 0
+        end = data.find(b"\n")
+        while end >= 0:
+            if self._discarding:
+                self._discarding = False
+            elif len(buf) + end - start > self._max_line:
+                self.stats.overflows += 1
+            else:
+                buf += data[start:end]
+                self.stats.lines += 1
+                line = bytes(buf).rstrip(b"\r")
+                self._on_line(line)
+            buf.clear()
+            start = end + 1
+            end = data.find(b"\n", start)
+
+        if self._discarding:
+            return
+        buf += data[start:]
+        if len(buf) > self._max_line:
+            # Drop the rest of this line when it finally ends
+            self.stats.overflows += 1
+            self._discarding = True
+            buf.clear()
+
+
+def _restart(reader: ProcessReader) -> None:
+    reader._restarted()
@@ -0,0 +1,250 @@
+"""Typed sensor readings and their payload encoders.
+
+A sensor describes the shape of its readings with a tuple of Fields, and its
+fire() method returns a Reading holding one value per field, in the same
+order.  A value may be None if the field is absent from this reading.  The
+reading is then encoded by an encoder compiled once for the sensor's fields:
+
+  - json:    a JSON object, formatted from a template built for each
+             combination of present fields, so that every reading of a
+             sensor has the same field order and rounding; a NaN or
+             infinite value, which JSON cannot hold, is written as null
+  - binary:  a compact little-endian encoding for constrained links: a
+             bitmask of the fields present, then each present field packed
+             with a precompiled struct (numbers as 32-bit floats or
+             integers, JSON fields as a 16-bit length and UTF-8 text);
+             floats are rounded to their precision when decoded, and a
+             NaN or infinite value of an int field is left out
+
+Values of int fields are rounded to the nearest integer by both encoders.
+
+BinaryEncoder.decode() turns a binary payload back into a dict, for
+consumers that know the sensor's fields.
+"""
+
+import json
+import struct
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+ENCODINGS = ("json", "binary")
+"""The names of the payload encodings."""
+
+_KINDS = ("float", "int", "json")
+
+# Stands for a value to be written as null
+_NULL = object()
+
+
+class Field:
+    """A field of a sensor's readings."""
+
+    __slots__ = ("name", "kind", "precision", "code", "unit", "device_class",
+                 "state_class")
+
+    def __init__(self, name: str, kind: str = "float", precision: int = 1,
+                 code: Optional[str] = None, unit: Optional[str] = None,
+                 device_class: Optional[str] = None,
+                 state_class: Optional[str] = "measurement"):
+        """Describe a field.
+
+        kind is float (published rounded to precision decimal places), int,
+        or json (any JSON-serializable value).  code overrides the struct
+        format character used by the binary encoding for a float or int
+        field, which is f or i by default.  unit, device_class and
+        state_class describe the field to Home Assistant discovery.
+        """
+        if kind not in _KINDS:
+            raise Exception("unknown field kind %s" % kind)
+        self.name = name
+        self.kind = kind
+        self.precision = precision
+        self.code = code or ("f" if kind == "float" else "i")
+        self.unit = unit
+        self.device_class = device_class
+        self.state_class = state_class
+
+
+Fields = Tuple[Field, ...]
+
+
+class Reading:
+    """One reading from a sensor: a value for each of its fields."""
+
+    __slots__ = ("values", "time")
+
+    def __init__(self, *values: Any, time: Optional[float] = None):
+        self.values = values
+        """The values, in the order of the sensor's fields"""
+        self.time = time
+        """The monotonic time of the reading, if it is not now"""
+
+
+def encoding_parser(arg: str) -> str:
+    """Parse a payload encoding name."""
+    if arg not in ENCODINGS:
+        raise Exception("unknown encoding %s" % arg)
+    return arg
+
+
+def _numbers(fields: Fields, values: Sequence[Any], missing: Any,
+             floats: bool) -> Sequence[Any]:
+    # The values with int fields rounded, and NaN and infinite numbers of
+    # int fields, and of float fields if floats is set, replaced by missing;
+    # the values themselves if none needed changing
+    fixed: Optional[List[Any]] = None
+    for i, (field, value) in enumerate(zip(fields, values)):
+        if value is None or value.__class__ is int or field.kind == "json":
+            continue
+        if value - value:
+            if field.kind == "float" and not floats:
+                continue
+            # Only NaN and infinities are not zero less themselves
+            value = missing
+        elif field.kind == "int":
+            value = round(value)
+        else:
+            continue
+        if fixed is None:
+            fixed = list(values)
+        fixed[i] = value
+    return values if fixed is None else fixed
+
+
+def _floats(ints: Tuple[int, ...], values: Sequence[Any]) -> bool:
+    # Whether any of the int fields at positions ints has another value
+    for i in ints:
+        if values[i].__class__ is not int and values[i] is not None:
+            return True
+    return False
+
+
+class JSONEncoder:
+    """Encode readings of the given fields as JSON objects."""
+
+    def __init__(self, fields: Fields):
+        self._fields = fields
+        self._json = tuple(i for i, field in enumerate(fields)
+                           if field.kind == "json")
+        self._fragments = tuple(
+            '"%s":%s' % (field.name,
+                         "%%.%df" % field.precision if field.kind == "float"
+                         else "%d" if field.kind == "int" else "%s")
+            for field in fields)
+        self._nulls = tuple('"%s":null' % field.name for field in fields)
+        self._full = "{" + ",".join(self._fragments) + "}"
+        self._ints = tuple(i for i, field in enumerate(fields)
+                           if field.kind == "int")
+        # Whether a complete reading can be checked for NaN and infinities
+        # by looking for them in its encoding
+        self._scan = not self._json and not any(
+            "nan" in field.name or "inf" in field.name for field in fields)
+        # Templates by the state of each field: 0 if absent, 1 if present,
+        # or 2 if null
+        self._partial: Dict[Tuple[int, ...], str] = {}
+
+    def encode(self, values: Sequence[Any]) -> str:
+        """Encode a reading's values."""
+        if self._scan and None not in values and not _floats(self._ints,
+                                                             values):
+            encoded = self._full % tuple(values)
+            if "nan" not in encoded and "inf" not in encoded:
+                return encoded
+        values = _numbers(self._fields, values, _NULL, True)
+        if self._json:
+            values = list(values)
+            for i in self._json:
+                if values[i] is not None:
+                    values[i] = json.dumps(values[i],
+                                           separators=(",", ":"))
+        if None not in values and _NULL not in values:
+            return self._full % tuple(values)
+
+        states = tuple(0 if value is None else 2 if value is _NULL else 1
+                       for value in values)
+        template = self._partial.get(states)
+        if template is None:
+            template = self._partial[states] = "{" + ",".join(
+                fragment if state == 1 else null
+                for fragment, null, state
+                in zip(self._fragments, self._nulls, states) if state) + "}"
+        return template % tuple(value for value, state in zip(values, states)
+                                if state == 1)
+
+
+class BinaryEncoder:
+    """Encode readings of the given fields in the compact binary format."""
+
+    def __init__(self, fields: Fields):
+        if len(fields) > 32:
+            raise Exception("binary encoding is limited to 32 fields")
+        self._fields = fields
+        self._mask = "<" + ("B" if len(fields) <= 8 else
+                            "H" if len(fields) <= 16 else "I")
+        self._structs: Dict[int, struct.Struct] = {}
+        self._all = (1 << len(fields)) - 1
+        self._numeric = not any(field.kind == "json" for field in fields)
+        self._ints = tuple(i for i, field in enumerate(fields)
+                           if field.kind == "int")
+
+    def _struct(self, mask: int) -> struct.Struct:
+        # The struct for the numeric fields present in mask, with the mask
+        packer = self._structs.get(mask)
+        if packer is None:
+            codes = "".join(field.code for i, field in enumerate(self._fields)
+                            if mask & (1 << i) and field.kind != "json")
+            packer = self._structs[mask] = struct.Struct(self._mask + codes)
+        return packer
+
+    def encode(self, values: Sequence[Any]) -> bytes:
+        """Encode a reading's values."""
+        if _floats(self._ints, values):
+            values = _numbers(self._fields, values, None, False)
+        if self._numeric and None not in values:
+            return self._struct(self._all).pack(self._all, *values)
+        mask = 0
+        numbers = []
+        texts = []
+        for i, (field, value) in enumerate(zip(self._fields, values)):
+            if value is None:
+                continue
+            mask |= 1 << i
+            if field.kind == "json":
+                text = json.dumps(value, separators=(",", ":")).encode()
+                texts.append(struct.pack("<H", len(text)) + text)
+            else:
+                numbers.append(value)
+        data = self._struct(mask).pack(mask, *numbers)
+        if texts:
+            data += b"".join(texts)
+        return data
+
+    def decode(self, data: bytes) -> Dict[str, Any]:
+        """Decode a binary payload into a dict of the fields present."""
+        mask = struct.unpack_from(self._mask, data)[0]
+        packer = self._struct(mask)
+        numbers = iter(packer.unpack_from(data)[1:])
+        offset = packer.size
+        result: Dict[str, Any] = {}
+        for i, field in enumerate(self._fields):
+            if not mask & (1 << i):
+                continue
+            if field.kind == "json":
+                size = struct.unpack_from("<H", data, offset)[0]
+                offset += 2
+                result[field.name] = json.loads(data[offset:offset + size])
+                offset += size
+            elif field.kind == "float":
+                result[field.name] = round(next(numbers), field.precision)
+            else:
+                result[field.name] = next(numbers)
+        return result
+
+
+Encoder = Union[JSONEncoder, BinaryEncoder]
+
+
+def create_encoder(fields: Fields, encoding: str = "json") -> Encoder:
+    """Compile an encoder for readings of the given fields."""
+    if encoding == "binary":
+        return BinaryEncoder(fields)
+    return JSONEncoder(fields)
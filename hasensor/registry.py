@@ -2,12 +2,33 @@
 
 Sensors should be added to the registry using register_sensor_type(), and then
 created with create_sensor() using a sensor description string.
+
+A sensor type may also be registered lazily, by the path to its class, with
+register_lazy_sensor_type(); or by another package, through an entry point in
+the "hasensor.sensors" group.  The module providing a lazily registered type is
+imported only when create_sensor() first sees that type, so that a node does
+not pay for importing hardware libraries it does not use.
 """
-from typing import Any, Dict, Optional, Type
+import importlib
+import time
+from importlib import metadata
+from typing import Dict, Optional, Tuple, Type
 
 from .sensor import Sensor, type_args
 
+ENTRY_POINT_GROUP = "hasensor.sensors"
+"""The entry point group searched for sensor types."""
+
 _sensor_registry = {}                   # type: Dict[str, Type[Sensor]]
+# Lazily registered types, as "module:Class" paths
+_lazy_registry = {}                     # type: Dict[str, str]
+# Types found as entry points, not yet loaded
+_entry_points: Dict[str, metadata.EntryPoint] = {}
+_entry_points_loaded = False
+
+# (type name, import seconds, construction seconds) by sensor name; a sensor
+# created again on reload replaces its entry
+_startup_times: Dict[str, Tuple[str, float, float]] = {}
 
 
 def register_sensor_type(name: str, sensor: Type[Sensor]) -> None:
@@ -17,42 +38,133 @@ def register_sensor_type(name: str, sensor: Type[Sensor]) -> None:
     configuration.  The same sensor can be registered under more than
     one name, but it cannot tell under which name it was instantiated.
     """
-    if name in _sensor_registry:
+    if name in _sensor_registry or name in _lazy_registry \
+            or name in _entry_points:
         raise Exception("duplicate sensor definition")
     _sensor_registry[name] = sensor
 
 
-def create_sensor(desc: str) -> Sensor:
-    """Create a sensor from a description string.
+def register_lazy_sensor_type(name: str, path: str) -> None:
+    """Register a sensor type to be imported when it is first created.
 
-    The description string is of the form:
-      "name:bool_arg:arg=value"
+    The path names the sensor class as "module:Class", for example
+    "hasensor.sensors.bme280:BME280Sensor".
+    """
+    if name in _sensor_registry or name in _lazy_registry \
+            or name in _entry_points:
+        raise Exception("duplicate sensor definition")
+    _lazy_registry[name] = path
 
-    The sensor registered as type "name" will be looked up, and its class
-    used to construct the object.  The arguments will be split on the colons,
-    and separated into key=value pairs.  Keys without values will be passed
-    on with a None value, which will assumed to be a boolean that is True if
-    type allows.
+
+def _load_entry_points() -> None:
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+    eps = metadata.entry_points()
+    if hasattr(eps, "select"):
+        group = eps.select(group=ENTRY_POINT_GROUP)
+    else:
+        # Python before 3.10 returns a dict of groups
+        group = eps.get(ENTRY_POINT_GROUP, [])
+    for ep in group:
+        if ep.name not in _sensor_registry and ep.name not in _lazy_registry:
+            _entry_points.setdefault(ep.name, ep)
+
+
+def _sensor_type(name: str) -> Tuple[Type[Sensor], float]:
+    # Return the class for a sensor type, importing it if necessary, and the
+    # time spent importing it
+    if name in _sensor_registry:
+        return _sensor_registry[name], 0.0
+    if name not in _lazy_registry:
+        _load_entry_points()
+        if name not in _entry_points:
+            raise Exception("unknown sensor %s" % name)
+
+    start = time.perf_counter()
+    try:
+        if name in _lazy_registry:
+            module, _, clsname = _lazy_registry[name].partition(":")
+            sensorcls = getattr(importlib.import_module(module), clsname)
+        else:
+            sensorcls = _entry_points[name].load()
+    except (ImportError, NotImplementedError, RuntimeError) as err:
+        # Hardware libraries raise all sorts of things on the wrong platform
+        raise Exception("sensor %s is unavailable: %s" % (name, err))
+    elapsed = time.perf_counter() - start
+
+    _lazy_registry.pop(name, None)
+    _entry_points.pop(name, None)
+    _sensor_registry[name] = sensorcls
+    return sensorcls, elapsed
+
+
+def parse_description(desc: str) -> Tuple[str, Dict[str, Optional[str]]]:
+    """Split a sensor description string into its type and arguments.
+
+    Arguments without values are given a value of None.
     """
     name, *args = desc.split(':')
 
-    kwargs: Dict[str, Optional[Any]] = {}
+    kwargs: Dict[str, Optional[str]] = {}
     for arg in args:
         key, *val = arg.split('=', 1)
         if val:
             kwargs[key] = val[0]
         else:
             kwargs[key] = None
+    return name, kwargs
 
-    if name not in _sensor_registry:
-        raise Exception("unknown sensor %s" % name)
 
-    sensorcls = _sensor_registry[name]
-    kwargs = type_args(sensorcls, kwargs)
+def create_sensor(desc: str) -> Sensor:
+    """Create a sensor from a description string.
+
+    The description string is of the form:
+      "name:bool_arg:arg=value"
+
+    The sensor registered as type "name" will be looked up, and its class
+    used to construct the object.  The arguments will be split on the colons,
+    and separated into key=value pairs.  Keys without values will be passed
+    on with a None value, which will assumed to be a boolean that is True if
+    type allows.
+    """
+    name, args = parse_description(desc)
+
+    sensorcls, import_time = _sensor_type(name)
+    start = time.perf_counter()
+    kwargs = type_args(sensorcls, dict(args))
 
     # Making this type check requires making the argument types for
     # the defaulted arguments of Sensor optional types, which in turn
     # causes more pain; meanwhile, we don't even know that we're
     # calling this on Sensor itself (it could be a subclass).  I don't
     # know how to express this to Python typing.
-    return _sensor_registry[name](**kwargs)     # type: ignore
+    sensor = sensorcls(**kwargs)                # type: ignore
+    create_time = time.perf_counter() - start
+    previous = _startup_times.get(str(sensor.name))
+    if previous is not None and previous[0] == name:
+        # Keep the import time charged to the sensor when it was first created
+        import_time = max(import_time, previous[1])
+    _startup_times[str(sensor.name)] = (name, import_time, create_time)
+    return sensor
+
+
+def startup_report() -> str:
+    """Return a report of the time spent importing and creating each sensor.
+
+    Import time is charged to the first sensor of each lazily registered type.
+    A sensor created again by a reload is reported with its latest creation.
+    """
+    lines = ["%-20s %-12s %10s %10s" % ("sensor", "type", "import ms",
+                                         "create ms")]
+    for sensor, (sensortype, import_time,
+                 create_time) in _startup_times.items():
+        lines.append("%-20s %-12s %10.1f %10.1f"
+                     % (sensor, sensortype, import_time * 1000,
+                        create_time * 1000))
+    total_import = sum(t[1] for t in _startup_times.values())
+    total_create = sum(t[2] for t in _startup_times.values())
+    lines.append("%-20s %-12s %10.1f %10.1f" % ("total", "", total_import * 1000,
+                                                 total_create * 1000))
+    return "\n".join(lines)
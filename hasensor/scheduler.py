@@ -0,0 +1,300 @@
+"""Scheduler backends for the main loop.
+
+The loop hands every scheduled event to a scheduler, which hands events back
+when they are due.  Two backends are provided: a binary heap, which is exact
+and is the default, and a hierarchical timing wheel, which keeps insertion
+and expiry constant-time however many events are scheduled.  In CPython the
+heap's C implementation is still the faster of the two at every size that
+benchmarks.bench_scheduler measures, from ten events to a hundred thousand,
+so the wheel is only worth choosing where that no longer holds.
+
+Both backends fire events with equal next_fire times in the order they were
+scheduled.
+"""
+
+import math
+import time
+from heapq import heappush, heappop
+from itertools import count
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple, \
+    Type, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .event import Event
+
+# (next_fire, sequence, event); the sequence number breaks ties so that
+# events are never compared with each other.
+_Entry = Tuple[float, int, 'Event']
+
+
+class Scheduler:
+    """Base class for loop schedulers.
+
+    A scheduler holds events ordered by their next_fire time.  Events must
+    not have their next_fire time changed while they are scheduled.
+    """
+
+    def push(self, event: 'Event') -> None:
+        """Add an event to the schedule."""
+        raise NotImplementedError()
+
+    def pop_due(self, now: float) -> List['Event']:
+        """Remove and return all events due at or before now, in order."""
+        raise NotImplementedError()
+
+    def drain(self) -> List['Event']:
+        """Remove and return every event, in order."""
+        raise NotImplementedError()
+
+    def next_time(self) -> Optional[float]:
+        """Return when pop_due() should next be called, or None if empty.
+
+        A HeapScheduler gives the next event's next_fire time.  A
+        TimingWheelScheduler fires events up to one tick late, and may give
+        a time up to one tick after the next event's, or an earlier time at
+        which it has events to move between its levels.
+        """
+        raise NotImplementedError()
+
+    def __len__(self) -> int:
+        raise NotImplementedError()
+
+    def __iter__(self) -> Iterator['Event']:
+        raise NotImplementedError()
+
+
+class HeapScheduler(Scheduler):
+    """A scheduler backed by a binary heap.
+
+    Insertion and removal are O(log n), and events fire exactly in next_fire
+    order.  The heap holds only the distinct next_fire times, with the events
+    due at each kept in a dict, so that scheduling an event allocates nothing
+    for the garbage collector to track.
+    """
+
+    def __init__(self):
+        self._heap: List[float] = []
+        # The event due at each time in the heap, or a list of them in the
+        # order they were scheduled
+        self._due: Dict[float, Any] = {}
+
+    def push(self, event: 'Event') -> None:
+        when = event.next_fire
+        events = self._due.get(when)
+        if events is None:
+            self._due[when] = event
+            heappush(self._heap, when)
+        elif events.__class__ is list:
+            events.append(event)
+        else:
+            self._due[when] = [events, event]
+
+    def pop_due(self, now: float) -> List['Event']:
+        heap = self._heap
+        if not heap or heap[0] > now:
+            return []
+        events = self._due.pop(heappop(heap))
+        due = events if events.__class__ is list else [events]
+        while heap and heap[0] <= now:
+            events = self._due.pop(heappop(heap))
+            if events.__class__ is list:
+                due.extend(events)
+            else:
+                due.append(events)
+        return due
+
+    def drain(self) -> List['Event']:
+        return self.pop_due(math.inf)
+
+    def next_time(self) -> Optional[float]:
+        if not self._heap:
+            return None
+        return self._heap[0]
+
+    def __bool__(self) -> bool:
+        return bool(self._heap)
+
+    def __len__(self) -> int:
+        return sum(len(events) if events.__class__ is list else 1
+                   for events in self._due.values())
+
+    def __iter__(self) -> Iterator['Event']:
+        for events in self._due.values():
+            if events.__class__ is list:
+                yield from events
+            else:
+                yield events
+
+
+class TimingWheelScheduler(Scheduler):
+    """A scheduler backed by a hierarchical timing wheel.
+
+    Time is divided into ticks of a fixed resolution, and each of the wheel's
+    levels has 256 slots covering 256 times the span of the level below it.
+    Insertion appends to a slot and expiry empties a slot, both in constant
+    time; events are moved down a level (cascaded) at most once per level.
+    Events fire no earlier than their next_fire time, and at most one tick
+    late.  Events further out than the wheel's span are parked in the last
+    slot that it covers and re-filed as time advances.
+    """
+
+    _BITS = 8
+    _SLOTS = 1 << _BITS
+    _MASK = _SLOTS - 1
+    _LEVELS = 4
+    _FULL = (1 << _SLOTS) - 1
+
+    def __init__(self, resolution: float = 0.05,
+                 clock: Callable[[], float] = time.monotonic):
+        """Create an empty timing wheel.
+
+        The resolution is the length of one tick in seconds, and clock is
+        the time source used by the loop, which is consulted once to set the
+        wheel's starting point.
+        """
+        self._res = resolution
+        self._wheel: List[List[List[_Entry]]] = [
+            [[] for _ in range(self._SLOTS)] for _ in range(self._LEVELS)
+        ]
+        # A bitmap of the non-empty slots at each level
+        self._occupied = [0] * self._LEVELS
+        # Events that were overdue when they were scheduled
+        self._ready: List[_Entry] = []
+        self._seq = count()
+        self._len = 0
+        # All ticks before this one have been expired
+        self._tick = int(clock() / resolution)
+
+    def _file(self, entry: _Entry) -> None:
+        tick = math.ceil(entry[0] / self._res)
+        if tick < self._tick:
+            self._ready.append(entry)
+            return
+        level = ((tick - self._tick).bit_length() - 1) // self._BITS
+        if level >= self._LEVELS:
+            level = self._LEVELS - 1
+            tick = self._tick + (self._SLOTS << (level * self._BITS)) - 1
+        elif level < 0:
+            level = 0
+        index = (tick >> (level * self._BITS)) & self._MASK
+        self._wheel[level][index].append(entry)
+        self._occupied[level] |= 1 << index
+
+    def _take(self, level: int, index: int) -> List[_Entry]:
+        slot = self._wheel[level][index]
+        self._wheel[level][index] = []
+        self._occupied[level] &= ~(1 << index)
+        return slot
+
+    def _offset(self, level: int, index: int, start: int) -> int:
+        # The distance from index to the next occupied slot at this level,
+        # not counting index itself unless start is 0, or -1 if none.
+        bits = self._occupied[level]
+        if not bits:
+            return -1
+        rotated = ((bits >> index) | (bits << (self._SLOTS - index))) \
+            & self._FULL
+        if start:
+            if rotated == 1:
+                return self._SLOTS
+            rotated &= ~1
+        return (rotated & -rotated).bit_length() - 1
+
+    def _cascade(self) -> None:
+        # Called as self._tick crosses a level 0 boundary; every level whose
+        # lower digits are all zero has a slot to redistribute.
+        tick = self._tick
+        level = 1
+        while level < self._LEVELS:
+            index = (tick >> (level * self._BITS)) & self._MASK
+            if self._occupied[level] & (1 << index):
+                for entry in self._take(level, index):
+                    self._file(entry)
+            if index:
+                break
+            level += 1
+
+    def push(self, event: 'Event') -> None:
+        self._file((event.next_fire, next(self._seq), event))
+        self._len += 1
+
+    def pop_due(self, now: float) -> List['Event']:
+        due = self._ready
+        self._ready = []
+        # Allow for rounding when woken exactly at a tick from next_time()
+        target = int(now / self._res + 1e-6)
+        while self._tick <= target:
+            if not self._tick & self._MASK:
+                self._cascade()
+            stop = min((self._tick | self._MASK) + 1, target + 1)
+            offset = self._offset(0, self._tick & self._MASK, 0)
+            if offset < 0 or self._tick + offset >= stop:
+                # Nothing to expire before the next cascade
+                self._tick = stop
+                continue
+            self._tick += offset
+            due.extend(self._take(0, self._tick & self._MASK))
+            self._tick += 1
+
+        self._len -= len(due)
+        if len(due) > 1:
+            due.sort()
+        return [entry[2] for entry in due]
+
+    def drain(self) -> List['Event']:
+        entries = self._ready
+        self._ready = []
+        for level in range(self._LEVELS):
+            while self._occupied[level]:
+                bits = self._occupied[level]
+                entries.extend(self._take(level,
+                                          (bits & -bits).bit_length() - 1))
+        self._len = 0
+        entries.sort()
+        return [entry[2] for entry in entries]
+
+    def next_time(self) -> Optional[float]:
+        if not self._len:
+            return None
+        if self._ready:
+            return min(self._ready)[0]
+
+        best: Optional[float] = None
+        for level in range(self._LEVELS):
+            shift = level * self._BITS
+            current = self._tick >> shift
+            # Level 0 slots expire at their own tick; higher level slots are
+            # cascaded at the start of their span, which for the current
+            # slot has already passed unless we are sitting on it.
+            start = 0 if not self._tick & ((1 << shift) - 1) else 1
+            offset = self._offset(level, current & self._MASK, start)
+            if offset < 0:
+                continue
+            when = ((current + offset) << shift) * self._res
+            if best is None or when < best:
+                best = when
+        return best
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self) -> Iterator['Event']:
+        for entry in self._ready:
+            yield entry[2]
+        for level in self._wheel:
+            for slot in level:
+                for entry in slot:
+                    yield entry[2]
+
+
+_schedulers: Dict[str, Type[Scheduler]] = {
+    "heap": HeapScheduler,
+    "wheel": TimingWheelScheduler,
+}
+
+
+def create_scheduler(name: str) -> Scheduler:
+    """Create a scheduler by name ("heap" or "wheel")."""
+    if name not in _schedulers:
+        raise Exception("unknown scheduler %s" % name)
+    return _schedulers[name]()
@@ -1,19 +1,46 @@
 """The Sensor base class and associated helpers.
 
 New sensors should derive from Sensor, and may wish to use some of the
-helper functions provided here.
+helper functions provided here.  A sensor that declares the fields of its
+readings in _fields may return a Reading from fire(), which is encoded and
+published for it.
 """
-from typing import Any, Callable, Dict, List, Optional, Type, Union
+import inspect
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Type, \
+    Union
 
-from .event import Event, RepeatingEvent, NOW
-from .loop import Loop
+from .aggregate import Aggregator, agg_parser
+from .event import Event, RepeatingEvent, MISSED_POLICIES, NOW
+from .filters import FilterPipeline, FilterSpec, filter_parser
+from .loop import Loop, Recorder
+from .reading import BinaryEncoder, Encoder, Field, Fields, Reading, \
+    create_encoder, encoding_parser
 
 ArgDict = Dict[str, Union[Type, Callable[[str], Any]]]
 
 
-def _sensor_callback(sensor: Optional['Sensor']) -> None:
+def _sensor_callback(sensor: Optional['Sensor']) -> Any:
     if sensor is not None:
-        sensor.fire()
+        return sensor.read()
+    return None
+
+
+def _threaded_sensor_callback(sensor: Optional['Sensor']) -> None:
+    if sensor is not None and sensor._loop is not None:
+        sensor._loop.submit(sensor.key, sensor.read, sensor.deadline,
+                            sensor.inflight)
+
+
+def _window_callback(sensor: Optional['Sensor']) -> None:
+    if sensor is not None:
+        sensor._close_window()      # pylint: disable=protected-access
+
+
+async def _publish_awaited(sensor: 'Sensor', result: Any) -> None:
+    reading = await result
+    if isinstance(reading, Reading):
+        sensor.publish_reading(reading)
 
 
 def hexint_parser(arg: str) -> int:
@@ -23,6 +50,13 @@ def hexint_parser(arg: str) -> int:
     return int(arg, 16)
 
 
+def missed_parser(arg: str) -> str:
+    """Parse a missed-tick policy name."""
+    if arg not in MISSED_POLICIES:
+        raise Exception("Received unknown missed-tick policy %s" % arg)
+    return arg
+
+
 def time_parser(arg: str) -> float:
     """Parse a start time as either NOW or a float into a float."""
     if arg == "NOW":
@@ -71,31 +105,116 @@ class Sensor:
     be scheduled, but when it fires it does nothing but print a diagnostic.
     """
 
+    _fields: Fields = ()
+    """The fields of the Readings returned by fire(), if it returns them."""
+
+    _component: Optional[str] = "sensor"
+    """The Home Assistant component of a sensor without fields, if any.
+
+    Such a sensor is announced to discovery as one entity whose state is
+    the whole payload.
+    """
+
     _argtypes: ArgDict = {
         'name': str,
         'start': time_parser,
-        'period': float
+        'period': float,
+        'missed': missed_parser,
+        'threaded': bool,
+        'deadline': float,
+        'inflight': int,
+        'qos': int,
+        'retain': bool,
+        'sample': float,
+        'window': float,
+        'agg': agg_parser,
+        'filter': filter_parser,
+        'heartbeat': float,
+        'encoding': encoding_parser
     }
 
     def __init__(self, name: Optional[str] = "Sensor",
-                 start: float = NOW, period: float = 0.0):
+                 start: float = NOW, period: float = 0.0,
+                 missed: str = "once", threaded: bool = False, deadline: float = 10.0,
+                 inflight: int = 1, qos: int = 0, retain: bool = False,
+                 sample: float = 0.0, window: float = 0.0,
+                 agg: Optional[List[str]] = None,
+                 filter: Optional[List[FilterSpec]] = None,
+                 heartbeat: float = 0.0, encoding: str = "json"):
         """Initialize a new Sensor with a schedule.
 
         keyword arguments:
-          - name:   The name of this sensor (typically used as its MQTT
-                    subtopic, but this base class does not use it)
-          - start:  The time of the first firing of this sensor's event
-          - period: The period of this sensor's event
+          - name:     The name of this sensor (typically used as its MQTT
+                      subtopic, but this base class does not use it)
+          - start:    The time of the first firing of this sensor's event
+          - period:   The period of this sensor's event
+          - missed:   What to do when the event falls whole periods behind
+          - threaded: Whether to fire this sensor on a worker thread
+          - deadline: The time allowed for a threaded read (seconds)
+          - inflight: The maximum number of concurrent threaded reads
+          - qos:      The MQTT QoS level for this sensor's messages
+          - retain:   Whether the broker should retain this sensor's messages
+          - sample:   The period at which to take readings, if they are
+                      aggregated (replaces period)
+          - window:   The period over which readings are aggregated before
+                      one summary is published (seconds; 0 publishes every
+                      reading)
+          - agg:      The aggregates to publish for each window
+          - filter:   The filters applied to readings before they are
+                      published or aggregated
+          - heartbeat: The longest time for which filters may suppress
+                      readings (seconds; 0 for no limit)
+          - encoding: The payload encoding for Readings, json or binary
         """
+        # pylint: disable=redefined-builtin
         self.name = name
         self.start = start
         self.period = period
+        self.missed = missed
+        self.threaded = threaded
+        self.deadline = deadline
+        self.inflight = inflight
+        self.qos = qos
+        self.retain = retain
+        self.sample = sample
+        self._filters: Optional[FilterPipeline] = None
+        if filter:
+            self._filters = FilterPipeline(filter, heartbeat)
+        self._aggregator: Optional[Aggregator] = None
+        self.aggregates: List[str] = []
+        """The aggregates published for each window, if aggregating"""
+        if window:
+            self.aggregates = agg or ["mean"]
+            self._aggregator = Aggregator(window, self.aggregates)
+        if encoding == "binary" and window:
+            raise Exception("binary encoding cannot be aggregated")
+        self._encoder: Optional[Encoder] = None
+        if self._fields:
+            self._encoder = create_encoder(self._fields, encoding)
         self._event: Optional[Event] = None
+        # The event closing the aggregation window, once one is open
+        self._window_event: Optional[Event] = None
         self._loop: Optional[Loop] = None
+        self.topic = name
+        """The topic on which this sensor publishes, once it has a loop"""
+        self.key = name
+        """The name of this sensor in its loop's metrics and worker limits"""
+        # Where this sensor's readings are recorded, other than published
+        self._recorders: List[Recorder] = []
+
+    def set_loop(self, loop: Loop, prefix: Optional[str] = None) -> None:
+        """Set the event loop that this sensor will be scheduled on.
 
-    def set_loop(self, loop: Loop) -> None:
-        """Set the event loop that this sensor will be scheduled on."""
+        The sensor publishes under prefix, or under the loop's prefix if none
+        is given.  The sensors of a gateway's nodes share one loop, each
+        under its node's prefix, and are told apart by topic.
+        """
         self._loop = loop
+        self.topic = "%s/%s" % (prefix or loop.prefix, self.name)
+        if prefix is not None:
+            self.key = self.topic
+        if self._fields:
+            self._recorders = loop.recorders(prefix)
 
     def event(self) -> Event:
         """Create or retrieve an event that will fire this sensor."""
@@ -104,13 +223,150 @@ class Sensor:
         if self._loop is None:
             raise Exception("Cannot retrieve sensor event without a loop")
 
-        if self.period == 0.0:
-            self._event = Event(self.start, _sensor_callback, self)
+        callback = _threaded_sensor_callback if self.threaded \
+            else _sensor_callback
+        period = self.sample or self.period
+        if period == 0.0:
+            self._event = Event(self.start, callback, self)
         else:
-            self._event = RepeatingEvent(self.start, self.period,
-                                         _sensor_callback, self)
+            self._event = RepeatingEvent(self.start, period,
+                                         callback, self, self.missed)
+        self._event.name = self.key
         return self._event
 
-    def fire(self) -> None:
-        """The method called by this sensor's event, to be overridden."""
+    def set_schedule(self, start: float = NOW, period: float = 0.0,
+                     missed: str = "once") -> None:
+        """Change this sensor's schedule.
+
+        Any existing event for this sensor is cancelled; the caller should
+        schedule the new event().
+        """
+        if self._event is not None and self._loop is not None:
+            self._loop.cancel(self._event)
+        self._event = None
+        self.start = start
+        self.period = period
+        self.missed = missed
+
+    def close(self) -> None:
+        """Stop this sensor and release its resources.
+
+        This is called when the sensor is removed from a running node, for
+        example because it was removed from the configuration.  Subclasses
+        that hold processes, threads or devices should release them, and
+        call this method.
+        """
+        if self._event is not None and self._loop is not None:
+            self._loop.cancel(self._event)
+        self._event = None
+        if self._window_event is not None and self._loop is not None:
+            self._loop.cancel(self._window_event)
+        self._window_event = None
+        for recorder in self._recorders:
+            recorder.forget(self.topic)
+
+    def discovery_fields(self) -> List[Field]:
+        """Return the fields to announce to Home Assistant discovery.
+
+        These are the numeric fields of JSON readings; a sensor that
+        publishes somewhere other than its own topic should return none.
+        """
+        if isinstance(self._encoder, BinaryEncoder):
+            return []
+        return [field for field in self._fields if field.kind != "json"]
+
+    def publish(self, data: Union[str, bytes],
+                when: Optional[float] = None) -> None:
+        """Publish a reading on this sensor's topic.
+
+        when is the monotonic time the reading was taken, if not now.
+        """
+        if self._loop is None:
+            raise Exception("Cannot publish without a loop")
+        if when is None:
+            when = time.monotonic()
+        if self._filters is not None:
+            filtered = self._filters.process(data, when)
+            if filtered is None:
+                return
+            data = filtered
+        self._aggregate(data, when)
+
+    def _aggregate(self, data: Union[str, bytes], when: float) -> None:
+        # Publish a filtered reading, or its window's summary
+        if self._aggregator is not None:
+            summary = self._aggregator.add(data, when)
+            if self._window_event is None:
+                # Readings may be taken on worker threads
+                self._loop.post(self._schedule_window)
+            if summary is None:
+                return
+            data = summary
+        self._loop.publish_raw(self.topic, data, self.qos, self.retain)
+
+    def _schedule_window(self) -> None:
+        # Schedule the closing of the open aggregation window, on the loop
+        if self._window_event is not None or self._loop is None:
+            return
+        end = self._aggregator.window_end()
+        if end is None:
+            return
+        self._window_event = Event(NOW, _window_callback, self)
+        self._window_event.next_fire = end
+        self._loop.schedule(self._window_event)
+
+    def _close_window(self) -> None:
+        # Publish the summary of a window that has ended
+        self._window_event = None
+        summary = self._aggregator.close(time.monotonic())
+        if summary is not None:
+            self._loop.publish_raw(self.topic, summary, self.qos, self.retain)
+        self._schedule_window()
+
+    def publish_reading(self, reading: Reading) -> None:
+        """Encode a reading with this sensor's encoder and publish it.
+
+        The reading is then recorded by the loop's recorders, such as its
+        history and store, if it has any.
+        """
+        if self._encoder is None:
+            raise Exception("Sensor %s does not declare its fields"
+                            % self.name)
+        if self._filters is None and self._aggregator is None:
+            self._loop.publish_raw(self.topic,
+                                   self._encoder.encode(reading.values),
+                                   self.qos, self.retain)
+        else:
+            when = reading.time
+            if when is None:
+                when = time.monotonic()
+            values: Optional[Sequence[Any]] = reading.values
+            if self._filters is not None:
+                # Filter the values, so that the encoder rounds the result
+                values = self._filters.filter(self._fields, values, when)
+            if values is not None:
+                self._aggregate(self._encoder.encode(values), when)
+        for recorder in self._recorders:
+            recorder.record(self.topic, self._fields, reading.values,
+                            reading.time)
+
+    def read(self) -> Any:
+        """Fire this sensor, publishing the Reading fire() returns, if any.
+
+        Returns what fire() returned otherwise, such as an awaitable.
+        """
+        result = self.fire()
+        if isinstance(result, Reading):
+            self.publish_reading(result)
+            return None
+        if inspect.isawaitable(result) and self._fields:
+            return _publish_awaited(self, result)
+        return result
+
+    def fire(self) -> Any:
+        """The method called by this sensor's event, to be overridden.
+
+        Sensors run on an AsyncLoop may instead define fire() as a
+        coroutine (async def fire()), which the loop runs as a task.
+        """
         print("Firing base Sensor event for %s", self.name)
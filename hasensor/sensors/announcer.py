@@ -2,6 +2,9 @@ from ..sensor import ArgDict, Sensor
 
 
 class Announcer(Sensor):
+    # The node's own Online entity covers the usual announcer
+    _component = None
+
     _argtypes: ArgDict = {
         "value": str
     }
@@ -12,4 +15,4 @@ class Announcer(Sensor):
         self._value = value
 
     def fire(self):
-        self._loop.publish(self.name, self._value)
+        self.publish(self._value)
@@ -1,27 +1,237 @@
-from typing import Optional
-
-import board
-import busio
-import adafruit_bme280
+import struct
+import time
+from typing import Any, Optional, Tuple
 
+from ..event import Event
+from ..i2cbus import shared_bus
+from ..reading import Field, Fields, Reading
 from ..sensor import ArgDict, Sensor, hexint_parser
 
+_CHIP_ID = 0x60
+
+_REG_CALIB_TP = 0x88            # through 0xA1, including dig_H1
+_REG_CHIP_ID = 0xD0
+_REG_RESET = 0xE0
+_REG_CALIB_H = 0xE1
+_REG_CTRL_HUM = 0xF2
+_REG_STATUS = 0xF3
+_REG_CTRL_MEAS = 0xF4
+_REG_CONFIG = 0xF5
+_REG_DATA = 0xF7                # through 0xFE: pressure, temperature, humidity
+
+_MODE_FORCED = 0x01
+_STATUS_MEASURING = 0x08
+
+# Register codes for each oversampling ratio and IIR filter coefficient
+_OVERSAMPLING = {0: 0, 1: 1, 2: 2, 4: 3, 8: 4, 16: 5}
+_IIR = {0: 0, 2: 1, 4: 2, 8: 3, 16: 4}
+
+
+def oversampling_parser(arg: str) -> int:
+    value = int(arg)
+    if value not in _OVERSAMPLING:
+        raise Exception("oversampling must be one of 0, 1, 2, 4, 8 or 16")
+    return value
+
+
+def iir_parser(arg: str) -> int:
+    value = int(arg)
+    if value not in _IIR:
+        raise Exception("iir must be one of 0, 2, 4, 8 or 16")
+    return value
+
+
+class BME280:
+    """A BME280 driven in forced mode.
+
+    Each measurement is triggered by start(), and once it is complete,
+    collect() reads every result register in a single burst, so a reading
+    costs three bus transactions plus any status polls, and the chip sleeps
+    between readings.
+    """
+
+    def __init__(self, i2c: Any, address: int = 0x77,
+                 oversample_temp: int = 1, oversample_pressure: int = 16,
+                 oversample_humidity: int = 1, iir: int = 0):
+        self._i2c = i2c
+        self._address = address
+        self._osrs = (oversample_temp, oversample_pressure,
+                      oversample_humidity)
+
+        chip_id = self._read(_REG_CHIP_ID, 1)[0]
+        if chip_id != _CHIP_ID:
+            raise Exception("no BME280 at 0x%02x (chip ID 0x%02x)"
+                            % (address, chip_id))
+        self._write(_REG_RESET, 0xB6)
+        time.sleep(0.004)
+        self._read_calibration()
+
+        # ctrl_hum only takes effect on the next write to ctrl_meas
+        self._write(_REG_CTRL_HUM, _OVERSAMPLING[oversample_humidity])
+        self._write(_REG_CONFIG, _IIR[iir] << 2)
+        self._ctrl_meas = _OVERSAMPLING[oversample_temp] << 5 \
+            | _OVERSAMPLING[oversample_pressure] << 2 | _MODE_FORCED
+        # The maximum measurement time, from the datasheet
+        self._measure_time = (1.25 + 2.3 * oversample_temp
+                              + (2.3 * oversample_pressure + 0.575
+                                 if oversample_pressure else 0)
+                              + (2.3 * oversample_humidity + 0.575
+                                 if oversample_humidity else 0)) / 1000.0
+
+    def _read(self, register: int, length: int) -> bytearray:
+        buf = bytearray(length)
+        while not self._i2c.try_lock():
+            pass
+        try:
+            self._i2c.writeto_then_readfrom(self._address, bytes([register]),
+                                            buf)
+        finally:
+            self._i2c.unlock()
+        return buf
+
+    def _write(self, register: int, value: int) -> None:
+        while not self._i2c.try_lock():
+            pass
+        try:
+            self._i2c.writeto(self._address, bytes([register, value]))
+        finally:
+            self._i2c.unlock()
+
+    def _read_calibration(self) -> None:
+        coeff = self._read(_REG_CALIB_TP, 26)
+        values = struct.unpack_from("<HhhHhhhhhhhh", coeff)
+        self._temp_calib = [float(v) for v in values[:3]]
+        self._pressure_calib = [float(v) for v in values[3:]]
+
+        h2, h3, e4, e5, e6, h6 = struct.unpack("<hBbBbb",
+                                               self._read(_REG_CALIB_H, 7))
+        self._humidity_calib = [float(coeff[25]), float(h2), float(h3),
+                                float((e4 << 4) | (e5 & 0xF)),
+                                float((e6 << 4) | (e5 >> 4)), float(h6)]
+
+    def start(self) -> float:
+        """Trigger a measurement, returning the seconds it will take."""
+        self._write(_REG_CTRL_MEAS, self._ctrl_meas)
+        return self._measure_time
+
+    def read(self) -> Tuple[float, Optional[float], Optional[float]]:
+        """Take one measurement, sleeping while the chip measures."""
+        time.sleep(self.start())
+        return self.collect()
+
+    def collect(self) -> Tuple[float, Optional[float], Optional[float]]:
+        """Read the result of the measurement triggered by start().
+
+        Returns the temperature (C), pressure (hPa) and humidity (%RH);
+        pressure or humidity is None if its oversampling is 0.
+        """
+        while self._read(_REG_STATUS, 1)[0] & _STATUS_MEASURING:
+            time.sleep(0.001)
+        data = self._read(_REG_DATA, 8)
+
+        adc_p = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
+        adc_t = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
+        adc_h = (data[6] << 8) | data[7]
+        t_fine = self._t_fine(adc_t)
+        pressure = self._pressure(adc_p, t_fine) if self._osrs[1] else None
+        humidity = self._humidity(adc_h, t_fine) if self._osrs[2] else None
+        return t_fine / 5120.0, pressure, humidity
+
+    # Compensation formulas from the Bosch BME280 driver, in floating point
+
+    def _t_fine(self, adc: int) -> float:
+        t1, t2, t3 = self._temp_calib
+        var1 = (adc / 16384.0 - t1 / 1024.0) * t2
+        var2 = (adc / 131072.0 - t1 / 8192.0) ** 2 * t3
+        return var1 + var2
+
+    def _pressure(self, adc: int, t_fine: float) -> float:
+        p1, p2, p3, p4, p5, p6, p7, p8, p9 = self._pressure_calib
+        var1 = t_fine / 2.0 - 64000.0
+        var2 = var1 * var1 * p6 / 32768.0
+        var2 = var2 + var1 * p5 * 2.0
+        var2 = var2 / 4.0 + p4 * 65536.0
+        var1 = (p3 * var1 * var1 / 524288.0 + p2 * var1) / 524288.0
+        var1 = (1.0 + var1 / 32768.0) * p1
+        if var1 == 0.0:
+            raise Exception("invalid BME280 pressure calibration")
+        pressure = 1048576.0 - adc
+        pressure = (pressure - var2 / 4096.0) * 6250.0 / var1
+        var1 = p9 * pressure * pressure / 2147483648.0
+        var2 = pressure * p8 / 32768.0
+        pressure = pressure + (var1 + var2 + p7) / 16.0
+        return pressure / 100.0
+
+    def _humidity(self, adc: int, t_fine: float) -> float:
+        h1, h2, h3, h4, h5, h6 = self._humidity_calib
+        var = t_fine - 76800.0
+        var = (adc - (h4 * 64.0 + h5 / 16384.0 * var)) \
+            * (h2 / 65536.0 * (1.0 + h6 / 67108864.0 * var
+                               * (1.0 + h3 / 67108864.0 * var)))
+        var = var * (1.0 - h1 * var / 524288.0)
+        return min(max(var, 0.0), 100.0)
+
 
 class BME280Sensor(Sensor):
+    _fields: Fields = (
+        Field("temp", unit="°C", device_class="temperature"),
+        Field("humidity", unit="%", device_class="humidity"),
+        Field("pressure", precision=2, unit="hPa", device_class="pressure"))
+
     _argtypes: ArgDict = {
-        "address": hexint_parser
+        "address": hexint_parser,
+        "scl": str,
+        "sda": str,
+        "oversample_temp": oversampling_parser,
+        "oversample_pressure": oversampling_parser,
+        "oversample_humidity": oversampling_parser,
+        "iir": iir_parser
     }
 
-    def __init__(self, address: Optional[int] = 0x77, **kwargs):
+    def __init__(self, address: Optional[int] = 0x77,
+                 scl: Optional[str] = "SCL", sda: Optional[str] = "SDA",
+                 oversample_temp: Optional[int] = 1,
+                 oversample_pressure: Optional[int] = 16,
+                 oversample_humidity: Optional[int] = 1,
+                 iir: Optional[int] = 0,
+                 **kwargs):
         super().__init__(**kwargs)
 
-        i2c = busio.I2C(board.SCL, board.SDA)
-        self._bme280 = adafruit_bme280.Adafruit_BME280_I2C(i2c, address=address)
+        if not oversample_temp:
+            raise Exception("temperature oversampling cannot be 0")
+        self._bus = shared_bus(scl, sda)
+        with self._bus.transaction() as i2c:
+            self._bme280 = BME280(i2c, address, oversample_temp,
+                                  oversample_pressure, oversample_humidity,
+                                  iir)
+
+        self._collect_event: Optional[Event] = None
 
     def fire(self):
-        temp = self._bme280.temperature
-        humidity = self._bme280.humidity
-        pressure = self._bme280.pressure
-        self._loop.publish(self.name,
-                           '{"temp":%.01f,"humidity":%.01f,"pressure":%.02f}'
-                           % (temp, humidity, pressure))
+        with self._bus.transaction(self._loop):
+            delay = self._bme280.start()
+        if self._loop.on_loop_thread():
+            # Collect the result once the chip is done, rather than
+            # holding up the loop while it measures
+            self._collect_event = Event(time.time() + delay, _collect, self)
+            self._loop.schedule(self._collect_event)
+        else:
+            time.sleep(delay)
+            return self._collect()
+        return None
+
+    def close(self):
+        if self._collect_event is not None:
+            self._loop.cancel(self._collect_event)
+            self._collect_event = None
+        super().close()
+
+    def _collect(self) -> Reading:
+        self._collect_event = None
+        with self._bus.transaction(self._loop):
+            temp, pressure, humidity = self._bme280.collect()
+        return Reading(temp, humidity, pressure)
+
+
+def _collect(sensor: BME280Sensor) -> None:
+    sensor.publish_reading(sensor._collect())
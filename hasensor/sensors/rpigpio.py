@@ -1,3 +1,4 @@
+import time
 from typing import Optional
 
 import RPi.GPIO as GPIO
@@ -6,6 +7,8 @@ from ..sensor import ArgDict, Sensor
 
 
 class RPiGPIOSensor(Sensor):
+    _component = "binary_sensor"
+
     _argtypes: ArgDict = {
         'pin': int,
         'debounce': int,
@@ -22,6 +25,13 @@ class RPiGPIOSensor(Sensor):
         self._debounce = debounce
         self._power = power
         self._inverted = inverted
+        # The time of the first edge not yet published, set on the GPIO
+        # callback thread and cleared on the loop
+        self._edge_time: Optional[float] = None
+        self.edges = 0
+        """The number of edges detected"""
+        self.coalesced = 0
+        """The number of edges folded into another edge's publish"""
 
         GPIO.setmode(GPIO.BCM)
 
@@ -44,12 +54,28 @@ class RPiGPIOSensor(Sensor):
         pass
 
     def _state(self, state):
-        print(state)
         if (state and not self._inverted) or (not state and self._inverted):
             return "ON"
         return "OFF"
 
     def _detect(self, pin):
+        # Runs on RPi.GPIO's callback thread; a burst of edges arriving
+        # before the loop gets to them is published as one state
         del pin
-        state = self._state(GPIO.input(self._pin))
-        self._loop.publish(self.name, state)
+        if self._loop is None:
+            return
+        self.edges += 1
+        if self._edge_time is not None:
+            self.coalesced += 1
+            return
+        self._edge_time = time.monotonic()
+        self._loop.post(self._publish_state)
+
+    def _publish_state(self):
+        edge_time = self._edge_time
+        # Clear before reading, so that an edge from here on posts again
+        self._edge_time = None
+        self.publish(self._state(GPIO.input(self._pin)))
+        metrics = self._loop.metrics
+        if metrics is not None and edge_time is not None:
+            metrics.latency(self.key, time.monotonic() - edge_time)
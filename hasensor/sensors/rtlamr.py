@@ -1,55 +1,254 @@
 import json
+import time
+from typing import Dict, List, Optional, Set, Tuple
 
-from subprocess import Popen, DEVNULL, PIPE
-from threading import Thread
-from typing import Optional
-
+from ..loop import Loop
+from ..procreader import ProcessReader
+from ..reading import Field, Fields, Reading
 from ..sensor import Sensor, ArgDict
 
+DEF_SERVER = "127.0.0.1:1234"
+
+
+class DecodeStats:
+    __slots__ = ("decoded", "errors", "ignored")
+
+    def __init__(self):
+        self.decoded = 0
+        """Lines that were consumption messages"""
+        self.errors = 0
+        """Lines that were not valid JSON"""
+        self.ignored = 0
+        """Valid lines that were not consumption messages"""
+
+
+class MeterStats:
+    __slots__ = ("messages", "first", "last")
+
+    def __init__(self, now: float):
+        self.messages = 0
+        """Consumption messages received from this meter"""
+        self.first = now
+        self.last = now
+
+    def rate(self) -> float:
+        """Return the meter's message rate, in messages per minute."""
+        if self.messages < 2 or self.last <= self.first:
+            return 0.0
+        return (self.messages - 1) * 60.0 / (self.last - self.first)
+
+
+class _Decoder:
+    # One rtlamr process for one rtl_tcp server, shared by every sensor
+    # watching a meter through that server
+
+    def __init__(self, loop: Loop, server: str):
+        self.server = server
+        self.symbol_length = 0
+        """The symbol length asked for by the decoder's sensors, if any"""
+        self.stats = DecodeStats()
+        self.meters: Dict[int, MeterStats] = {}
+        """Statistics for every meter heard, by ID"""
+        self._loop = loop
+        # Every sensor using the decoder, and those that have fired by meter
+        self._users: List['RTLAMRSensor'] = []
+        self._sensors: Dict[int, List['RTLAMRSensor']] = {}
+        self._reader: Optional[ProcessReader] = None
+        self._running: Optional[List[str]] = None
+        self._dirty = False
+
+    def _args(self) -> List[str]:
+        args = ["rtlamr", "-format", "json", "-server", self.server]
+        # A sensor for meter 0 wants every meter
+        if 0 not in self._sensors:
+            args.append("-filterid")
+            args.append(",".join(str(meter)
+                                 for meter in sorted(self._sensors)))
+        if self.symbol_length:
+            args.append("-symbollength")
+            args.append(str(self.symbol_length))
+        return args
+
+    def _changed(self) -> None:
+        # Sensors starting together, or added by one reload, restart rtlamr
+        # once rather than once each
+        if not self._dirty:
+            self._dirty = True
+            self._loop.post(self._refilter)
+
+    def _refilter(self) -> None:
+        # Restart rtlamr if the meters it should decode have changed
+        self._dirty = False
+        args = self._args() if self._sensors else None
+        if args == self._running:
+            return
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        self._running = args
+        if args is not None:
+            self._reader = ProcessReader(self._loop, args, self._handle_line)
+            self._reader.start()
+
+    def claim(self, sensor: 'RTLAMRSensor') -> None:
+        """Reserve the decoder for a sensor that will be added when it fires.
+
+        Raises an exception if the sensor asks for a symbol length other than
+        one another sensor of the decoder has asked for.
+        """
+        if sensor.symbol_length:
+            if self.symbol_length \
+                    and sensor.symbol_length != self.symbol_length:
+                raise Exception("conflicting symbol lengths for rtlamr "
+                                "server %s" % self.server)
+            self.symbol_length = sensor.symbol_length
+        self._users.append(sensor)
+
+    def add(self, sensor: 'RTLAMRSensor') -> None:
+        self._sensors.setdefault(sensor.meter_id, []).append(sensor)
+        self._changed()
+
+    def remove(self, sensor: 'RTLAMRSensor') -> bool:
+        # Returns True if no sensors remain
+        sensors = self._sensors.get(sensor.meter_id, [])
+        if sensor in sensors:
+            sensors.remove(sensor)
+            if not sensors:
+                del self._sensors[sensor.meter_id]
+        if sensor in self._users:
+            self._users.remove(sensor)
+        self.symbol_length = next((user.symbol_length for user in self._users
+                                   if user.symbol_length), 0)
+        if not self._users:
+            if self._reader is not None:
+                self._reader.close()
+                self._reader = None
+            self._running = None
+            return True
+        self._changed()
+        return False
+
+    def _handle_line(self, line: bytes) -> None:
+        try:
+            info = json.loads(line)
+        except ValueError:
+            self.stats.errors += 1
+            return
+        message = info.get('Message') if isinstance(info, dict) else None
+        if not isinstance(message, dict) \
+                or 'ID' not in message or 'Consumption' not in message:
+            self.stats.ignored += 1
+            return
+
+        self.stats.decoded += 1
+        meter, consumption = message['ID'], message['Consumption']
+        now = time.monotonic()
+        stats = self.meters.get(meter)
+        if stats is None:
+            stats = self.meters[meter] = MeterStats(now)
+        stats.messages += 1
+        stats.last = now
+
+        for sensor in self._sensors.get(meter, ()):
+            sensor.reading(meter, consumption)
+        for sensor in self._sensors.get(0, ()):
+            sensor.reading(meter, consumption)
+
+
+_decoders: Dict[Tuple[Loop, str], _Decoder] = {}
+
+
+def _decoder(loop: Loop, server: str) -> _Decoder:
+    decoder = _decoders.get((loop, server))
+    if decoder is None:
+        decoder = _decoders[(loop, server)] = _Decoder(loop, server)
+    return decoder
+
 
 class RTLAMRSensor(Sensor):
+    _fields: Fields = (
+        Field("id", "int", code="I", state_class=None),
+        Field("kWh", "int", code="I", unit="kWh", device_class="energy",
+              state_class="total_increasing"))
+
     _argtypes: ArgDict = {
         "meter_id": int,
-        "symbol_length": int
+        "symbol_length": int,
+        "server": str
     }
 
-    _rtl: Popen
-    _thread: Thread
-
     def __init__(self, meter_id: Optional[int] = 0,
                  symbol_length: Optional[int] = 0,
+                 server: str = DEF_SERVER,
                  **kwargs):
         super().__init__(**kwargs)
 
-        rtlargs = ["rtlamr", "-unique", "-format", "json"]
-        if meter_id:
-            rtlargs.append("-filterid")
-            rtlargs.append(str(meter_id))
-        if symbol_length:
-            rtlargs.append("-symbollength")
-            rtlargs.append(str(symbol_length))
+        self.meter_id = meter_id or 0
+        self.symbol_length = symbol_length or 0
+        self._server = server
+        self._decoder: Optional[_Decoder] = None
+        self._joined = False
+        self.duplicates = 0
+        """Readings suppressed as repeats of the meter's last reading"""
+        # The last consumption reported by each meter
+        self._last: Dict[int, int] = {}
 
-        self._rtl = Popen(rtlargs, stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL,
-                          close_fds=True)
-        self._thread = Thread(target=self._handle_rtl)
-        self._thread.start()
+    def set_loop(self, loop: Loop, prefix: Optional[str] = None) -> None:
+        # Claim the shared decoder now, so that a conflict with the other
+        # sensors on the server fails the sensor's creation
+        self._release()
+        super().set_loop(loop, prefix)
+        decoder = _decoder(loop, self._server)
+        decoder.claim(self)
+        self._decoder = decoder
+        self._joined = False
 
     def fire(self):
-        pass
-
-    def _handle_rtl(self):
-        while True:
-            try:
-                packet = self._rtl.stdout.readline()
-                if not packet:
-                    continue
-                info = json.loads(packet)
-            except OSError:
-                self._rtl.kill()
-                return
-            if 'Message' in info:
-                message = info['Message']
-                if 'ID' in message and 'Consumption' in message:
-                    self._loop.publish(self.name, '{"id":%d,"kWh":%d}'
-                                       % (message['ID'],
-                                          message['Consumption']))
+        # Join the shared decoder on the first firing
+        if self._decoder is not None and not self._joined:
+            self._joined = True
+            self._decoder.add(self)
+
+    def _release(self) -> None:
+        if self._decoder is not None:
+            if self._decoder.remove(self):
+                del _decoders[(self._loop, self._server)]
+            self._decoder = None
+
+    def close(self):
+        self._release()
+        super().close()
+
+    def discovery_fields(self) -> List[Field]:
+        # A sensor for every meter publishes on a topic per meter
+        if not self.meter_id:
+            return []
+        return [field for field in super().discovery_fields()
+                if field.name == "kWh"]
+
+    def meter_stats(self) -> Dict[int, MeterStats]:
+        """Return the statistics of the meters this sensor reports, by ID."""
+        if self._decoder is None:
+            return {}
+        if not self.meter_id:
+            return dict(self._decoder.meters)
+        stats = self._decoder.meters.get(self.meter_id)
+        return {self.meter_id: stats} if stats is not None else {}
+
+    def reading(self, meter: int, consumption: int):
+        """Handle a consumption reading from the shared decoder."""
+        if self._last.get(meter) == consumption:
+            self.duplicates += 1
+            return
+        self._last[meter] = consumption
+        reading = Reading(meter, consumption)
+        if self.meter_id:
+            self.publish_reading(reading)
+        else:
+            # Every meter heard gets its own topic under this sensor's
+            topic = "%s/%d" % (self.topic, meter)
+            self._loop.publish_raw(topic,
+                                   self._encoder.encode(reading.values),
+                                   self.qos, self.retain)
+            for recorder in self._recorders:
+                recorder.record(topic, self._fields, reading.values)
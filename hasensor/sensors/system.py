@@ -1,12 +1,64 @@
-import json
-from typing import Dict, List
-
-import psutil                           # type: ignore
+import os
+import re
+import select
+from typing import Any, Dict, List, Optional, Set, Tuple
 
+from ..reading import Field, Fields, Reading
 from ..sensor import ArgDict, Sensor
 
+_THERMAL = "/sys/class/thermal/thermal_zone0/temp"
+
+# Filesystems without a backing device that are nonetheless on disk
+_PHYSICAL_NODEV = {"zfs"}
+
+
+def _open(path: str) -> Optional[int]:
+    try:
+        return os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+
+
+def _read(fd: int, size: int = 4096) -> bytes:
+    # Read a small /proc or /sys file from the start without seeking
+    data = os.pread(fd, size, 0)
+    while len(data) == size:
+        size *= 2
+        data = os.pread(fd, size, 0)
+    return data
+
+
+def _unescape(path: str) -> str:
+    # Mount points in mountinfo escape space, tab, newline and backslash
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), path)
+
+
+def _nodev_filesystems() -> Set[str]:
+    nodev: Set[str] = set()
+    with open("/proc/filesystems", "r") as f:
+        for line in f:
+            if line.startswith("nodev"):
+                nodev.add(line.split()[1])
+    return nodev - _PHYSICAL_NODEV
+
+
+def _disk_percent(path: str) -> float:
+    # Percentage of space used, as seen by an unprivileged user (as df)
+    st = os.statvfs(path)
+    used = st.f_blocks - st.f_bfree
+    total = used + st.f_bavail
+    if not total:
+        return 0.0
+    return used * 100.0 / total
+
 
 class SystemSensor(Sensor):
+    _fields: Fields = (
+        Field("cpu_temp", unit="°C", device_class="temperature"),
+        Field("cpu_pct", unit="%"),
+        Field("mem_used_pct", unit="%"),
+        Field("disk_full", "json"))
+
     _argtypes: ArgDict = {
         "partitions": str,
         "diskthresh": float
@@ -23,29 +75,94 @@ class SystemSensor(Sensor):
 
         self._diskthresh = diskthresh
 
-    def fire(self):
-        stats: Dict[str, str] = {}
+        # Files read on every fire are kept open and read with pread()
+        self._thermal = _open(_THERMAL)
+        self._stat = _open("/proc/stat")
+        self._meminfo = _open("/proc/meminfo")
+        self._cpu_times: Optional[Tuple[int, int]] = None
+
+        # The partition list is cached until the mount table changes, which
+        # the kernel signals by marking mountinfo with POLLPRI
+        self._mounts: Optional[List[str]] = None
+        self._mountinfo: Optional[int] = None
+        self._mountpoll: Optional[Any] = None
+        if self._diskthresh != 0.0 and not self._partitions:
+            self._mountinfo = _open("/proc/self/mountinfo")
+            self._mountpoll = select.poll()
+            if self._mountinfo is not None:
+                self._mountpoll.register(self._mountinfo, select.POLLPRI)
+
+    def close(self):
+        for fd in (self._thermal, self._stat, self._meminfo,
+                   self._mountinfo):
+            if fd is not None:
+                os.close(fd)
+        self._thermal = self._stat = self._meminfo = self._mountinfo = None
+        super().close()
 
-        with open("/sys/class/thermal/thermal_zone0/temp", "r") as f:
-            temp = int(f.read())
-        f_temp = float(temp) / 1000.0
-        stats["cpu_temp"] = round(f_temp, 1)
+    def _cpu_pct(self) -> float:
+        # Busy time since the last fire, from the aggregate line of /proc/stat
+        line = _read(self._stat, 256).split(b"\n", 1)[0]
+        fields = [int(field) for field in line.split()[1:9]]
+        total = sum(fields)
+        idle = fields[3] + fields[4]
+        prev = self._cpu_times
+        self._cpu_times = (total, idle)
+        if prev is not None:
+            total -= prev[0]
+            idle -= prev[1]
+        if total <= 0:
+            return 0.0
+        return (total - idle) * 100.0 / total
 
-        stats["cpu_pct"] = round(psutil.cpu_percent(), 1)
-        stats["mem_used_pct"] = round(psutil.virtual_memory().percent, 1)
+    def _mem_used_pct(self) -> float:
+        info: Dict[bytes, int] = {}
+        for line in _read(self._meminfo).split(b"\n"):
+            key, _, value = line.partition(b":")
+            if key in (b"MemTotal", b"MemAvailable"):
+                info[key] = int(value.split()[0])
+                if len(info) == 2:
+                    break
+        total = info.get(b"MemTotal", 0)
+        if not total:
+            return 0.0
+        return (total - info.get(b"MemAvailable", 0)) * 100.0 / total
 
+    def _mountpoints(self) -> List[str]:
+        if self._mountinfo is None:
+            return []
+        if self._mounts is not None and not self._mountpoll.poll(0):
+            return self._mounts
+
+        nodev = _nodev_filesystems()
+        mounts: List[str] = []
+        for line in _read(self._mountinfo).decode().split("\n"):
+            # The filesystem type follows the "-" separator
+            fields = line.split(" - ", 1)
+            if len(fields) != 2:
+                continue
+            fstype = fields[1].split(" ", 1)[0]
+            if fstype not in nodev:
+                mounts.append(_unescape(fields[0].split(" ")[4]))
+        self._mounts = mounts
+        return mounts
+
+    def fire(self):
+        cpu_temp = None
+        if self._thermal is not None:
+            cpu_temp = int(_read(self._thermal, 32)) / 1000.0
+
+        warnings: Optional[List[str]] = None
         if self._diskthresh != 0.0:
-            warnings: List[str] = []
-            if self._partitions:
-                for part in self._partitions:
-                    if psutil.disk_usage(part).percent > self._diskthresh:
+            warnings = []
+            parts = self._partitions or self._mountpoints()
+            for part in parts:
+                try:
+                    if _disk_percent(part) > self._diskthresh:
                         warnings.append(part)
-            else:
-                for part in psutil.disk_partitions():
-                    usage = psutil.disk_usage(part.mountpoint)
-                    if usage.percent > self._diskthresh:
-                        warnings.append(part.mountpoint)
-            if warnings:
-                stats["disk_full"] = warnings
-
-        self._loop.publish(self.name, json.dumps(stats))
+                except OSError:
+                    # Unmounted since the list was read, or unreadable
+                    pass
+
+        return Reading(cpu_temp, self._cpu_pct(), self._mem_used_pct(),
+                       warnings or None)
@@ -0,0 +1,233 @@
+"""The set of sensors running on a node, and reloading it.
+
+A SensorSet creates and schedules sensors from their description strings, and
+can later be given a new list of descriptions, in which case it changes only
+what differs: sensors that were removed are closed, new sensors are created,
+sensors whose schedule alone changed are rescheduled, and all other sensors
+keep running undisturbed.  Sensors are matched by name, so no two sensors in
+a set may have the same name.
+
+A ConfigWatcher is a loop event that applies the sensors from the
+configuration file when the file changes or the process receives SIGHUP.
+"""
+
+import os
+import signal
+import sys
+from dataclasses import fields
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from .configuration import Configuration
+from .event import RepeatingEvent, NOW
+from .loop import Loop
+from .registry import create_sensor, parse_description
+from .sensor import Sensor, missed_parser, time_parser
+
+# Sensor arguments that can be changed by rescheduling the sensor
+_SCHEDULE_ARGS = {
+    "start": time_parser,
+    "period": float,
+    "missed": missed_parser,
+}
+
+
+class _Entry(NamedTuple):
+    desc: str
+    sensor: Sensor
+
+
+def _split(desc: str) -> Tuple[str, Dict[str, Optional[str]],
+                               Dict[str, Optional[str]]]:
+    # Return the type, schedule arguments and other arguments of a sensor
+    sensortype, args = parse_description(desc)
+    sched = {k: v for k, v in args.items() if k in _SCHEDULE_ARGS}
+    other = {k: v for k, v in args.items() if k not in _SCHEDULE_ARGS}
+    return sensortype, sched, other
+
+
+def _key(desc: str) -> str:
+    # Sensors are matched by name, or by description if they have none
+    _, args = parse_description(desc)
+    name = args.get("name")
+    return name if name is not None else desc
+
+
+def _keyed(descs: List[str]) -> Dict[str, str]:
+    # The descriptions by key, which must be unique
+    wanted: Dict[str, str] = {}
+    for desc in descs:
+        key = _key(desc)
+        if key in wanted:
+            raise Exception("duplicate sensor name %s" % key)
+        wanted[key] = desc
+    return wanted
+
+
+class SensorSet:
+    """The sensors scheduled on a loop."""
+
+    def __init__(self, loop: Loop, prefix: Optional[str] = None):
+        """Create an empty set of sensors on loop.
+
+        The sensors publish under prefix, or the loop's prefix if none is
+        given.
+        """
+        self._loop = loop
+        self._prefix = prefix
+        self._sensors: Dict[str, _Entry] = {}
+        self.on_change: Optional[Callable[[], None]] = None
+        """Called after apply() has changed the running sensors."""
+
+    def __len__(self) -> int:
+        return len(self._sensors)
+
+    def sensors(self) -> List[Sensor]:
+        """Return the running sensors."""
+        return [entry.sensor for entry in self._sensors.values()]
+
+    def _start(self, key: str, desc: str) -> None:
+        sensor = create_sensor(desc)
+        sensor.set_loop(self._loop, self._prefix)
+        self._loop.schedule(sensor.event())
+        self._sensors[key] = _Entry(desc, sensor)
+
+    def apply(self, descs: List[str]) -> Tuple[int, int, int]:
+        """Make the running sensors match a list of descriptions.
+
+        Returns the numbers of sensors created, closed, and rescheduled.  A
+        sensor whose arguments changed other than its schedule is closed and
+        created anew.  If a description cannot be created, the exception is
+        raised once every other change has been made.  If two descriptions
+        give the same name, nothing is changed and an exception is raised.
+        """
+        wanted = _keyed(descs)
+        created = closed = rescheduled = 0
+        error: Optional[Exception] = None
+
+        for key in list(self._sensors):
+            if key not in wanted:
+                self._sensors.pop(key).sensor.close()
+                closed += 1
+
+        for key, desc in wanted.items():
+            entry = self._sensors.get(key)
+            if entry is not None and entry.desc == desc:
+                continue
+            if entry is not None:
+                oldtype, oldsched, oldargs = _split(entry.desc)
+                newtype, newsched, newargs = _split(desc)
+                if oldtype == newtype and oldargs == newargs:
+                    self._reschedule(entry.sensor, newsched)
+                    self._sensors[key] = _Entry(desc, entry.sensor)
+                    rescheduled += 1
+                    continue
+                self._sensors.pop(key).sensor.close()
+                closed += 1
+            try:
+                self._start(key, desc)
+                created += 1
+            except Exception as err:     # pylint: disable=broad-except
+                error = err
+
+        if self.on_change is not None and (created or closed or rescheduled):
+            self.on_change()
+        if error is not None:
+            raise error
+        return created, closed, rescheduled
+
+    def _reschedule(self, sensor: Sensor,
+                    sched: Dict[str, Optional[str]]) -> None:
+        typed = {arg: _SCHEDULE_ARGS[arg](value)
+                 for arg, value in sched.items() if value is not None}
+        sensor.set_schedule(**typed)
+        self._loop.schedule(sensor.event())
+
+    def close(self) -> None:
+        """Close every sensor."""
+        for entry in self._sensors.values():
+            entry.sensor.close()
+        self._sensors.clear()
+
+
+class ConfigWatcher(RepeatingEvent):
+    """An event that reloads the sensors when the configuration changes.
+
+    The configuration file is checked every conf.config_poll seconds, and
+    reloaded if it has been modified or if SIGHUP was received since the last
+    check.  Only the sensors are reloaded; other changes to the configuration
+    are reported, and take effect when the node is restarted.
+    """
+
+    def __init__(self, conf: Configuration, sensors: SensorSet):
+        super().__init__(NOW, conf.config_poll or 1.0, _check, self)
+        self._conf = conf
+        self._sensors = sensors
+        self._requested = False
+        self._mtime = self._modified()
+        self.reloads = 0
+        """The number of times the configuration has been reloaded."""
+
+    def install(self) -> None:
+        """Reload the configuration on SIGHUP.
+
+        Every installed watcher reloads its configuration on the signal.
+        """
+        _watchers.append(self)
+        signal.signal(signal.SIGHUP, _hangup)
+
+    def uninstall(self) -> None:
+        """Stop reloading this configuration on SIGHUP."""
+        if self in _watchers:
+            _watchers.remove(self)
+
+    def _modified(self) -> float:
+        if self._conf.config is None or not self._conf.config_poll:
+            return 0.0
+        try:
+            return os.stat(self._conf.config).st_mtime
+        except OSError:
+            return 0.0
+
+    def check(self) -> None:
+        """Reload the configuration if it has changed or was requested."""
+        mtime = self._modified()
+        if not self._requested and mtime == self._mtime:
+            return
+        self._requested = False
+        self._mtime = mtime
+        try:
+            conf = self._conf.reloaded()
+        except (Exception, SystemExit) as err:   # pylint: disable=broad-except
+            # argparse exits on bad options; keep running the old sensors
+            print("configuration not reloaded: %s" % err, file=sys.stderr)
+            return
+
+        changed = [f.name for f in fields(Configuration)
+                   if f.name != "sensors"
+                   and getattr(conf, f.name) != getattr(self._conf, f.name)]
+        if changed:
+            print("restart to apply changes to %s" % ", ".join(changed),
+                  file=sys.stderr)
+        try:
+            created, closed, rescheduled = self._sensors.apply(conf.sensors)
+        except Exception as err:     # pylint: disable=broad-except
+            print("error reloading sensors: %s" % err, file=sys.stderr)
+            return
+        finally:
+            self._conf.sensors = conf.sensors
+            self.reloads += 1
+        print("reloaded sensors: %d created, %d closed, %d rescheduled"
+              % (created, closed, rescheduled), file=sys.stderr)
+
+
+_watchers: List[ConfigWatcher] = []
+
+
+def _hangup(signum, frame) -> None:
+    # Only set flags; the loop may be anywhere when a signal arrives
+    for watcher in _watchers:
+        watcher._requested = True     # pylint: disable=protected-access
+
+
+def _check(watcher: ConfigWatcher) -> None:
+    watcher.check()
@@ -0,0 +1,195 @@
+"""A disk-backed store-and-forward spool for outgoing messages.
+
+Messages published while the broker is unreachable are appended to a
+fixed-size ring buffer in a memory-mapped file, and drained in order once the
+connection returns.  Because the buffer lives in a file, spooled messages
+survive a restart of the sensor node; because the file never grows, neither
+does the node's memory footprint.
+
+File layout: a fixed header holding the buffer geometry and the head and tail
+positions, followed by the ring itself.  Positions only ever increase; a
+record at position p lives at offset p % capacity in the ring, and may wrap
+around its end.  Each record is a small header (topic length, payload length,
+QoS and retain flag) followed by the UTF-8 topic and the payload bytes.
+"""
+
+import mmap
+import os
+import struct
+import threading
+from typing import Callable, Dict, List, Tuple, Union
+
+_MAGIC = b"HASPOOL2"
+_HEADER = struct.Struct("<8sQQQQ")      # magic, capacity, head, tail, count
+_RECORD = struct.Struct("<HIB")         # topic length, payload length, flags
+_RETAIN = 0x04                          # flags are QoS | _RETAIN
+
+POLICIES = ("oldest", "newest", "coalesce")
+"""The valid drop policies for a full spool."""
+
+# (topic, payload, qos, retain)
+Message = Tuple[str, bytes, int, bool]
+
+
+class Spool:
+    """A bounded, persistent FIFO of MQTT messages.
+
+    When a message does not fit, the drop policy decides what to lose:
+      - oldest:   drop the oldest messages until the new one fits
+      - newest:   drop the new message
+      - coalesce: keep only the most recent message on each topic, then
+                  fall back to dropping the oldest
+
+    Spools are safe to use from multiple threads.
+    """
+
+    def __init__(self, path: str, size: int = 1 << 20,
+                 policy: str = "oldest"):
+        """Open or create the spool file at path.
+
+        The size is the capacity of the ring in bytes.  An existing spool
+        with a different capacity, or an unreadable one, is discarded.
+        """
+        if policy not in POLICIES:
+            raise Exception("unknown spool policy %s" % policy)
+        self.policy = policy
+        self.dropped: int = 0
+        """The number of messages dropped because the spool was full."""
+
+        self._lock = threading.Lock()
+        self._capacity = size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            os.ftruncate(fd, _HEADER.size + size)
+            self._map = mmap.mmap(fd, _HEADER.size + size)
+        finally:
+            os.close(fd)
+
+        magic, capacity, head, tail, count = _HEADER.unpack_from(self._map)
+        if magic != _MAGIC or capacity != size \
+           or not head <= tail <= head + size:
+            head = tail = count = 0
+        self._head = head
+        self._tail = tail
+        self._count = count
+        self._sync_header()
+
+    def __len__(self) -> int:
+        return self._count
+
+    def used(self) -> int:
+        """Return the number of bytes of the ring currently in use."""
+        return self._tail - self._head
+
+    def close(self) -> None:
+        """Flush the spool to disk and unmap it."""
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+
+    def _sync_header(self) -> None:
+        _HEADER.pack_into(self._map, 0, _MAGIC, self._capacity, self._head,
+                          self._tail, self._count)
+
+    def _write(self, pos: int, data: bytes) -> None:
+        off = pos % self._capacity
+        first = min(len(data), self._capacity - off)
+        base = _HEADER.size
+        self._map[base + off:base + off + first] = data[:first]
+        if first < len(data):
+            self._map[base:base + len(data) - first] = data[first:]
+
+    def _read(self, pos: int, length: int) -> bytes:
+        off = pos % self._capacity
+        first = min(length, self._capacity - off)
+        base = _HEADER.size
+        data = self._map[base + off:base + off + first]
+        if first < length:
+            data += self._map[base:base + length - first]
+        return data
+
+    def _record_at(self, pos: int) -> Tuple[Message, int]:
+        tlen, plen, flags = _RECORD.unpack(self._read(pos, _RECORD.size))
+        topic = self._read(pos + _RECORD.size, tlen).decode()
+        payload = self._read(pos + _RECORD.size + tlen, plen)
+        return (topic, payload, flags & 0x03, bool(flags & _RETAIN)), \
+            _RECORD.size + tlen + plen
+
+    def _drop_oldest(self) -> None:
+        _, length = self._record_at(self._head)
+        self._head += length
+        self._count -= 1
+        self.dropped += 1
+
+    def _coalesce(self) -> None:
+        # Rewrite the ring keeping only the latest message on each topic, in
+        # the order of those latest messages.
+        latest: Dict[str, int] = {}
+        records: List[Message] = []
+        pos = self._head
+        while pos < self._tail:
+            message, length = self._record_at(pos)
+            latest[message[0]] = len(records)
+            records.append(message)
+            pos += length
+        keep = sorted(latest.values())
+        self.dropped += len(records) - len(keep)
+        self._head = self._tail = self._count = 0
+        for index in keep:
+            self._append(*records[index])
+
+    def _append(self, topic: str, payload: bytes, qos: int,
+                retain: bool) -> None:
+        tbytes = topic.encode()
+        flags = qos | (_RETAIN if retain else 0)
+        self._write(self._tail, _RECORD.pack(len(tbytes), len(payload), flags)
+                    + tbytes + payload)
+        self._tail += _RECORD.size + len(tbytes) + len(payload)
+        self._count += 1
+
+    def append(self, topic: str, payload: Union[str, bytes], qos: int = 0,
+               retain: bool = False) -> bool:
+        """Add a message to the spool.
+
+        Returns False if the message (or another message, according to the
+        drop policy) was dropped to make room.
+        """
+        if isinstance(payload, str):
+            payload = payload.encode()
+        length = _RECORD.size + len(topic.encode()) + len(payload)
+        with self._lock:
+            free = self._capacity - (self._tail - self._head)
+            lossless = length <= free
+            if length > self._capacity or \
+               (not lossless and self.policy == "newest"):
+                self.dropped += 1
+                return False
+            if not lossless and self.policy == "coalesce":
+                self._coalesce()
+            while length > self._capacity - (self._tail - self._head):
+                self._drop_oldest()
+            self._append(topic, payload, qos, retain)
+            self._sync_header()
+            return lossless
+
+    def drain(self, limit: int,
+              send: Callable[[str, bytes, int, bool], bool]) -> int:
+        """Send up to limit of the oldest messages, removing them as they go.
+
+        The send callable is given each message in turn, and should return
+        False if it could not be sent, which stops the drain and leaves that
+        message at the head of the spool.  Returns the number sent.
+        """
+        sent = 0
+        with self._lock:
+            while sent < limit and self._count:
+                message, length = self._record_at(self._head)
+                if not send(*message):
+                    break
+                self._head += length
+                self._count -= 1
+                sent += 1
+            if not self._count:
+                self._head = self._tail = 0
+            self._sync_header()
+        return sent
@@ -0,0 +1,603 @@
+"""Long-term local history of readings, in append-only segment files.
+
+A Store keeps the readings of the node's sensor topics in files under a
+directory, so that history survives broker outages and restarts.  Each topic
+has three series: its raw readings, and rollups of them into one-minute and
+one-hour summaries.  A series is a directory of segment files, each named
+after the time of its first record in milliseconds, holding a header that
+describes its fields and then fixed-width little-endian records: the time
+(seconds since the Epoch) as a double, then each numeric field as a float,
+or a 64-bit integer for integer fields.  Absent values are NaN, or the
+smallest integer.  A rollup record holds the number of readings in its
+bucket, and the minimum, mean and maximum of each field.
+
+Readings are kept in memory as sensors take them, and every sync interval
+the loop has a worker thread pack them, build their rollups and write them
+out, with one fsync per file written, so that an SD card sees few, large
+writes and the loop never waits for it.  Each rollup bucket is written once
+it is over.  When the files outgrow the store's size, the oldest segments are
+deleted, raw readings first, then minute rollups and finally hour rollups; a
+segment still being written is never deleted.
+
+Records must be in time order for reads to find them, so a reading taken
+before the last one recorded on its topic, because it was back-dated or the
+clock stepped back, is stored at the time of the last.
+
+Series are read through mmap, by binary search on the record times, so a
+range read touches only the pages it returns.  python -m hasensor.store
+lists the series in a store and exports ranges of them as CSV or JSON.
+"""
+
+import argparse
+import csv
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, \
+    Optional, Sequence, Tuple
+from urllib.parse import quote, unquote
+
+from .reading import Fields
+
+RESOLUTIONS = ("raw", "1m", "1h")
+"""The series kept for each topic: raw readings, then rollups."""
+
+SEGMENT_SIZE = 1 << 18
+"""The size at which a new segment file is started (bytes)."""
+
+_BUCKETS = {"1m": 60.0, "1h": 3600.0}
+_MAGIC = b"HAS1"
+# The magic number and the length of the JSON field description that follows
+_HEADER = struct.Struct("<4sH")
+_TIME = struct.Struct("<d")
+_MISSING_INT = -(1 << 63)
+
+# The fields of a series: (name, kind, precision) for each, kind float or int
+_Spec = Tuple[Tuple[str, str, int], ...]
+
+
+def _struct(spec: _Spec) -> struct.Struct:
+    return struct.Struct("<d" + "".join("q" if kind == "int" else "f"
+                                        for _, kind, _ in spec))
+
+
+class Segment:
+    """A segment file, read through mmap."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, length = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC:
+                raise Exception("%s is not a segment file" % path)
+            spec = json.loads(f.read(length))
+        self.spec: _Spec = tuple(tuple(field) for field in spec)
+        self.fields = [name for name, _, _ in self.spec]
+        """The names of the fields in each record"""
+        self.start = _start(path)
+        """The time of the first record"""
+        self._struct = _struct(self.spec)
+        self._offset = _HEADER.size + length
+
+    def records(self, since: Optional[float] = None,
+                until: Optional[float] = None) -> Iterator[Tuple[Any, ...]]:
+        """Yield the records taken from since through until, in order.
+
+        A record is its time followed by its field values.  A partial record
+        at the end of the file, from an interrupted write, is ignored.
+        """
+        with open(self.path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            count = (size - self._offset) // self._struct.size
+            if count <= 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                first = 0 if since is None \
+                    else self._search(data, count, since, False)
+                end = count if until is None \
+                    else self._search(data, count, until, True)
+                size = self._struct.size
+                yield from self._struct.iter_unpack(
+                    data[self._offset + first * size:self._offset + end * size])
+
+    def _search(self, data: mmap.mmap, count: int, when: float,
+                after: bool) -> int:
+        # The index of the first record later than (or, unless after, at)
+        # when
+        low, high = 0, count
+        while low < high:
+            mid = (low + high) // 2
+            t = _TIME.unpack_from(data, self._offset
+                                  + mid * self._struct.size)[0]
+            if t < when or (after and t == when):
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+
+class Series:
+    """One resolution of one topic's readings: a directory of segments."""
+
+    def __init__(self, path: str, level: int, segment_size: int):
+        self.path = path
+        self.level = level
+        """The position of the series' resolution in RESOLUTIONS"""
+        self._segment_size = segment_size
+        # Records waiting to be written, in runs of the same fields
+        self._pending: List[Tuple[_Spec, bytearray]] = []
+        self._file: Optional[BinaryIO] = None
+        self._file_path: Optional[str] = None
+        self._file_spec: Optional[_Spec] = None
+        self._file_size = 0
+        # The headers of segments already read, by path
+        self._segments: Dict[str, Segment] = {}
+
+    def segments(self) -> List[str]:
+        """Return the paths of the series' segments, oldest first."""
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            return []
+        return [os.path.join(self.path, name)
+                for name in sorted(names) if name.endswith(".seg")]
+
+    def deleted(self, path: str) -> None:
+        """Note that a segment of the series was deleted."""
+        self._segments.pop(path, None)
+
+    def active(self) -> Optional[str]:
+        """Return the path of the segment being written, if any."""
+        return self._file_path
+
+    def append(self, spec: _Spec, packer: struct.Struct,
+               values: Sequence[Any]) -> None:
+        """Buffer a record of the given fields."""
+        if not self._pending or self._pending[-1][0] != spec:
+            self._pending.append((spec, bytearray()))
+        self._pending[-1][1].extend(packer.pack(*values))
+
+    def take(self) -> List[Tuple[_Spec, bytearray]]:
+        """Return and clear the buffered records."""
+        pending, self._pending = self._pending, []
+        return pending
+
+    def write(self, pending: List[Tuple[_Spec, bytearray]]) -> int:
+        """Write buffered records out and fsync them; return the bytes added.
+
+        Records go to the current segment until it is full, or the fields
+        change, and then to a new one.
+        """
+        added = 0
+        for spec, data in pending:
+            size = _struct(spec).size
+            pos = 0
+            while pos < len(data):
+                if self._file is None or self._file_spec != spec \
+                        or self._file_size + size > self._segment_size:
+                    added += self._open(spec, _TIME.unpack_from(data, pos)[0])
+                room = max((self._segment_size - self._file_size) // size,
+                           1) * size
+                piece = data[pos:pos + room]
+                self._file.write(piece)
+                self._file_size += len(piece)
+                added += len(piece)
+                pos += len(piece)
+        if self._file is not None and pending:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        return added
+
+    def _open(self, spec: _Spec, start: float) -> int:
+        # Start a new segment at time start; returns the header's size
+        self.close()
+        os.makedirs(self.path, exist_ok=True)
+        millis = int(start * 1000)
+        while True:
+            path = os.path.join(self.path, "%015d.seg" % millis)
+            try:
+                self._file = open(path, "xb")
+                break
+            except FileExistsError:
+                millis += 1
+        description = json.dumps(spec, separators=(",", ":")).encode()
+        header = _HEADER.pack(_MAGIC, len(description)) + description
+        self._file.write(header)
+        self._file_path = path
+        self._file_spec = spec
+        self._file_size = len(header)
+        return len(header)
+
+    def close(self) -> None:
+        """Close the segment being written, if any."""
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+        self._file = None
+        self._file_path = None
+
+    def read(self, since: Optional[float] = None,
+             until: Optional[float] = None) -> Tuple[List[str],
+                                                     List[Tuple[Any, ...]]]:
+        """Return the field names and records from since through until.
+
+        Records of older segments with other fields are given the fields of
+        the newest segment, by name, with None for any they lack.  Values are
+        rounded to their field's precision, and absent values are None.
+        """
+        # Segment files are named after their start, so only the headers of
+        # those in range, and of the newest, need to be read
+        paths = self.segments()
+        starts = [_start(path) for path in paths]
+        chosen = [path for i, path in enumerate(paths)
+                  if (until is None or starts[i] <= until)
+                  and (since is None or i + 1 == len(paths)
+                       or starts[i + 1] > since)]
+        if paths and paths[-1] not in chosen:
+            chosen.append(paths[-1])
+        segments = []
+        for path in chosen:
+            segment = self._segments.get(path)
+            if segment is None:
+                try:
+                    segment = self._segments[path] = Segment(path)
+                except Exception:        # pylint: disable=broad-except
+                    # Not a segment, or one whose header was never written
+                    continue
+            segments.append(segment)
+        if not segments:
+            return [], []
+        spec = segments[-1].spec
+        names = [name for name, _, _ in spec]
+        rows: List[Tuple[Any, ...]] = []
+        for segment in segments:
+            if until is not None and segment.start > until:
+                break
+            index = {name: j + 1 for j, name in enumerate(segment.fields)}
+            columns = [(index.get(name, 0), _converter(kind, precision)
+                        if name in index else _absent)
+                       for name, kind, precision in spec]
+            rows.extend((round(record[0], 3),)
+                        + tuple(convert(record[j]) for j, convert in columns)
+                        for record in segment.records(since, until))
+        return names, rows
+
+
+def _start(path: str) -> float:
+    # The time of the first record of a segment, from its name
+    return int(os.path.basename(path).split(".")[0]) / 1000.0
+
+
+def _absent(value: Any) -> None:
+    return None
+
+
+def _converter(kind: str, precision: int) -> Callable[[Any], Any]:
+    # Turns a stored value into a reading value, or None if absent
+    if kind == "int":
+        return lambda value: None if value == _MISSING_INT else value
+    return lambda value: None if value != value else round(value, precision)
+
+
+class _Rollup:
+    # Summarizes readings into buckets of a fixed length as they arrive
+    def __init__(self, bucket: float, fields: int):
+        self.bucket = bucket
+        self.start: Optional[float] = None
+        self._fields = fields
+        self._count = 0
+        self._stats: List[List[float]] = []
+
+    def add(self, when: float,
+            values: Sequence[Any]) -> Optional[Tuple[Any, ...]]:
+        """Add a reading, returning the record of a bucket it ends."""
+        start = when - when % self.bucket
+        record = None
+        if self.start is not None and start != self.start:
+            record = self.close()
+        if self.start is None:
+            self.start = start
+            self._count = 0
+            self._stats = [[0, 0.0, math.inf, -math.inf]
+                           for _ in range(self._fields)]
+        self._count += 1
+        for stats, value in zip(self._stats, values):
+            if value is None or value != value:
+                continue
+            stats[0] += 1
+            stats[1] += value
+            if value < stats[2]:
+                stats[2] = value
+            if value > stats[3]:
+                stats[3] = value
+        return record
+
+    def close(self) -> Optional[Tuple[Any, ...]]:
+        """End the current bucket, returning its record if it has one."""
+        if self.start is None:
+            return None
+        record: List[Any] = [self.start, self._count]
+        for n, total, low, high in self._stats:
+            if n:
+                record.extend((low, total / n, high))
+            else:
+                record.extend((math.nan, math.nan, math.nan))
+        self.start = None
+        return tuple(record)
+
+
+class _Topic:
+    # How a topic's readings are stored, for the fields of its sensor
+    def __init__(self, fields: Fields, series: List[Series]):
+        self.fields = fields
+        # Readings not yet taken for writing, as (time, numeric values)
+        self.pending: List[Tuple[float, List[Any]]] = []
+        self.last = -math.inf
+        self.index = [i for i, field in enumerate(fields)
+                      if field.kind != "json"]
+        numeric = [fields[i] for i in self.index]
+        self.spec: _Spec = tuple((field.name, field.kind, field.precision)
+                                 for field in numeric)
+        self.packer = _struct(self.spec)
+        self.ints = [field.kind == "int" for field in numeric]
+        rollup_spec: List[Tuple[str, str, int]] = [("count", "int", 0)]
+        for name, _, precision in self.spec:
+            rollup_spec.extend(("%s_%s" % (name, stat), "float", precision)
+                               for stat in ("min", "mean", "max"))
+        self.rollup_spec: _Spec = tuple(rollup_spec)
+        self.rollup_packer = _struct(self.rollup_spec)
+        self.series = series
+        self.rollups = [_Rollup(_BUCKETS[resolution], len(self.spec))
+                        for resolution in RESOLUTIONS[1:]]
+
+
+# The readings taken for writing: the time taken, and each topic with its
+# readings and whether its sensor has changed fields since
+_Taken = Tuple[float, List[Tuple[_Topic, List[Tuple[float, List[Any]]], bool]]]
+
+
+class Store:
+    """Readings of a node's sensor topics, kept in a directory."""
+
+    def __init__(self, path: str, size: int,
+                 segment_size: int = SEGMENT_SIZE):
+        """Keep readings under path, in at most about size bytes."""
+        self.path = path
+        self.size = size
+        self._segment_size = min(segment_size, max(size // 8, 4096))
+        os.makedirs(path, exist_ok=True)
+        self._series: Dict[Tuple[str, str], Series] = {}
+        self._topics: Dict[str, _Topic] = {}
+        # Topics whose sensors changed fields, with readings still to write
+        self._retired: List[_Topic] = []
+        # Readings may be recorded by worker threads
+        self._lock = threading.Lock()
+        # Held while writing, which may happen on a worker thread
+        self._write_lock = threading.Lock()
+        self.bytes = 0
+        """The size of the segment files (bytes)"""
+        self.appended = 0
+        """The number of readings recorded"""
+        self.deleted = 0
+        """The number of segments deleted to keep to the size"""
+        self.syncs = 0
+        """The number of times the buffers were written and fsynced"""
+        for topic in self.topics():
+            for resolution in RESOLUTIONS:
+                for segment in self.series(topic, resolution).segments():
+                    self.bytes += os.path.getsize(segment)
+        # The writer's own counts, published by synced()
+        self._bytes = self.bytes
+        self._deleted = 0
+        self._syncs = 0
+
+    def topics(self) -> List[str]:
+        """Return the topics with readings in the store."""
+        return sorted(unquote(name) for name in os.listdir(self.path)
+                      if os.path.isdir(os.path.join(self.path, name)))
+
+    def series(self, topic: str, resolution: str = "raw") -> Series:
+        """Return a series of a topic."""
+        series = self._series.get((topic, resolution))
+        if series is None:
+            # The writer and the recording threads may both get here
+            path = os.path.join(self.path, quote(topic, safe=""), resolution)
+            series = self._series.setdefault((topic, resolution), Series(
+                path, RESOLUTIONS.index(resolution), self._segment_size))
+        return series
+
+    def record(self, topic: str, fields: Fields, values: Sequence[Any],
+               when: Optional[float] = None) -> None:
+        """Record a reading published on topic.
+
+        when is the monotonic time the reading was taken, if not now.
+        """
+        now = time.time()
+        if when is not None:
+            now -= time.monotonic() - when
+        with self._lock:
+            stored = self._topics.get(topic)
+            if stored is None or stored.fields is not fields:
+                if stored is not None:
+                    self._retired.append(stored)
+                stored = self._topics[topic] = _Topic(
+                    fields, [self.series(topic, resolution)
+                             for resolution in RESOLUTIONS])
+            if now < stored.last:
+                now = stored.last
+            stored.last = now
+            stored.pending.append((now, [values[i] for i in stored.index]))
+            self.appended += 1
+
+    def forget(self, topic: str) -> None:
+        """Note that topic's sensor was removed; its readings are kept."""
+
+    def take(self) -> '_Taken':
+        """Take the readings recorded since the last take, for write().
+
+        The readings are taken with the time, so that write() closes only
+        the rollup buckets over by then.
+        """
+        with self._lock:
+            taken = []
+            for stored in self._retired:
+                taken.append((stored, stored.pending, True))
+            for stored in self._topics.values():
+                taken.append((stored, stored.pending, False))
+                stored.pending = []
+            self._retired = []
+        return time.time(), taken
+
+    def write(self, taken: '_Taken') -> Tuple[int, int, int]:
+        """Write out readings from take(), then enforce the size.
+
+        The readings are packed and rolled up, the rollup buckets that are
+        over are closed, and every file written is fsynced.  This may be
+        called on any thread.  Returns the size of the files, the number of
+        segments deleted and the number of writes, for synced().
+        """
+        now, topics = taken
+        with self._write_lock:
+            for stored, readings, retired in topics:
+                self._pack(stored, readings, math.inf if retired else now)
+            for series in list(self._series.values()):
+                records = series.take()
+                if records:
+                    self._bytes += series.write(records)
+            self._syncs += 1
+            if self._bytes > self.size:
+                self._expire()
+            return self._bytes, self._deleted, self._syncs
+
+    def synced(self, counts: Tuple[int, int, int]) -> None:
+        """Publish the counts returned by write()."""
+        if counts[2] > self.syncs:
+            self.bytes, self.deleted, self.syncs = counts
+
+    def _pack(self, stored: _Topic, readings: List[Tuple[float, List[Any]]],
+              now: float) -> None:
+        # Buffer the records of readings and of the rollup buckets that are
+        # over by now
+        raw_series = stored.series[0]
+        for when, numbers in readings:
+            raw = [when]
+            for value, integer in zip(numbers, stored.ints):
+                raw.append(value if value is not None
+                           else _MISSING_INT if integer else math.nan)
+            raw_series.append(stored.spec, stored.packer, raw)
+            for rollup, series in zip(stored.rollups, stored.series[1:]):
+                record = rollup.add(when, numbers)
+                if record is not None:
+                    series.append(stored.rollup_spec, stored.rollup_packer,
+                                  record)
+        for rollup, series in zip(stored.rollups, stored.series[1:]):
+            if rollup.start is not None \
+                    and now >= rollup.start + rollup.bucket:
+                record = rollup.close()
+                if record is not None:
+                    series.append(stored.rollup_spec, stored.rollup_packer,
+                                  record)
+
+    def flush(self) -> None:
+        """Write the recorded readings out now, on the calling thread."""
+        self.synced(self.write(self.take()))
+
+    def _expire(self) -> None:
+        # Delete the oldest segments of the most detailed series first
+        candidates = []
+        for topic in self.topics():
+            for resolution in RESOLUTIONS:
+                series = self.series(topic, resolution)
+                active = series.active()
+                candidates.extend(
+                    (series.level, os.path.basename(path), path, series)
+                    for path in series.segments() if path != active)
+        candidates.sort(key=lambda candidate: candidate[:3])
+        for _, _, path, series in candidates:
+            if self._bytes <= self.size:
+                break
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+            except OSError:
+                continue
+            series.deleted(path)
+            self._bytes -= size
+            self._deleted += 1
+
+    def read(self, topic: str, since: Optional[float] = None,
+             until: Optional[float] = None, resolution: str = "raw"
+             ) -> Tuple[List[str], List[Tuple[Any, ...]]]:
+        """Return the field names and records of a topic's series.
+
+        Only records that have been written out are included.
+        """
+        if resolution not in RESOLUTIONS:
+            raise Exception("unknown resolution %s" % resolution)
+        return self.series(topic, resolution).read(since, until)
+
+    def close(self) -> None:
+        """Write out the buffered readings and close the files."""
+        self.flush()
+        with self._write_lock:
+            for series in self._series.values():
+                series.close()
+
+    def report(self) -> Dict[str, Any]:
+        """Return the store's size and activity, for the runtime metrics."""
+        return {"topics": len(self._topics), "bytes": self.bytes,
+                "appended": self.appended, "deleted": self.deleted,
+                "syncs": self.syncs}
+
+
+def _parse_time(arg: str) -> float:
+    # Seconds since the Epoch, or a negative number of seconds before now
+    value = float(arg)
+    return time.time() + value if value < 0 else value
+
+
+def _main() -> None:
+    parser = argparse.ArgumentParser(
+        description="List or export the readings in a store.")
+    parser.add_argument("store", help="The store directory")
+    parser.add_argument("topic", nargs="?",
+                        help="The topic to export; list the topics if none")
+    parser.add_argument("--since", type=_parse_time,
+                        help="Start of the range (seconds since the Epoch, "
+                        "or negative for seconds ago)")
+    parser.add_argument("--until", type=_parse_time,
+                        help="End of the range (as for --since)")
+    parser.add_argument("--resolution", choices=RESOLUTIONS, default="raw",
+                        help="Raw readings, or minute or hour rollups")
+    parser.add_argument("--format", choices=["csv", "json"], default="csv",
+                        help="Output format")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.store):
+        parser.error("no store at %s" % args.store)
+    store = Store(args.store, 0)
+    if args.topic is None:
+        for topic in store.topics():
+            print(topic)
+        return
+    fields, rows = store.read(args.topic, args.since, args.until,
+                              args.resolution)
+    if args.format == "json":
+        json.dump({"topic": args.topic, "resolution": args.resolution,
+                   "fields": ["time"] + fields, "rows": rows},
+                  sys.stdout, separators=(",", ":"))
+        print()
+        return
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["time"] + fields)
+    writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    _main()
@@ -0,0 +1,352 @@
+"""Transports that carry published messages away from the node.
+
+The loop hands every outgoing message to a Transport.  The MQTT transport
+sends to a broker through paho; the others deliver to consumers on the same
+host without a broker round trip: an in-memory consumer in the same process, a
+Unix datagram socket, or an append-only file.
+
+A transport reports connection changes through its on_connect() and
+on_disconnect() callbacks, and acknowledgements of QoS 1 and 2 messages
+through on_publish(), which the loop sets.  Transports that need socket I/O
+expose their socket so that the loop can wait on it.  Transports that can
+receive messages pass those on the topics given to listen() to on_message().
+"""
+
+import collections
+import socket
+import struct
+import time
+from typing import (Any, BinaryIO, Callable, Deque, Iterator, List, Optional,
+                    Sequence, Tuple)
+
+import paho.mqtt.client as MQTTClient
+
+from .configuration import Configuration
+from .outbound import Message, Payload
+
+TRANSPORTS = ("mqtt", "memory", "unix", "file")
+"""The names of the available transports."""
+
+# A record in an append-only file: wall clock time, flags (QoS and retain),
+# topic length, payload length; the topic and payload follow
+_RECORD = struct.Struct("<dBHI")
+_RETAIN = 0x04
+
+
+def _encode(data: Payload) -> bytes:
+    return data.encode() if isinstance(data, str) else data
+
+
+class Transport:
+    """The base class for transports.
+
+    Subclasses implement at least connect() and publish(); the base class
+    describes a transport that is connected as soon as connect() returns and
+    has no socket of its own.
+    """
+
+    def __init__(self):
+        self.on_connect: Callable[[int], None] = lambda result: None
+        """Called with a result of 0 when connected, or nonzero on failure."""
+        self.on_disconnect: Callable[[int], None] = lambda result: None
+        """Called when an established connection is lost."""
+        self.on_publish: Callable[[int], None] = lambda mid: None
+        """Called with the message ID of an acknowledged message."""
+        self.on_message: Callable[[str, bytes], None] = \
+            lambda topic, payload: None
+        """Called with the topic and payload of a received message."""
+        self.on_socket_open: Callable[[Any], None] = lambda sock: None
+        self.on_socket_close: Callable[[Any], None] = lambda sock: None
+        self.on_socket_register_write: Callable[[Any], None] = \
+            lambda sock: None
+        self.on_socket_unregister_write: Callable[[Any], None] = \
+            lambda sock: None
+
+    def connect(self) -> None:
+        """Begin a connection attempt.
+
+        The outcome is reported through on_connect(), possibly before this
+        method returns.  An immediate failure raises OSError.
+        """
+        raise NotImplementedError
+
+    def disconnect(self) -> None:
+        """Abandon the current connection or connection attempt."""
+
+    def listen(self, topic: str) -> None:
+        """Receive messages on topic, now and after every reconnection.
+
+        Transports that cannot receive messages ignore this.
+        """
+
+    def publish(self, topic: str, data: Payload, qos: int,
+                retain: bool) -> Optional[int]:
+        """Send a message.
+
+        Returns the message ID if the message awaits acknowledgement, 0 if it
+        was sent and needs none, or None if it could not be sent.
+        """
+        raise NotImplementedError
+
+    def publish_many(self, messages: Sequence[Message]) -> List[Optional[int]]:
+        """Send several messages, returning a result for each as publish()."""
+        return [self.publish(*message) for message in messages]
+
+    def socket(self) -> Any:
+        """Return the socket the loop should wait on, if any."""
+        return None
+
+    def want_write(self) -> bool:
+        """Return whether the transport has data waiting to be written."""
+        return False
+
+    def loop_read(self) -> None:
+        """Handle the transport's socket becoming readable."""
+
+    def loop_write(self) -> None:
+        """Handle the transport's socket becoming writable."""
+
+    def loop_misc(self) -> None:
+        """Perform periodic maintenance, such as keepalives."""
+
+
+class MQTTTransport(Transport):
+    """Publish to an MQTT broker using paho."""
+
+    def __init__(self, conf: Configuration):
+        super().__init__()
+        self._conf = conf
+        self._connecting = False
+        self._topics: List[str] = []
+        self._client = MQTTClient.Client(conf.client_id, userdata=self)
+        client = self._client
+        client.on_connect = lambda c, d, flags, result: \
+            self._connected(result)
+        client.on_message = lambda c, d, msg: \
+            self.on_message(msg.topic, msg.payload)
+        client.on_disconnect = lambda c, d, result: self.on_disconnect(result)
+        client.on_publish = lambda c, d, mid: self.on_publish(mid)
+        client.on_socket_open = lambda c, d, sock: self.on_socket_open(sock)
+        client.on_socket_close = lambda c, d, sock: self.on_socket_close(sock)
+        client.on_socket_register_write = \
+            lambda c, d, sock: self.on_socket_register_write(sock)
+        client.on_socket_unregister_write = \
+            lambda c, d, sock: self.on_socket_unregister_write(sock)
+        availability = conf.availability_topic()
+        if availability is not None:
+            # The broker marks the node unavailable if it vanishes
+            client.will_set(availability, "offline", 1, True)
+
+    def _connected(self, result: int) -> None:
+        if result == 0:
+            for topic in self._topics:
+                self._client.subscribe(topic, 1)
+        self.on_connect(result)
+
+    def connect(self) -> None:
+        if not self._connecting:
+            self._connecting = True
+            self._client.connect_async(self._conf.broker[0],
+                                       self._conf.broker[1])
+        self._client.reconnect()
+
+    def disconnect(self) -> None:
+        self._client.disconnect()
+
+    def listen(self, topic: str) -> None:
+        if topic not in self._topics:
+            self._topics.append(topic)
+            if self._client.is_connected():
+                self._client.subscribe(topic, 1)
+
+    def publish(self, topic: str, data: Payload, qos: int,
+                retain: bool) -> Optional[int]:
+        info = self._client.publish(topic, data, qos, retain)
+        if info.rc != MQTTClient.MQTT_ERR_SUCCESS:
+            return None
+        return info.mid if qos else 0
+
+    def socket(self) -> Any:
+        return self._client.socket()
+
+    def want_write(self) -> bool:
+        return self._client.want_write()
+
+    def loop_read(self) -> None:
+        self._client.loop_read()
+
+    def loop_write(self) -> None:
+        self._client.loop_write()
+
+    def loop_misc(self) -> None:
+        self._client.loop_misc()
+
+
+class MemoryTransport(Transport):
+    """Deliver messages to consumers in the same process.
+
+    Each message is passed to every subscribed consumer as it is sent, and the
+    most recent messages are kept in messages.
+    """
+
+    def __init__(self, keep: int = 1000):
+        """Create a transport keeping the last keep messages."""
+        super().__init__()
+        self.messages: Deque[Message] = collections.deque(maxlen=keep)
+        """The most recently sent messages."""
+        self._consumers: List[Callable[[Message], None]] = []
+        self._topics: List[str] = []
+
+    def subscribe(self, consumer: Callable[[Message], None]) -> None:
+        """Pass every message sent from now on to consumer."""
+        self._consumers.append(consumer)
+
+    def listen(self, topic: str) -> None:
+        if topic not in self._topics:
+            self._topics.append(topic)
+
+    def receive(self, topic: str, payload: Payload) -> None:
+        """Deliver a message to the node, as a broker would."""
+        if topic in self._topics:
+            self.on_message(topic, _encode(payload))
+
+    def connect(self) -> None:
+        self.on_connect(0)
+
+    def publish(self, topic: str, data: Payload, qos: int,
+                retain: bool) -> Optional[int]:
+        message = (topic, data, qos, retain)
+        self.messages.append(message)
+        for consumer in self._consumers:
+            consumer(message)
+        return 0
+
+    def publish_many(self, messages: Sequence[Message]) -> List[Optional[int]]:
+        self.messages.extend(messages)
+        for consumer in self._consumers:
+            for message in messages:
+                consumer(message)
+        return [0] * len(messages)
+
+
+class UnixDatagramTransport(Transport):
+    """Send each message as a datagram to a Unix domain socket.
+
+    A datagram is the UTF-8 topic, a NUL byte, and the payload.  Messages are
+    not acknowledged; if the receiver goes away or falls behind, the transport
+    disconnects and the loop retries as it would for a broker.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self._path = path
+        self._sock: Optional[socket.socket] = None
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.setblocking(False)
+            sock.connect(self._path)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        self.on_connect(0)
+
+    def disconnect(self) -> None:
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def publish(self, topic: str, data: Payload, qos: int,
+                retain: bool) -> Optional[int]:
+        if self._sock is None:
+            return None
+        try:
+            self._sock.send(topic.encode() + b"\0" + _encode(data))
+        except OSError:
+            self.disconnect()
+            self.on_disconnect(1)
+            return None
+        return 0
+
+
+class FileTransport(Transport):
+    """Append messages to a file.
+
+    Each record is a header (wall clock time, flags, topic length and payload
+    length) followed by the topic and payload; read_file() reads them back.
+    A batch of messages is written with a single write.
+    """
+
+    def __init__(self, path: str):
+        super().__init__()
+        self._path = path
+        self._file: Optional[BinaryIO] = None
+
+    def connect(self) -> None:
+        self._file = open(self._path, "ab")
+        self.on_connect(0)
+
+    def disconnect(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def publish(self, topic: str, data: Payload, qos: int,
+                retain: bool) -> Optional[int]:
+        return self.publish_many([(topic, data, qos, retain)])[0]
+
+    def publish_many(self, messages: Sequence[Message]) -> List[Optional[int]]:
+        if self._file is None:
+            return [None] * len(messages)
+        now = time.time()
+        records = []
+        for topic, data, qos, retain in messages:
+            btopic = topic.encode()
+            payload = _encode(data)
+            records.append(_RECORD.pack(now, qos | (_RETAIN if retain else 0),
+                                        len(btopic), len(payload)))
+            records.append(btopic)
+            records.append(payload)
+        try:
+            self._file.write(b"".join(records))
+            self._file.flush()
+        except OSError:
+            self.disconnect()
+            self.on_disconnect(1)
+            return [None] * len(messages)
+        return [0] * len(messages)
+
+
+def read_file(path: str) -> Iterator[Tuple[float, str, bytes, int, bool]]:
+    """Yield (time, topic, payload, qos, retain) for each record in a file
+    written by FileTransport."""
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = 0
+    while pos + _RECORD.size <= len(data):
+        stamp, flags, tlen, plen = _RECORD.unpack_from(data, pos)
+        pos += _RECORD.size
+        if pos + tlen + plen > len(data):
+            # A record cut short by a crash
+            break
+        topic = data[pos:pos + tlen].decode()
+        payload = data[pos + tlen:pos + tlen + plen]
+        pos += tlen + plen
+        yield stamp, topic, payload, flags & 0x03, bool(flags & _RETAIN)
+
+
+def create_transport(conf: Configuration) -> Transport:
+    """Create the transport named by the configuration."""
+    if conf.transport == "mqtt":
+        return MQTTTransport(conf)
+    if conf.transport == "memory":
+        return MemoryTransport()
+    if conf.transport_path is None:
+        raise Exception("the %s transport requires a path" % conf.transport)
+    if conf.transport == "unix":
+        return UnixDatagramTransport(conf.transport_path)
+    if conf.transport == "file":
+        return FileTransport(conf.transport_path)
+    raise Exception("unknown transport %s" % conf.transport)